@@ -0,0 +1,82 @@
+"""
+    benchmarks.build_box
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Tiempo para construir la caja de un dispositivo en el dashboard,
+    comparando la figura cacheada con la construcción completa de
+    plotly (como se hacía antes).
+
+    Uso (desde dashCO2-web): python -m benchmarks.build_box
+"""
+
+import timeit
+
+import arrow
+import plotly.graph_objs as go
+
+from dashCO2 import config, dashapp
+from dashCO2.shared import COLORS
+
+DEVICE = dict(
+    id=1, serial_number=1, floor="1", room="s/d", building="s/d"
+)
+BUILDINGS = {"s/d": "building-filter-NO"}
+
+
+def _measurements(n=2000):
+    now = arrow.utcnow().timestamp
+    step = config.DISPLAY_LEN_SEC // n
+    x = [now - config.DISPLAY_LEN_SEC + step * i for i in range(n)]
+    y = [400 + (i * 7) % 600 for i in range(n)]
+    return x, y
+
+
+def plotly_figure(x, y, serial_number):
+    """Full go.Figure construction, as used before the skeleton cache."""
+    fig = go.Figure(
+        {
+            "data": [
+                {
+                    "x": list(x),
+                    "y": list(y),
+                    "mode": "lines",
+                    "name": f"sparkline-line-{serial_number}-id",
+                    "line": {"color": "#888", "width": 3},
+                }
+            ],
+            "layout": dashapp.SPARKLINE_LAYOUT,
+        }
+    )
+    xmax = arrow.utcnow().float_timestamp
+    xmin = xmax - config.DISPLAY_LEN_SEC
+    fig.update_layout(xaxis_range=[xmin, xmax], yaxis_range=[0, 1200])
+    for value, color in (
+        (config.RANGES.OK, COLORS.OK),
+        (config.RANGES.WARNING, COLORS.WARNING),
+        (config.RANGES.DANGER, COLORS.DANGER),
+    ):
+        fig.add_hline(
+            value, line_dash="dot", line_width=1, line_color=color
+        )
+    return fig
+
+
+def main(number=50):
+    x, y = _measurements()
+
+    results = {
+        "plotly figure": lambda: plotly_figure(x, y, 1),
+        "cached figure": lambda: dashapp.sparkline_figure(x, y, 1),
+        "build_box": lambda: dashapp.build_box(
+            DEVICE, (x, y), BUILDINGS
+        ),
+    }
+
+    for name, func in results.items():
+        func()
+        elapsed = timeit.timeit(func, number=number) / number
+        print(f"{name:>15}: {elapsed * 1000:8.3f} ms per box")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+    benchmarks.fixtures
+    ~~~~~~~~~~~~~~~~~~~
+
+    Bases de datos sqlite sintéticas para los benchmarks: una flota de
+    dispositivos generada con dashCO2.fleet, con una medición por minuto
+    durante los últimos días.
+
+    Las bases se guardan en benchmarks/.fixtures y se vuelven a generar
+    cuando sus datos ya no llegan hasta el momento actual.
+"""
+
+import json
+import pathlib
+import time
+
+import sqlalchemy
+
+from dashCO2 import fleet, models
+
+FOLDER = pathlib.Path(__file__).parent / ".fixtures"
+
+# Antigüedad máxima de los datos de una base (en segundos).
+MAX_AGE_SEC = 60 * 60
+
+
+def build(path, devices, days, period_sec=60):
+    """Create a sqlite database with a synthetic fleet."""
+    end = int(time.time())
+    path = pathlib.Path(path)
+    path.unlink(missing_ok=True)
+    engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+    models.db.Model.metadata.create_all(engine)
+    fleet.generate(
+        engine,
+        devices,
+        days,
+        period_sec=period_sec,
+        seed=devices,
+        end=end,
+    )
+
+    path.with_suffix(".json").write_text(
+        json.dumps(dict(devices=devices, days=days, end=end))
+    )
+    return path
+
+
+def get(devices, days) -> pathlib.Path:
+    """Path of the database for a fleet, building it if needed."""
+    FOLDER.mkdir(exist_ok=True)
+    path = FOLDER / f"fleet-{devices}x{days}.db"
+    try:
+        info = json.loads(path.with_suffix(".json").read_text())
+        if path.exists() and time.time() - info["end"] < MAX_AGE_SEC:
+            return path
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    return build(path, devices, days)
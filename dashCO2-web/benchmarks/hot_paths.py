@@ -0,0 +1,407 @@
+"""
+    benchmarks.hot_paths
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Tiempos de las partes más usadas de la aplicación, para flotas
+    sintéticas de distintos tamaños (ver fixtures), sobre sqlite:
+
+    - models: get_values, load_devices, get_devices_by_status y
+      summarize_devices.
+    - dashapp.build_box.
+    - La cadena de callbacks del dashboard (dispositivos, cajas,
+      mediciones recientes, sparklines y resumen).
+    - /store.
+    - Las listas del admin (sensores, registros y últimas 24 h).
+
+    Los cachés del servidor quedan calientes después de la primera
+    llamada, por lo que se mide el estado estacionario.
+
+    Los resultados se guardan en benchmarks/results/<versión>-<fecha>.json
+    y se comparan con el último resultado anterior (o con --compare).
+
+    Uso (desde dashCO2-web):
+        python -m benchmarks.hot_paths [--devices 10 100 1000] [--days 1]
+"""
+
+import argparse
+import json
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import arrow
+
+from benchmarks import fixtures
+from dashCO2 import config
+
+RESULTS = pathlib.Path(__file__).parent / "results"
+
+
+def measure(func, min_time=0.5, max_runs=200) -> dict:
+    """Call func repeatedly (after a warm up call) and return timing
+    statistics in milliseconds."""
+    func()
+    times = []
+    deadline = time.perf_counter() + min_time
+    while len(times) < max_runs and (
+        len(times) < 3 or time.perf_counter() < deadline
+    ):
+        started = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - started) * 1000)
+    return dict(
+        runs=len(times),
+        min_ms=min(times),
+        median_ms=statistics.median(times),
+        mean_ms=statistics.mean(times),
+    )
+
+
+def _dash_app(flask_app, prefix):
+    return flask_app.view_functions[
+        f"{prefix}_dash-update-component"
+    ].__self__
+
+
+def _dash_call(client, prefix, output, inputs, state=()):
+    """Call a dash callback through the http endpoint, as the browser.
+    inputs and state are lists of dicts with id, property and value."""
+    payload = dict(
+        output=output,
+        outputs=_outputs(output, inputs),
+        inputs=inputs,
+        changedPropIds=[_prop_id(inputs[0])],
+        state=list(state),
+    )
+    response = client.post(
+        prefix + "_dash-update-component", json=payload
+    )
+    if response.status_code == 204:
+        return {}
+    assert response.status_code == 200, response.data[:500]
+    return response.get_json()["response"]
+
+
+def _prop_id(item):
+    return f"{item['id']}.{item['property']}"
+
+
+def _outputs(output, inputs):
+    """Outputs of the payload for the callback id. Pattern matching
+    outputs (ALL) match the ids of the first pattern matching input."""
+    parts = (
+        output[2:-2].split("...")
+        if output.startswith("..")
+        else [output]
+    )
+    matched = next((i for i in inputs if isinstance(i, list)), [])
+    out = []
+    for part in parts:
+        component, _, prop = part.rpartition(".")
+        if component.startswith("{"):
+            kind = json.loads(component)["type"]
+            out.append(
+                [
+                    dict(id=dict(item["id"], type=kind), property=prop)
+                    for item in matched
+                ]
+            )
+        else:
+            out.append(dict(id=component, property=prop))
+    return out if output.startswith("..") else out[0]
+
+
+def _item(component, prop, value):
+    return dict(id=component, property=prop, value=value)
+
+
+def dashboard_chain(client, flask_app, visible_count=40):
+    """Run the callbacks executed when the dashboard is loaded."""
+    prefix = "/dashboard/"
+    # By the first output.
+    callbacks = {
+        key.strip(".").split("...")[0]: key
+        for key in _dash_app(flask_app, prefix).callback_map
+    }
+
+    out = _dash_call(
+        client,
+        prefix,
+        callbacks["devices.data"],
+        [
+            _item("interval-component-devices", "n_intervals", 0),
+            _item("live-devices", "n_clicks", None),
+        ],
+        [
+            _item("devices", "data", None),
+            _item("buildings", "data", None),
+        ],
+    )
+    devices_key = out["devices"]["data"]
+    buildings_key = out["buildings"]["data"]
+    selected = [
+        option["value"] for option in out["filter-buildings"]["options"]
+    ]
+
+    out = _dash_call(
+        client,
+        prefix,
+        callbacks["grid-content.children"],
+        [
+            _item("devices", "data", devices_key),
+            _item("buildings", "data", buildings_key),
+            _item("view-options", "value", []),
+            _item("filter-buildings", "value", selected),
+        ],
+    )
+    serials = [
+        box["props"]["id"]["serial"]
+        for box in _find(out["grid-content"]["children"], "sparkline")
+    ]
+    visible = serials[:visible_count]
+
+    out = _dash_call(
+        client,
+        prefix,
+        callbacks["recent-measurements.data"],
+        [
+            _item("devices", "data", devices_key),
+            _item("interval-component-records", "n_intervals", 0),
+            _item("live-records", "n_clicks", None),
+            _item("visible-devices", "data", visible),
+        ],
+        [
+            _item("filter-buildings", "value", selected),
+            _item("buildings", "data", buildings_key),
+            _item("data-version", "data", None),
+        ],
+    )
+    recent_key = out["recent-measurements"]["data"]
+    last_update = out["last-update"]["data"]
+
+    sparkline_callback = next(
+        key for key in callbacks.values() if '"sparkline"' in key
+    )
+    _dash_call(
+        client,
+        prefix,
+        sparkline_callback,
+        [
+            _item("recent-measurements", "data", recent_key),
+            [
+                _item(
+                    dict(serial=sn, type="sparkline"),
+                    "id",
+                    dict(serial=sn, type="sparkline"),
+                )
+                for sn in serials
+            ],
+        ],
+        [_item("visible-devices", "data", visible)],
+    )
+
+    _dash_call(
+        client,
+        prefix,
+        callbacks["summary-count.data"],
+        [_item("last-update", "data", last_update)],
+    )
+
+
+def _find(component, kind):
+    """Components with a pattern matching id of the given type."""
+    if isinstance(component, list):
+        for child in component:
+            yield from _find(child, kind)
+    elif isinstance(component, dict):
+        props = component.get("props", {})
+        if isinstance(props.get("id"), dict):
+            if props["id"].get("type") == kind:
+                yield component
+        yield from _find(props.get("children"), kind)
+
+
+def run_fleet(devices, days) -> dict:
+    path = fixtures.get(devices, days)
+    config.SQLALCHEMY_DATABASE_URI = f"sqlite:///{path}"
+    config.CLIENTSIDE_SPARKLINES = False
+
+    from dashCO2 import create_app, dashapp, models
+
+    flask_app = create_app(False)
+    client = flask_app.test_client()
+    results = {}
+
+    with flask_app.app_context():
+        now = arrow.utcnow().timestamp
+        serial_number = devices // 2 + 1
+        dev_list, buildings, _ = models.load_devices()
+        recent = models.get_recent_values(serial_number)
+
+        cases = {
+            "models.get_values": lambda: models.get_values(
+                serial_number, now - config.DISPLAY_LEN_SEC, 10000
+            ),
+            "models.load_devices": models.load_devices,
+            "models.get_devices_by_status": models.get_devices_by_status,
+            "models.summarize_devices": lambda: models.summarize_devices(
+                config.CONSIDER_OFFLINE_SEC, config.NO_CAL
+            ),
+            "dashapp.build_box": lambda: dashapp.build_box(
+                dev_list[0], recent, buildings
+            ),
+        }
+        for name, func in cases.items():
+            results[name] = measure(func)
+
+    results["dashboard callbacks"] = measure(
+        lambda: dashboard_chain(client, flask_app)
+    )
+
+    counter = iter(range(10**9))
+
+    def store():
+        timestamp = arrow.utcnow().timestamp + next(counter)
+        response = client.post(
+            "/store",
+            json=dict(
+                timestamp=timestamp,
+                uptime=1,
+                ntpEpoch=timestamp,
+                bootID=1,
+                userRecord=dict(co2=600, temperature=22),
+            ),
+            headers={
+                "SNO-SERIAL-NUMBER": str(serial_number),
+                "SNO-ACQ-PERIOD": "60000",
+                "SNO-METHOD": "0",
+                "SNO-USER-lastCalibration": "42",
+                "SNO-USER-firmwareVersion": "2021071801",
+                "SNO-API-KEY": _api_key(),
+            },
+        )
+        assert response.status_code == 200, response.status_code
+
+    results["/store"] = measure(store)
+
+    for name, url in (
+        ("admin sensores", "/admin/device/"),
+        ("admin registros", "/admin/record/"),
+        ("admin registros por sensor", "/admin/record/?search=%d"),
+        ("admin últimas 24 h", "/admin/day/"),
+    ):
+        if "%d" in url:
+            url = url % serial_number
+
+        def get(url=url):
+            response = client.get(url)
+            assert response.status_code == 200, response.status_code
+
+        results[name] = measure(get)
+
+    return results
+
+
+def _api_key():
+    from dashCO2 import secrets
+
+    return secrets.API_KEY or ""
+
+
+def _version() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=pathlib.Path(__file__).parent,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _previous(exclude: pathlib.Path):
+    files = sorted(
+        (p for p in RESULTS.glob("*.json") if p != exclude),
+        key=lambda p: p.stat().st_mtime,
+    )
+    return files[-1] if files else None
+
+
+def report(results: dict, previous: dict = None):
+    for fleet, cases in results.items():
+        print(f"\n{fleet}")
+        for name, stats in cases.items():
+            line = f"  {name:<32} {stats['median_ms']:10.3f} ms"
+            old = (previous or {}).get(fleet, {}).get(name)
+            if old:
+                ratio = stats["median_ms"] / old["median_ms"]
+                line += f"  ({ratio:5.2f}x)"
+            print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[4])
+    parser.add_argument(
+        "--devices", type=int, nargs="+", default=[10, 100, 1000]
+    )
+    parser.add_argument("--days", type=int, default=1)
+    parser.add_argument(
+        "--compare", type=pathlib.Path, help="Resultado anterior."
+    )
+    args = parser.parse_args(argv)
+
+    results = {}
+    for devices in args.devices:
+        # Cada flota necesita su propia aplicación y base de datos.
+        out = subprocess.check_output(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.hot_paths",
+                "--single",
+                str(devices),
+                str(args.days),
+            ],
+            cwd=pathlib.Path(__file__).parent.parent,
+            text=True,
+        )
+        results[
+            f"{devices} dispositivos x {args.days} días"
+        ] = json.loads(out.splitlines()[-1])
+
+    version = _version()
+    RESULTS.mkdir(exist_ok=True)
+    path = RESULTS / "{}-{}.json".format(
+        version, arrow.now().format("YYYYMMDD-HHmmss")
+    )
+    previous_path = args.compare or _previous(path)
+    previous = None
+    if previous_path is not None:
+        previous = json.loads(previous_path.read_text())["results"]
+        print(f"Comparando con {previous_path.name}")
+
+    path.write_text(
+        json.dumps(
+            dict(
+                version=version,
+                date=arrow.utcnow().isoformat(),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                results=results,
+            ),
+            indent=2,
+        )
+    )
+    report(results, previous)
+    print(f"\nResultados en {path}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--single"]:
+        devices, days = map(int, sys.argv[2:4])
+        print(json.dumps(run_fleet(devices, days)))
+    else:
+        main()
@@ -0,0 +1,71 @@
+"""
+    benchmarks.wire_size
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Bytes enviados al navegador en cada actualización del store
+    recent-measurements, para una flota de dispositivos, con el
+    formato anterior (listas JSON) y el compacto (dashCO2.wire),
+    sin comprimir, con gzip y con brotli.
+
+    Uso (desde dashCO2-web): python -m benchmarks.wire_size [dispositivos]
+"""
+
+import gzip
+import json
+import random
+import sys
+
+import brotli
+
+from dashCO2 import config, wire
+
+NOW = 1_700_000_000
+
+
+def fleet(devices, acq_period_sec=5):
+    """Synthetic recent measurements for a fleet."""
+    out = {}
+    n = config.DISPLAY_LEN_SEC // acq_period_sec
+    for serial_number in range(1, devices + 1):
+        value = random.randint(400, 900)
+        timestamps, values = [], []
+        for i in range(n):
+            value = min(max(value + random.randint(-15, 15), 380), 2500)
+            timestamps.append(NOW - (n - i) * acq_period_sec)
+            values.append(value)
+        out[serial_number] = timestamps, values
+    return out
+
+
+def sizes(payload: dict) -> tuple[int, int, int]:
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return (
+        len(raw),
+        len(gzip.compress(raw, 6)),
+        len(brotli.compress(raw, quality=4)),
+    )
+
+
+def main(devices=200):
+    random.seed(0)
+    data = fleet(devices)
+
+    formats = {
+        "json lists": {
+            str(k): [list(x), list(y)] for k, (x, y) in data.items()
+        },
+        "compact": {
+            str(k): wire.encode_series(x, y)
+            for k, (x, y) in data.items()
+        },
+    }
+
+    print(f"{devices} devices, {config.DISPLAY_LEN_SEC} s at 5 s")
+    print(f"{'':>12} {'raw':>12} {'gzip':>12} {'brotli':>12}")
+    for name, payload in formats.items():
+        raw, gz, br = sizes(payload)
+        print(f"{name:>12} {raw:>12,} {gz:>12,} {br:>12,}")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -47,6 +47,18 @@ def create_app(debug=False):
 
     db.init_app(flask_app)
 
+    from . import profiling
+
+    profiling.init_app(flask_app)
+
+    if config.COMPRESS_ALGORITHM:
+        from flask_compress import Compress
+
+        flask_app.config[
+            "COMPRESS_ALGORITHM"
+        ] = config.COMPRESS_ALGORITHM
+        Compress(flask_app)
+
     with flask_app.app_context():
         db.create_all()
 
@@ -75,11 +87,26 @@ def create_app(debug=False):
             db.session.add(rec)
 
             db.session.commit()
+        elif models.aggregates_missing():
+            flask_app.logger.warning(
+                "The database has records but no aggregates, the "
+                "history and the record counts will be empty. Run: "
+                "flask rebuild-aggregates"
+            )
+
+    from . import ringbuffer
+
+    ringbuffer.init_app(flask_app)
 
     from . import api, secrets
 
     api.init_app(flask_app, secrets.API_KEY)
 
+    from . import live
+
+    live.init_app(flask_app)
+
+    auth = None
     try:
         from . import _basicauth
 
@@ -93,13 +120,34 @@ def create_app(debug=False):
 
     from . import dashapp
 
+    # Compression (if any) is already set for the whole flask app.
     dash_app = dashapp.build_app(
-        server=flask_app, url_base_pathname="/dashboard/"
+        server=flask_app,
+        url_base_pathname="/dashboard/",
+        compress=False,
     )
 
     if debug:
         dash_app.enable_dev_tools(debug)
 
+    from . import history
+
+    history.build_app(
+        server=flask_app, url_base_pathname="/history/", compress=False
+    )
+
+    from . import kiosk
+
+    kiosk.init_app(flask_app)
+
+    from . import metrics
+
+    metrics.init_app(flask_app)
+
+    from . import commands
+
+    commands.init_app(flask_app)
+
     @flask_app.route("/")
     def index():
         return redirect("/admin")
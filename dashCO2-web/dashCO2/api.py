@@ -10,19 +10,23 @@
     /store [POST]
         Registra una medición.
     /updates/<int:version> [GET]
-        Versiones del firmware
+        Versiones del firmware (acepta If-None-Match, Range y
+        x-ESP8266-sketch-md5). Con ?gzip=1 se envía la versión
+        comprimida, si existe (ver firmware).
 """
 
 
 import dataclasses
 import functools
 import json
+import time
 
 import arrow
 import flask
+import numpy as np
 
-from . import config
-from .shared import get_latest_firmware_version
+from . import config, firmware, live, metrics, ringbuffer
+from .shared import classify, get_latest_firmware_version
 
 # Número que indica que version del firmware se usa para
 # registrar el dispositivo.
@@ -70,7 +74,8 @@ class SensorHeader:
 
 def init_app(app, api_key):
 
-    from .models import Device, Record, db
+    from . import rollout
+    from .models import Device, add_record, db, invalidate_summary
 
     if api_key:
 
@@ -144,6 +149,10 @@ def init_app(app, api_key):
                 )
                 db.session.add(dev)
                 db.session.commit()
+                if ringbuffer.get() is not None:
+                    ringbuffer.get().register(headers.serial_number)
+                invalidate_summary()
+                live.publish_device(dev)
             except Exception as ex:
                 app.logger.error(str(ex))
 
@@ -155,13 +164,31 @@ def init_app(app, api_key):
     @require_appkey
     def store():
         """Register a record in the database and handles"""
+        started = time.perf_counter()
+        try:
+            return _store()
+        except Exception:
+            flask.g.store_outcome = "error"
+            raise
+        finally:
+            method = flask.g.get("store_method", "-")
+            metrics.STORE_REQUESTS.inc(
+                method, flask.g.get("store_outcome", "ok")
+            )
+            metrics.STORE_DURATION.observe(
+                time.perf_counter() - started, method
+            )
 
+    def _store():
         try:
             headers = SensorHeader.from_headers(flask.request.headers)
         except Exception as ex:
             app.logger.error(f"Cannot parse headers: {ex}")
+            flask.g.store_outcome = "bad_headers"
             return flask.jsonify()
 
+        flask.g.store_method = str(headers.method)
+
         devs = Device.query.filter(
             Device.serial_number == headers.serial_number
         ).all()
@@ -170,6 +197,7 @@ def init_app(app, api_key):
             app.logger.warning(
                 f"No device found for {headers.serial_number}"
             )
+            flask.g.store_outcome = "unknown_device"
             return flask.jsonify(
                 dict(userServerPayload=dict(firmwareVersion=_REGISTER))
             )
@@ -189,13 +217,15 @@ def init_app(app, api_key):
             return store_device_info_method1(headers, record, devs[0])
 
         app.logger.error(f"Unknown method: {headers.method}")
+        flask.g.store_outcome = "unknown_method"
         return flask.jsonify()
 
     def store_record_method0(
         headers: SensorHeader, record: dict, dev: Device
     ):
+        previous_co2, previous_seen = dev.last_co2, dev.last_seen
         try:
-            rec = Record(
+            values = dict(
                 serial_number=headers.serial_number,
                 timestamp=record["timestamp"],
                 co2=record["userRecord"]["co2"],
@@ -204,12 +234,30 @@ def init_app(app, api_key):
                 ntp_epoch=record["ntpEpoch"],
                 boot_id=record["bootID"],
             )
-            db.session.add(rec)
-            dev.last_seen = record["timestamp"]
-            dev.last_co2 = record["userRecord"]["co2"]
-            db.session.commit()
+            if not add_record(dev, values):
+                app.logger.error(
+                    f"Aggregates not updated for {values['serial_number']}"
+                    f" at {values['timestamp']}, run flask "
+                    "rebuild-aggregates"
+                )
+                metrics.AGGREGATE_FAILURES.inc()
+            metrics.RECORDS.inc()
+            if ringbuffer.get() is not None:
+                ringbuffer.get().append(
+                    values["serial_number"],
+                    values["timestamp"],
+                    values["co2"],
+                )
+            codes = classify(
+                np.array([previous_co2, dev.last_co2], dtype=float),
+                np.array([previous_seen, dev.last_seen], dtype=float),
+            )
+            if codes[0] != codes[1]:
+                invalidate_summary()
+            live.publish_reading(dev, previous_co2, previous_seen)
         except Exception as ex:
             app.logger.error(str(ex))
+            flask.g.store_outcome = "error"
 
         payload = {}
         userServerPayload = {}
@@ -245,6 +293,7 @@ def init_app(app, api_key):
                 # update the value in the server
                 dev.last_calibration = headers.last_calibration
                 db.session.commit()
+                invalidate_summary()
             elif chk1 != chk2:
                 # The server changed its last digit,
                 # send instruction to the device.
@@ -252,8 +301,13 @@ def init_app(app, api_key):
                     "lastCalibration"
                 ] = dev.last_calibration
 
-        if headers.firmware_version != dev.firmware_version:
-            userServerPayload["firmwareVersion"] = dev.firmware_version
+        # Puede no ser dev.firmware_version si hay una actualización
+        # escalonada en curso (ver rollout).
+        firmware_version = rollout.firmware_for(
+            dev, headers.firmware_version
+        )
+        if headers.firmware_version != firmware_version:
+            userServerPayload["firmwareVersion"] = firmware_version
 
         if userServerPayload:
             payload["userServerPayload"] = userServerPayload
@@ -270,8 +324,10 @@ def init_app(app, api_key):
             dev.hardware_info = json.dumps(record)
             db.session.add(dev)
             db.session.commit()
+            invalidate_summary()
         except Exception as ex:
             app.logger.error(str(ex))
+            flask.g.store_outcome = "error"
 
         payload = {}
         userServerPayload = {}
@@ -304,6 +360,7 @@ def init_app(app, api_key):
                 # update the value in the server
                 dev.last_calibration = headers.last_calibration
                 db.session.commit()
+                invalidate_summary()
             elif chk1 != chk2:
                 # The server changed its last digit,
                 # send instruction to the device.
@@ -311,8 +368,13 @@ def init_app(app, api_key):
                     "lastCalibration"
                 ] = dev.last_calibration
 
-        if headers.firmware_version != dev.firmware_version:
-            userServerPayload["firmwareVersion"] = dev.firmware_version
+        # Puede no ser dev.firmware_version si hay una actualización
+        # escalonada en curso (ver rollout).
+        firmware_version = rollout.firmware_for(
+            dev, headers.firmware_version
+        )
+        if headers.firmware_version != firmware_version:
+            userServerPayload["firmwareVersion"] = firmware_version
 
         if userServerPayload:
             payload["userServerPayload"] = userServerPayload
@@ -322,10 +384,54 @@ def init_app(app, api_key):
 
     @app.route("/updates/<int:version>")
     def updates(version):
+        """Firmware binary, with the MD5 as a strong ETag and in the
+        header expected by the ESP8266 updater. Supports conditional
+        and range requests."""
         if version == _REGISTER:
             version = "first"
         elif version == _LATEST:
             version = get_latest_firmware_version()
-        return flask.send_from_directory(
-            "/firmware", f"{version}.ino.bin"
+        firmware_file = firmware.get_catalog().get(version)
+        if firmware_file is None:
+            flask.abort(404)
+
+        # The ESP8266 updater sends the MD5 of the running sketch.
+        if (
+            flask.request.headers.get("x-ESP8266-sketch-md5")
+            == firmware_file.md5
+        ):
+            response = flask.Response(status=304)
+            response.set_etag(firmware_file.md5)
+            return response
+
+        # The compressed image is flashed as is (the bootloader
+        # decompresses it), so it is not sent as Content-Encoding and
+        # the updater checks the MD5 of the compressed file. Only for
+        # firmware that asks for it: the Accept-Encoding of the ESP8266
+        # updater does not say whether the bootloader supports it.
+        if (
+            firmware_file.gz_size is not None
+            and flask.request.args.get("gzip") == "1"
+        ):
+            path, md5 = firmware_file.gz_path, firmware_file.gz_md5
+            variant = "gz"
+        else:
+            path, md5 = firmware_file.path, firmware_file.md5
+            variant = "bin"
+
+        response = flask.send_file(
+            path,
+            mimetype="application/octet-stream",
+            conditional=True,
+            etag=md5,
+            max_age=0,
         )
+        response.headers["x-ESP8266-sketch-md5"] = md5
+        response.headers["Accept-Ranges"] = "bytes"
+        if response.status_code in (200, 206):
+            metrics.FIRMWARE_BYTES.inc(
+                firmware_file.name,
+                variant,
+                amount=response.content_length or 0,
+            )
+        return response
@@ -0,0 +1,61 @@
+// Keeps track of the device boxes that are in (or close to) the
+// viewport, and asks dash to load their data by clicking a hidden
+// button. Boxes are found by their data-serial attribute.
+
+window.co2Lazy = (function() {
+  var visible = new Set();
+  var observed = new WeakSet();
+  var timer = null;
+
+  function notify() {
+    if (timer === null) {
+      timer = setTimeout(function() {
+        timer = null;
+        var button = document.getElementById("lazy-visible");
+        if (button) {
+          button.click();
+        }
+      }, 300);
+    }
+  }
+
+  var observer = new IntersectionObserver(function(entries) {
+    entries.forEach(function(entry) {
+      var serial = Number(entry.target.dataset.serial);
+      if (entry.isIntersecting) {
+        visible.add(serial);
+      } else {
+        visible.delete(serial);
+      }
+    });
+    notify();
+  }, {rootMargin: "200px"});
+
+  function scan() {
+    var present = new Set();
+    document.querySelectorAll(".grid-item[data-serial]").forEach(function(el) {
+      present.add(Number(el.dataset.serial));
+      if (!observed.has(el)) {
+        observed.add(el);
+        observer.observe(el);
+      }
+    });
+    // Boxes removed (e.g. filtered buildings) are no longer visible.
+    visible.forEach(function(serial) {
+      if (!present.has(serial)) {
+        visible.delete(serial);
+        notify();
+      }
+    });
+  }
+
+  new MutationObserver(scan).observe(
+    document.documentElement, {childList: true, subtree: true}
+  );
+
+  return {
+    visible: function() {
+      return Array.from(visible).sort(function(a, b) { return a - b; });
+    }
+  };
+})();
@@ -0,0 +1,37 @@
+// Receives events from /events (used when LIVE_UPDATES is enabled in
+// config.py) and asks dash to refresh by clicking hidden buttons.
+// Events arriving close together trigger a single refresh.
+
+window.co2Live = (function() {
+  var source = null;
+  var timers = {};
+
+  function click(id) {
+    delete timers[id];
+    var button = document.getElementById(id);
+    if (button) {
+      button.click();
+    }
+  }
+
+  function later(id) {
+    if (timers[id] === undefined) {
+      timers[id] = setTimeout(function() { click(id); }, 1000);
+    }
+  }
+
+  function subscribe(buildings) {
+    if (source !== null) {
+      source.close();
+    }
+    var query = buildings.map(function(b) {
+      return "building=" + encodeURIComponent(b);
+    }).join("&");
+    source = new EventSource("/events?" + query);
+    source.addEventListener("reading", function() { later("live-records"); });
+    source.addEventListener("status", function() { later("live-records"); });
+    source.addEventListener("device", function() { later("live-devices"); });
+  }
+
+  return {subscribe: subscribe};
+})();
@@ -0,0 +1,116 @@
+// Draws the sparklines in the browser from the recent-measurements store
+// (used when CLIENTSIDE_SPARKLINES is enabled in config.py).
+// Series are encoded with dashCO2.wire.encode_series.
+
+function co2ColorFromValue(value, timestamp, now, cfg) {
+  if (timestamp && now - timestamp > cfg.consider_offline_sec) {
+    return cfg.colors.offline;
+  }
+  if (value === null || value === undefined || isNaN(value)) {
+    return cfg.colors.offline;
+  }
+  if (value > cfg.ranges.danger) {
+    return cfg.colors.danger;
+  }
+  if (value > cfg.ranges.warning) {
+    return cfg.colors.warning;
+  }
+  return cfg.colors.ok;
+}
+
+// Inverse of dashCO2.wire.encode_series
+function co2DecodeBase64(text) {
+  var binary = atob(text);
+  var bytes = new Uint8Array(binary.length);
+  for (var i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return new DataView(bytes.buffer);
+}
+
+function co2DecodeSeries(data) {
+  var dt = co2DecodeBase64(data.dt);
+  var v = co2DecodeBase64(data.v);
+  var n = v.byteLength / 2;
+  var x = new Array(n), y = new Array(n);
+  var big = data.big || [], k = 0;
+  var t = data.t0;
+  for (var i = 0; i < n; i++) {
+    if (i > 0) {
+      var d = dt.getUint16(2 * (i - 1), true);
+      // 65535: the real difference is the next one in big.
+      t += d === 0xFFFF ? big[k++] : d;
+    }
+    x[i] = t;
+    y[i] = v.getInt16(2 * i, true);
+  }
+  return [x, y];
+}
+
+function co2RangeLine(value, color) {
+  return {
+    type: "line",
+    xref: "paper",
+    x0: 0,
+    x1: 1,
+    yref: "y",
+    y0: value,
+    y1: value,
+    line: {dash: "dot", width: 1, color: color}
+  };
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+  co2: {
+    renderSparklines: function(recent, ids, cfg) {
+      var now = Date.now() / 1000;
+      var shapes = [
+        co2RangeLine(cfg.ranges.ok, cfg.colors.ok),
+        co2RangeLine(cfg.ranges.warning, cfg.colors.warning),
+        co2RangeLine(cfg.ranges.danger, cfg.colors.danger)
+      ];
+      var layout = Object.assign({}, cfg.layout, {
+        xaxis: Object.assign({}, cfg.layout.xaxis, {
+          range: [now - cfg.display_len_sec, now]
+        }),
+        yaxis: Object.assign({}, cfg.layout.yaxis, {range: [0, 1200]}),
+        shapes: shapes
+      });
+
+      var figures = [], colors = [], values = [], styles = [];
+      var no_update = window.dash_clientside.no_update;
+      ids.forEach(function(id) {
+        var data = (recent || {})[String(id.serial)];
+        if (data === undefined) {
+          // Not loaded (yet), keep it as it is.
+          figures.push(no_update);
+          colors.push(no_update);
+          values.push(no_update);
+          styles.push(no_update);
+          return;
+        }
+        var xy = co2DecodeSeries(data);
+        var x = xy[0], y = xy[1];
+        var traces = [];
+        var value = "s/d";
+        var color = cfg.colors.offline;
+        if (x.length) {
+          value = y[y.length - 1];
+          color = co2ColorFromValue(value, x[x.length - 1], now, cfg);
+          traces.push({
+            x: x,
+            y: y,
+            mode: "lines",
+            name: "sparkline-line-" + id.serial + "-id",
+            line: {color: "#888", width: 3}
+          });
+        }
+        figures.push({data: traces, layout: layout});
+        colors.push(color);
+        values.push(String(value));
+        styles.push({color: color});
+      });
+      return [figures, colors, values, styles];
+    }
+  }
+});
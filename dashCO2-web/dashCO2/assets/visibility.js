@@ -0,0 +1,15 @@
+// Lets dash know when the page is hidden or shown (to pause the
+// refresh timers), and asks for a refresh when it is shown again.
+
+document.addEventListener("visibilitychange", function() {
+  var button = document.getElementById("page-visibility");
+  if (button) {
+    button.click();
+  }
+  if (!document.hidden) {
+    button = document.getElementById("live-records");
+    if (button) {
+      button.click();
+    }
+  }
+});
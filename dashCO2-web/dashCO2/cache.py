@@ -0,0 +1,95 @@
+"""
+    dashCO2.cache
+    ~~~~~~~~~~~~~
+
+    Cache en memoria, local al proceso, con tiempo de expiración.
+"""
+
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from . import metrics
+
+_MISSING = object()
+
+
+class ServerCache:
+    """Thread safe cache with a time to live and a maximum size
+    (the least recently used entries are dropped first)."""
+
+    def __init__(self, ttl: float, maxsize: int = 128, name=None):
+        self.ttl = ttl
+        self.name = name
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        # key -> [lock, waiting threads] of the values being built.
+        self._building = {}
+
+    def _lookup(self, key):
+        with self._lock:
+            expires, value = self._data.get(key, (0, _MISSING))
+            if value is _MISSING or expires < time.monotonic():
+                self._data.pop(key, None)
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if self.name is not None:
+            metrics.CACHE_REQUESTS.inc(
+                self.name, "miss" if value is _MISSING else "hit"
+            )
+        return default if value is _MISSING else value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_or_set(self, key, func):
+        """Get the value for key, calling func to build it if missing.
+        Only one thread builds a given key, the others wait for it."""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._lock:
+            building = self._building.setdefault(
+                key, [threading.Lock(), 0]
+            )
+            building[1] += 1
+        try:
+            with building[0]:
+                value = self._lookup(key)
+                if value is _MISSING:
+                    value = func()
+                    self.set(key, value)
+        finally:
+            with self._lock:
+                building[1] -= 1
+                if not building[1]:
+                    del self._building[key]
+        return value
+
+    def put(self, value) -> str:
+        """Store a JSON serializable value under a key derived
+        from its content, and return the key."""
+        content = json.dumps(value, sort_keys=True).encode("utf-8")
+        key = hashlib.blake2b(content, digest_size=16).hexdigest()
+        self.set(key, value)
+        return key
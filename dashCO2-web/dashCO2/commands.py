@@ -0,0 +1,70 @@
+"""
+    dashCO2.commands
+    ~~~~~~~~~~~~~~~~
+
+    Comandos para la línea de comandos de flask.
+    Ejemplo: FLASK_APP=app.py flask rebuild-aggregates
+
+    create-indexes crea los índices agregados después de crear la base.
+    generate-fleet agrega una flota sintética (ver fleet), para probar
+    con volúmenes como los de producción.
+"""
+
+import time
+
+import click
+import sqlalchemy
+
+
+def init_app(app):
+
+    from . import fleet, models, ringbuffer
+
+    @app.cli.command("create-indexes")
+    def create_indexes():
+        """Create the indexes missing in an existing database."""
+        engine = models.db.engine
+        inspector = sqlalchemy.inspect(engine)
+        for table in models.db.metadata.sorted_tables:
+            existing = {
+                index["name"]
+                for index in inspector.get_indexes(table.name)
+            }
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=engine)
+                    click.echo(f"{index.name} created.")
+
+    @app.cli.command("rebuild-aggregates")
+    def rebuild_aggregates():
+        """Rebuild the aggregates used by the history explorer."""
+        models.rebuild_aggregates()
+        click.echo(
+            f"{models.RecordAggregate.query.count()} aggregates built."
+        )
+
+    @app.cli.command("generate-fleet")
+    @click.option("--devices", default=100, help="Number of devices.")
+    @click.option("--days", default=7, help="Days of records.")
+    @click.option(
+        "--period", default=60, help="Seconds between records."
+    )
+    @click.option("--seed", default=0, help="Random seed.")
+    def generate_fleet(devices, days, period, seed):
+        """Add a synthetic fleet of devices with their records."""
+        started = time.perf_counter()
+        counts = fleet.generate(
+            models.db.engine,
+            devices,
+            days,
+            period_sec=period,
+            seed=seed,
+            echo=click.echo,
+        )
+        if ringbuffer.get() is not None:
+            ringbuffer.rebuild_from_db()
+        click.echo(
+            "{devices} devices, {records} records and {aggregates} "
+            "aggregates added".format(**counts)
+            + f" in {time.perf_counter() - started:.1f} s."
+        )
@@ -16,6 +16,31 @@ SQLALCHEMY_DATABASE_URI = "sqlite:////data/co2.db"
 
 # Carpeta donde están los firmware de los dispositivos.
 FIRMWARE_FOLDER = "/firmware"
+# Intervalo para buscar cambios en FIRMWARE_FOLDER (en segundos).
+FIRMWARE_POLL_SEC = 10
+# Guardar una versión comprimida (gzip) de cada firmware, que se envía
+# a los dispositivos que la piden con /updates/<version>?gzip=1
+# (ver firmware). Requiere permisos de escritura en FIRMWARE_FOLDER y
+# un firmware que la pida, por eso está desactivado.
+FIRMWARE_GZIP = False
+
+# Actualización escalonada del firmware (ver rollout).
+# Porcentaje acumulado de los dispositivos en cada etapa.
+ROLLOUT_WAVES = (5, 25, 50, 100)
+# Máximo de dispositivos descargando el firmware al mismo tiempo, entre
+# todas las actualizaciones abiertas.
+ROLLOUT_MAX_IN_FLIGHT = 10
+# Tiempo para que un dispositivo vuelva con la versión nueva
+# (en segundos), luego se lo considera fallido.
+ROLLOUT_TIMEOUT_SEC = 15 * 60
+# Duración máxima de cada etapa (en segundos). Pasado ese tiempo empieza
+# la siguiente aunque queden dispositivos sin conectarse.
+ROLLOUT_WAVE_SEC = 60 * 60
+# Fracción de dispositivos fallidos para pausar la actualización.
+ROLLOUT_MAX_FAILED_FRACTION = 0.2
+# Mínimo de dispositivos terminados (o todos, si son menos) antes de
+# aplicar ROLLOUT_MAX_FAILED_FRACTION.
+ROLLOUT_MIN_RESOLVED = 10
 
 
 # Rangos de alerta
@@ -28,6 +53,74 @@ class RANGES:
 # Tiempo para mostrar en los gráficos (en segundos).
 DISPLAY_LEN_SEC = 3 * 60 * 60
 
+# Intervalo para actualizar el dashboard (en segundos). Se acorta hasta
+# el menor período de adquisición de los dispositivos visibles,
+# pero no menos que REFRESH_MIN_INTERVAL_SEC.
+REFRESH_INTERVAL_SEC = 3 * 60
+REFRESH_MIN_INTERVAL_SEC = 15
+
+# Tiempo que se guarda la cantidad exacta de registros calculada a
+# pedido en las vistas de registros (en segundos).
+RECORD_COUNT_TTL_SEC = 10 * 60
+
+# Tiempo que se guarda el resumen del índice del admin (en segundos).
+# Se descarta antes si cambia el estado o la configuración de algún
+# dispositivo.
+SUMMARY_TTL_SEC = 30
+
+# Registros leídos por consulta al exportar (ver export).
+EXPORT_BATCH_SIZE = 10000
+
+# Intervalo para regenerar las páginas de /kiosk (en segundos).
+KIOSK_REFRESH_SEC = 60
+
+# Dibujar los gráficos del dashboard en el navegador. El servidor envía
+# sólo los valores y los umbrales, y no construye las figuras de plotly.
+CLIENTSIDE_SPARKLINES = False
+
+# Tiempo (en segundos) y cantidad máxima de entradas para los datos
+# del dashboard que se guardan en el servidor.
+SERVER_STORE_TTL_SEC = 15 * 60
+SERVER_STORE_MAXSIZE = 64
+
+# Archivo para el buffer circular con las mediciones recientes,
+# compartido por todos los workers de uwsgi. Usar un archivo en memoria
+# (ej: "/dev/shm/co2-recent.bin") o None para leer siempre de la base.
+RING_BUFFER_PATH = None
+
+# Cantidad máxima de dispositivos en el buffer circular.
+RING_BUFFER_MAX_DEVICES = 1024
+
+# Enviar las mediciones nuevas a los dashboards (Server-Sent Events)
+# en lugar de esperar al próximo intervalo de actualización.
+# Requiere que uwsgi use threads (ver app.ini).
+LIVE_UPDATES = False
+
+# Tiempo para agrupar eventos antes de enviarlos (en segundos).
+LIVE_COALESCE_SEC = 5
+
+# Duración máxima de cada conexión (en segundos), luego el navegador
+# se reconecta.
+LIVE_MAX_STREAM_SEC = 10 * 60
+
+# Algoritmos para comprimir las respuestas (dashboard, admin y api),
+# en orden de preferencia. None para no comprimir.
+COMPRESS_ALGORITHM = ["br", "gzip"]
+
+# Publicar métricas para Prometheus en /metrics. No pide autenticación,
+# así que si se activa conviene limitar el acceso (p. ej. en nginx).
+METRICS = False
+
+# Medir las consultas SQL de cada pedido y registrar las lentas
+# (ver profiling). Agrega trabajo a cada consulta, usar sólo para
+# diagnosticar.
+SQL_PROFILING = False
+# Consultas más lentas que este valor (en milisegundos) se registran
+# en el log con su plan.
+SLOW_QUERY_MS = 200
+# Cantidad de consultas en el reporte del admin.
+SQL_PROFILING_TOP = 25
+
 # Tiempo sin datos para considerar que el sensor esta offline (en segundos).
 CONSIDER_OFFLINE_SEC = 10 * 60
 
@@ -12,18 +12,20 @@ import operator
 import arrow
 from flask import (
     flash,
+    g,
     has_app_context,
     make_response,
     redirect,
     request,
 )
-from flask_admin import Admin, AdminIndexView, expose
+from flask_admin import Admin, AdminIndexView, BaseView, expose
 from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla import filters as sqla_filters
 from flask_admin.form import rules
 from flask_admin.helpers import get_redirect_target
 from markupsafe import Markup
-from sqlalchemy import and_, desc, func
+from sqlalchemy import desc, func, tuple_
 from wtforms import Form, HiddenField, IntegerField, StringField
 from wtforms.validators import AnyOf, InputRequired, NumberRange
 
@@ -52,8 +54,18 @@ def init_app(app, auth=None):
 
         auth = Auth()
 
-    from . import config, models, shared
-    from .models import Record
+    from . import (
+        cache,
+        config,
+        export,
+        firmware,
+        live,
+        models,
+        profiling,
+        ringbuffer,
+        rollout,
+        shared,
+    )
     from .shared import (
         COLORS,
         firmware_version_exists,
@@ -69,6 +81,11 @@ def init_app(app, auth=None):
                 return prefix + "log:out@" + text[sz:]
         return text
 
+    # Exact counts of the record views, by search and filters.
+    _record_counts = cache.ServerCache(
+        config.RECORD_COUNT_TTL_SEC, name="record_counts"
+    )
+
     class SecureModelView(ModelView):
         def is_accessible(self):
             return auth.get_current_user() in auth.users
@@ -111,15 +128,9 @@ def init_app(app, auth=None):
             return ""
 
     def _last_seen_formatter(view, context, model, name):
-        rec = (
-            Record.query.filter(
-                Record.serial_number == model.serial_number
-            )
-            .order_by(desc(Record.timestamp))
-            .first()
-        )
-        if rec:
-            return format_utc(rec.timestamp)
+        # Kept up to date by the api, avoids a query per row.
+        if model.last_seen:
+            return format_utc(model.last_seen)
         else:
             return "N/A"
 
@@ -128,10 +139,12 @@ def init_app(app, auth=None):
         day_link = base % "day"
         week_link = base % "week"
         month_link = base % "month"
+        history_link = f"/history/?serial_number={model.serial_number}"
         return Markup(
             f"<a href='{day_link}'>24 h</a> <br/> "
             f"<a href='{week_link}'>7 d</a> <br/> "
-            f"<a href='{month_link}'>30 d</a>"
+            f"<a href='{month_link}'>30 d</a> <br/> "
+            f"<a href='{history_link}'>historia</a>"
         )
 
     def _dict_formatter(column, conversion, default="N/A"):
@@ -147,6 +160,12 @@ def init_app(app, auth=None):
     class RecordView(SecureModelView):
         named_filter_urls = True
 
+        # Counting all records is slow. The list shows the exact count
+        # only if it was asked for (see count_view) and is still cached,
+        # otherwise an estimate from the aggregates.
+        simple_list_pager = True
+        list_template = "record_list.html"
+
         can_delete = False
         can_create = False
         can_edit = False
@@ -161,6 +180,216 @@ def init_app(app, auth=None):
             "ntp_epoch": _timestamp_formatter("ntp_epoch"),
         }
 
+        def _min_timestamp(self):
+            return None
+
+        def _count_key(self, search, filters):
+            return (
+                self.endpoint,
+                search,
+                tuple(tuple(flt) for flt in filters or ()),
+            )
+
+        def estimate_count(self, search, filters):
+            """Estimate the count from the aggregates,
+            None if not possible for this search or filters."""
+            if search:
+                return None
+
+            serial_numbers = None
+            for idx, _, value in filters or ():
+                flt = self._filters[idx]
+                if not (
+                    isinstance(flt, sqla_filters.FilterEqual)
+                    and flt.column.key == "serial_number"
+                ):
+                    return None
+                serial_numbers = [flt.clean(value)]
+
+            return (
+                models.estimate_record_count(
+                    serial_numbers, self._min_timestamp()
+                )
+                or None
+            )
+
+        def exact_count(self, search, filters):
+            joins, count_joins = {}, {}
+            query = self.get_query()
+            count_query = self.get_count_query()
+            if self._search_supported and search:
+                (
+                    query,
+                    count_query,
+                    joins,
+                    count_joins,
+                ) = self._apply_search(
+                    query, count_query, joins, count_joins, search
+                )
+            if filters and self._filters:
+                (
+                    query,
+                    count_query,
+                    joins,
+                    count_joins,
+                ) = self._apply_filters(
+                    query, count_query, joins, count_joins, filters
+                )
+            return count_query.scalar()
+
+        def get_list(
+            self,
+            page,
+            sort_column,
+            sort_desc,
+            search,
+            filters,
+            execute=True,
+            page_size=None,
+        ):
+            g.keyset = None
+            if sort_column is None and execute:
+                # Default order: newest first, paginated by
+                # (timestamp, id) instead of offset.
+                _, query = super().get_list(
+                    0, None, False, search, filters, False, 0
+                )
+                data = self._keyset_page(
+                    query, page_size or self.page_size
+                )
+            else:
+                _, data = super().get_list(
+                    page,
+                    sort_column,
+                    sort_desc,
+                    search,
+                    filters,
+                    execute,
+                    page_size,
+                )
+
+            count = _record_counts.get(self._count_key(search, filters))
+            g.exact_count = count is not None
+            if count is None:
+                count = self.estimate_count(search, filters)
+            return count, data
+
+        @staticmethod
+        def _cursor(name):
+            """(timestamp, id) from a request argument or None."""
+            try:
+                timestamp, id_ = request.args[name].split("_")
+                return int(timestamp), int(id_)
+            except (KeyError, ValueError):
+                return None
+
+        def _keyset_url(self, **cursor):
+            view_args = self._get_list_extra_args()
+            extra_args = {
+                k: v
+                for k, v in view_args.extra_args.items()
+                if k not in ("after", "before")
+            }
+            extra_args.update(
+                (k, "%d_%d" % v) for k, v in cursor.items()
+            )
+            return self._get_list_url(
+                view_args.clone(page=0, extra_args=extra_args)
+            )
+
+        def _keyset_page(self, query, page_size):
+            """Rows of the page after or before the cursor in the request
+            (sorted by timestamp and id, newest first).
+
+            The links to the first, previous and next pages are stored
+            in g.keyset (see record_list.html).
+            """
+            timestamp, id_ = self.model.timestamp, self.model.id
+            key = tuple_(timestamp, id_)
+            after, before = self._cursor("after"), self._cursor(
+                "before"
+            )
+
+            if before is not None:
+                rows = (
+                    query.filter(key > before)
+                    .order_by(timestamp, id_)
+                    .limit(page_size + 1)
+                    .all()
+                )
+                has_prev, has_next = len(rows) > page_size, True
+                rows = rows[:page_size][::-1]
+            else:
+                if after is not None:
+                    query = query.filter(key < after)
+                rows = (
+                    query.order_by(desc(timestamp), desc(id_))
+                    .limit(page_size + 1)
+                    .all()
+                )
+                has_prev = after is not None
+                has_next = len(rows) > page_size
+                rows = rows[:page_size]
+
+            g.keyset = dict(
+                first_url=self._keyset_url(),
+                prev_url=None,
+                next_url=None,
+            )
+            if rows and has_prev:
+                g.keyset["prev_url"] = self._keyset_url(
+                    before=(rows[0].timestamp, rows[0].id)
+                )
+            if rows and has_next:
+                g.keyset["next_url"] = self._keyset_url(
+                    after=(rows[-1].timestamp, rows[-1].id)
+                )
+            return rows
+
+        def render(self, template, **kwargs):
+            kwargs.setdefault(
+                "exact_count", g.get("exact_count", False)
+            )
+            kwargs.setdefault("keyset", g.get("keyset"))
+            kwargs.setdefault(
+                "stream_formats", export.available_formats()
+            )
+            return super().render(template, **kwargs)
+
+        @expose("/count/")
+        def count_view(self):
+            view_args = self._get_list_extra_args()
+            count = self.exact_count(
+                view_args.search, view_args.filters
+            )
+            _record_counts.set(
+                self._count_key(view_args.search, view_args.filters),
+                count,
+            )
+            return redirect(self._get_list_url(view_args))
+
+        @expose("/stream/<fmt>/")
+        def stream_view(self, fmt):
+            """All records of the list (with its filters and search)
+            that also match the export parameters, without loading
+            them in memory (see export)."""
+            try:
+                filters = export.parse_args(request.args)
+            except ValueError as ex:
+                flash(f"Parámetros inválidos: {ex}", "error")
+                return redirect(self.get_url(".index_view"))
+            view_args = self._get_list_extra_args()
+            _, query = super().get_list(
+                0,
+                None,
+                False,
+                view_args.search,
+                view_args.filters,
+                False,
+                0,
+            )
+            return export.stream(fmt, filters, query)
+
     class WithFilter:
         def get_query(self):
             return self.session.query(self.model).filter(
@@ -179,6 +408,16 @@ def init_app(app, auth=None):
         _delta_ts = 0
         _operator = None
 
+        def _min_timestamp(self):
+            if self._column != "timestamp" or self._operator not in (
+                operator.gt,
+                operator.ge,
+            ):
+                # Not a lower bound, counting from the beginning
+                # gives an upper bound.
+                return None
+            return arrow.utcnow().timestamp - self._delta_ts
+
         def _my_filter(self):
             now = arrow.utcnow().timestamp
 
@@ -251,7 +490,13 @@ def init_app(app, auth=None):
                 if action == "firmware_update":
                     change_form = ChangeFirmwareForm()
                     new_title = "Actualizar Firmware"
-                    msg = f"Última versión: {get_latest_firmware_version()}"
+                    available = ", ".join(
+                        f.name for f in firmware.get_catalog().files()
+                    )
+                    msg = (
+                        f"Última versión: {get_latest_firmware_version()} "
+                        f"(disponibles: {available})"
+                    )
                 elif action == "recalibrate":
                     change_form = RecalibrateForm()
                     new_title = "Recalibrar"
@@ -305,23 +550,19 @@ def init_app(app, auth=None):
                         )
                         return redirect(url)
 
-                    _update_mappings = [
-                        {
-                            "id": rowid,
-                            "firmware_version": firmware_version,
-                        }
-                        for rowid in ids
-                    ]
-                    self.session.bulk_update_mappings(
-                        models.Device, _update_mappings
-                    )
-                    self.session.commit()
+                    # Los dispositivos reciben la versión nueva de a
+                    # poco (ver rollout).
+                    new_rollout = rollout.create(ids, firmware_version)
+                    if new_rollout is None:
+                        flash(
+                            f"Los dispositivos ya tienen la versión "
+                            f"{firmware_version}.",
+                            category="info",
+                        )
+                        return redirect(url)
                     flash(
-                        "Set firmware_version for {} device{} to {}.".format(
-                            len(ids),
-                            "s" if len(ids) > 1 else "",
-                            firmware_version,
-                        ),
+                        f"Actualización #{new_rollout.id} a la versión "
+                        f"{firmware_version} creada.",
                         category="info",
                     )
                     return redirect(url)
@@ -369,6 +610,7 @@ def init_app(app, auth=None):
                             dev.last_calibration += 1
 
                     self.session.commit()
+                    models.invalidate_summary()
                     flash(
                         f"La recalibración se ha iniciado para {len(devices)} "
                         f"dispositivos{'s' if len(devices) > 1 else ''}. "
@@ -474,6 +716,15 @@ def init_app(app, auth=None):
                     self._template_args["modal_count"] = len(ids)
                     return self.index_view()
 
+        def after_model_change(self, form, model, is_created):
+            models.invalidate_summary()
+            live.publish_device(model)
+
+        def after_model_delete(self, model):
+            models.invalidate_summary()
+            if ringbuffer.get() is not None:
+                ringbuffer.get().remove(model.serial_number)
+
         column_default_sort = "serial_number"
 
         list_template = "custom_list.html"
@@ -581,45 +832,134 @@ def init_app(app, auth=None):
 
             return self._user_form_edit_rules
 
-    class LastCalibrationDayView(
-        HiddenView, RelativeTemporalFilter, DeviceView
-    ):
-        _column = "last_calibration"
-        _delta_ts = DAY
-        _operator = operator.gt
+    class LastCalibrationView(HiddenView, WithFilter, DeviceView):
+        _range = ""
 
-    class LastCalibrationWeekView(
-        HiddenView, RelativeTemporalFilter, DeviceView
-    ):
-        _column = "last_calibration"
-        _delta_ts = (7 * DAY, DAY)
-        _operator = "between"
-
-    class LastCalibrationMonthView(
-        HiddenView, RelativeTemporalFilter, DeviceView
-    ):
-        _column = "last_calibration"
-        _delta_ts = (30 * DAY, 7 * DAY)
-        _operator = "between"
-
-    class LastCalibrationYearView(
-        HiddenView, RelativeTemporalFilter, DeviceView
-    ):
-        _column = "last_calibration"
-        _delta_ts = (365 * DAY, 30 * DAY)
-        _operator = "between"
-
-    class LastCalibrationLongerView(HiddenView, WithFilter, DeviceView):
         def _my_filter(self):
-            abs_ts = arrow.utcnow().timestamp - 365 * DAY
-            return and_(
-                models.Device.last_calibration != config.NO_CAL,
-                models.Device.last_calibration < abs_ts,
+            return (
+                models.calibration_range(config.NO_CAL) == self._range
             )
 
-    class LastCalibrationNoView(HiddenView, WithFilter, DeviceView):
-        def _my_filter(self):
-            return models.Device.last_calibration == config.NO_CAL
+    class LastCalibrationDayView(LastCalibrationView):
+        _range = "day"
+
+    class LastCalibrationWeekView(LastCalibrationView):
+        _range = "week"
+
+    class LastCalibrationMonthView(LastCalibrationView):
+        _range = "month"
+
+    class LastCalibrationYearView(LastCalibrationView):
+        _range = "year"
+
+    class LastCalibrationLongerView(LastCalibrationView):
+        _range = "longer"
+
+    class LastCalibrationNoView(LastCalibrationView):
+        _range = "N/A"
+
+    def _rollout_progress_formatter(view, context, model, name):
+        counts = rollout.progress(model.id)
+        return ", ".join(
+            f"{label}: {counts[state]}"
+            for state, label in (
+                (rollout.DONE, "actualizados"),
+                (rollout.OFFERED, "descargando"),
+                (rollout.PENDING, "pendientes"),
+                (rollout.FAILED, "fallidos"),
+            )
+        )
+
+    def _rollout_wave_formatter(view, context, model, name):
+        return f"{model.wave + 1} de {len(config.ROLLOUT_WAVES)}"
+
+    class RolloutView(SecureModelView):
+        """Staged firmware updates, created from the devices view."""
+
+        def _set_status(self, ids, status, verb):
+            if self.get_current_user() != "admin":
+                flash(
+                    f"El usuario {self.get_current_user()} no "
+                    f"tiene permisos para {verb} actualizaciones.",
+                    category="error",
+                )
+                return
+            count = rollout.set_status(ids, status)
+            flash(f"{count} actualización(es) modificadas.", "info")
+
+        @action("pause", "Pausar")
+        def action_pause(self, ids):
+            self._set_status(ids, rollout.PAUSED, "pausar")
+
+        @action("resume", "Reanudar")
+        def action_resume(self, ids):
+            self._set_status(ids, rollout.RUNNING, "reanudar")
+
+        @action("cancel", "Cancelar")
+        def action_cancel(self, ids):
+            self._set_status(ids, rollout.CANCELLED, "cancelar")
+
+        column_default_sort = ("id", True)
+
+        can_delete = False
+        can_create = False
+        can_edit = False
+
+        column_filters = ["firmware_version", "status"]
+
+        column_list = [
+            "id",
+            "firmware_version",
+            "created",
+            "status",
+            "wave",
+            "max_in_flight",
+            "progress",
+        ]
+
+        column_labels = dict(
+            firmware_version="Versión",
+            created="Creada",
+            status="Estado",
+            wave="Etapa",
+            max_in_flight="Descargas simultáneas",
+            progress="Progreso",
+        )
+
+        column_formatters = {
+            "created": _timestamp_formatter("created"),
+            "status": _dict_formatter(
+                "status",
+                {
+                    rollout.RUNNING: "en curso",
+                    rollout.PAUSED: "pausada",
+                    rollout.DONE: "terminada",
+                    rollout.CANCELLED: "cancelada",
+                },
+            ),
+            "wave": _rollout_wave_formatter,
+            "progress": _rollout_progress_formatter,
+        }
+
+    class ProfilingView(BaseView):
+        """Most expensive SQL statements by endpoint (see profiling)."""
+
+        def is_accessible(self):
+            return auth.get_current_user() in auth.users
+
+        def inaccessible_callback(self, name, **kwargs):
+            return redirect("/admin")
+
+        @expose("/", methods=["GET", "POST"])
+        def index(self):
+            if request.method == "POST":
+                profiling.profile.clear()
+                return redirect(self.get_url(".index"))
+            return self.render(
+                "profiling.html",
+                stats=profiling.profile.top(config.SQL_PROFILING_TOP),
+                slow_query_ms=config.SLOW_QUERY_MS,
+            )
 
     class ChangeFirmwareForm(Form):
         ids = HiddenField()
@@ -714,9 +1054,7 @@ def init_app(app, auth=None):
             except Exception:
                 offline_secs = config.CONSIDER_OFFLINE_SEC
 
-            summary = models.summarize_devices(
-                offline_secs, config.NO_CAL
-            )
+            summary = models.get_summary(offline_secs, config.NO_CAL)
 
             rendered = self.render(
                 "my_index.html",
@@ -726,7 +1064,8 @@ def init_app(app, auth=None):
                 by_building=summary["by_building"],
                 COLORS=COLORS,
                 total=summary["total"],
-                last_firmware_version=get_latest_firmware_version(),
+                last_firmware_version=summary["last_firmware_version"],
+                firmware_files=firmware.get_catalog().files(),
                 current_user=current_user,
             )
             resp = make_response(rendered)
@@ -751,6 +1090,15 @@ def init_app(app, auth=None):
     admin.add_view(
         RecordView(models.Record, models.db.session, name="Registros")
     )
+    admin.add_view(
+        RolloutView(
+            models.Rollout, models.db.session, name="Actualizaciones"
+        )
+    )
+    if config.SQL_PROFILING:
+        admin.add_view(
+            ProfilingView(name="Perfil SQL", endpoint="profiling")
+        )
     admin.add_view(
         DayView(
             models.Record,
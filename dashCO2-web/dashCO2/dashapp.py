@@ -5,16 +5,40 @@
     Applicación en dash
 """
 
+import functools
+from math import nan
+
 import arrow
 import dash
 import dash_core_components as dcc
 import dash_daq as daq
 import dash_html_components as html
 import plotly.graph_objs as go
-from dash.dependencies import Input, Output
-
-from . import config, models
-from .shared import COLORS, color_from_value
+from dash.dependencies import (
+    ALL,
+    ClientsideFunction,
+    Input,
+    Output,
+    State,
+)
+from dash.exceptions import PreventUpdate
+
+from . import cache, config, models, wire
+from .shared import (
+    COLORS,
+    STATUS_COLORS,
+    classify,
+    color_from_value,
+)
+
+# Large data of the dash stores (devices, buildings and, unless drawn
+# in the browser, recent measurements) is kept in the server. The stores
+# only hold the key.
+_server_store = cache.ServerCache(
+    config.SERVER_STORE_TTL_SEC,
+    config.SERVER_STORE_MAXSIZE,
+    name="dash_store",
+)
 
 SPARKLINE_LAYOUT = {
     "uirevision": True,
@@ -135,12 +159,124 @@ def build_header():
     )
 
 
+def sparkline_config():
+    """Thresholds and layout used to draw the sparklines in the browser."""
+    return dict(
+        layout=SPARKLINE_LAYOUT,
+        display_len_sec=config.DISPLAY_LEN_SEC,
+        consider_offline_sec=config.CONSIDER_OFFLINE_SEC,
+        ranges=dict(
+            ok=config.RANGES.OK,
+            warning=config.RANGES.WARNING,
+            danger=config.RANGES.DANGER,
+        ),
+        colors=dict(
+            offline=COLORS.OFFLINE,
+            ok=COLORS.OK,
+            warning=COLORS.WARNING,
+            danger=COLORS.DANGER,
+        ),
+    )
+
+
+@functools.lru_cache()
+def _sparkline_skeleton(ok, warning, danger, display_len_sec):
+    """Validated sparkline layout, including the threshold lines.
+
+    Built once per configuration, build_box only patches the x range
+    (display_len_sec is part of the key so that a change in the
+    configuration invalidates the cache).
+    """
+    fig = go.Figure({"layout": SPARKLINE_LAYOUT})
+    fig.update_layout(yaxis_range=[0, 1200])
+
+    fig.add_hline(
+        ok,
+        line_dash="dot",
+        line_width=1,
+        line_color=COLORS.OK,
+    )
+    fig.add_hline(
+        warning,
+        line_dash="dot",
+        line_width=1,
+        line_color=COLORS.WARNING,
+    )
+    fig.add_hline(
+        danger,
+        line_dash="dot",
+        line_width=1,
+        line_color=COLORS.DANGER,
+    )
+
+    return fig.to_plotly_json()["layout"]
+
+
+def sparkline_figure(x, y, serial_number) -> dict:
+    """Sparkline figure (as a dict) for the given values."""
+    layout = _sparkline_skeleton(
+        config.RANGES.OK,
+        config.RANGES.WARNING,
+        config.RANGES.DANGER,
+        config.DISPLAY_LEN_SEC,
+    )
+
+    xmax = arrow.utcnow().float_timestamp
+    xmin = xmax - config.DISPLAY_LEN_SEC
+    layout = dict(
+        layout, xaxis=dict(layout["xaxis"], range=[xmin, xmax])
+    )
+
+    if not x:
+        return {"data": [], "layout": layout}
+
+    return {
+        "data": [
+            {
+                "type": "scatter",
+                "x": list(x),
+                "y": list(y),
+                "mode": "lines",
+                "name": f"sparkline-line-{serial_number}-id",
+                "line": {"color": "#888", "width": 3},
+            }
+        ],
+        "layout": layout,
+    }
+
+
+def _box_id(kind, serial_number):
+    return {"type": kind, "serial": serial_number}
+
+
+def box_content(serial_number, x, y, color=None):
+    """Figure, color and value shown in the box of a device.
+
+    The color is computed from the last value unless given
+    (see update_sparklines).
+    """
+    if x:
+        current_value = y[-1]
+        if color is None:
+            color = color_from_value(current_value, x[-1])
+    else:
+        current_value = "s/d"
+        color = COLORS.OFFLINE
+
+    return sparkline_figure(x, y, serial_number), color, current_value
+
+
 def build_box(
     device: dict,
     dev_recent_measurements: (list, list),
     buildings,
     view_options=(),
 ):
+    """Build the box for a device.
+
+    Ids are dicts, so that the figure, indicator color and value
+    can be updated by pattern matching callbacks.
+    """
 
     devid = device["id"]
     serial_number = device["serial_number"]
@@ -155,71 +291,26 @@ def build_box(
     # if 'view-reference' in view_options:
     #     ref_serial_no, reference_value = get_reference_value(serialno)
 
-    x, y = dev_recent_measurements
-    if x:
-        current_value = y[-1]
-        color = color_from_value(current_value, x[-1])
-
-        # if reference_value is None:
-        #     current_value_str = f"{current_value}"
-        # else:
-        #     current_value_str = f"{current_value - reference_value:+}"
-
-        fig = go.Figure(
-            {
-                "data": [
-                    {
-                        "x": list(x),
-                        "y": list(y),
-                        "mode": "lines",
-                        "name": f"sparkline-line-{serial_number}-id",
-                        "line": {"color": "#888", "width": 3},
-                    }
-                ],
-                "layout": SPARKLINE_LAYOUT,
-            }
-        )
-    else:
-        current_value = "s/d"
-        color = COLORS.OFFLINE
-        fig = go.Figure(
-            {
-                "layout": SPARKLINE_LAYOUT,
-            }
-        )
-
-    xmax = arrow.utcnow().float_timestamp
-    xmin = xmax - config.DISPLAY_LEN_SEC
-    fig.update_layout(xaxis_range=[xmin, xmax], yaxis_range=[0, 1200])
+    # if reference_value is None:
+    #     current_value_str = f"{current_value}"
+    # else:
+    #     current_value_str = f"{current_value - reference_value:+}"
 
-    fig.add_hline(
-        config.RANGES.OK,
-        line_dash="dot",
-        line_width=1,
-        line_color=COLORS.OK,
-    )
-    fig.add_hline(
-        config.RANGES.WARNING,
-        line_dash="dot",
-        line_width=1,
-        line_color=COLORS.WARNING,
-    )
-    fig.add_hline(
-        config.RANGES.DANGER,
-        line_dash="dot",
-        line_width=1,
-        line_color=COLORS.DANGER,
+    fig, color, current_value = box_content(
+        serial_number, *dev_recent_measurements
     )
 
     return html.Div(
         className="grid-item " + buildings[building],
+        # used by assets/lazy.js
+        **{"data-serial": serial_number},
         children=[
             html.Div(
-                id=f"header-{serial_number}-id",
+                id=_box_id("header", serial_number),
                 className="header",
                 children=[
                     daq.Indicator(
-                        id=f"indicator-{serial_number}-id",
+                        id=_box_id("indicator", serial_number),
                         value=True,
                         color=color,
                         size=12,
@@ -229,11 +320,11 @@ def build_box(
                 ],
             ),
             html.Div(
-                id=f"mainbody-{serial_number}-id",
+                id=_box_id("mainbody", serial_number),
                 className="mainbody",
                 children=[
                     dcc.Graph(
-                        id=f"sparkline-{serial_number}-id",
+                        id=_box_id("sparkline", serial_number),
                         className="sparkline-graph",
                         config={
                             "staticPlot": False,
@@ -243,13 +334,13 @@ def build_box(
                         figure=fig,
                     ),
                     html.Div(
-                        id=f"bigvalue-{serial_number}-id",
+                        id=_box_id("bigvalue", serial_number),
                         className="bigvalue",
                         children=f"{current_value}",
                         style={"color": color},
                     ),
                     html.Div(
-                        id=f"bigvalue-delta-{serial_number}-id",
+                        id=_box_id("bigvalue-delta", serial_number),
                         className="bigvalue-delta",
                         children=f"Δ {current_value - reference_value} "
                         f"({ref_serial_no})",
@@ -260,7 +351,7 @@ def build_box(
                 ],
             ),
             html.Div(
-                id=f"footer-{serial_number}-id",
+                id=_box_id("footer", serial_number),
                 className="footer",
                 children=dcc.Link(
                     href=f"/admin/device/details/?id={devid}",
@@ -274,7 +365,33 @@ def build_box(
     )
 
 
+def _get_devices(devices_key, buildings_key):
+    """Devices and buildings stored in the server under these keys,
+    loaded again if not found (e.g. expired or in another worker)."""
+    devices = _server_store.get(devices_key)
+    buildings = _server_store.get(buildings_key)
+    if devices is None or buildings is None:
+        devices, buildings, _ = models.load_devices()
+    return devices, buildings
+
+
+def _get_recent_measurements(serial_numbers):
+    return {
+        str(serial_number): wire.encode_series(
+            *models.get_recent_values(serial_number)
+        )
+        for serial_number in sorted(serial_numbers)
+    }
+
+
 def build_app(**kwargs):
+    """Build the dash app.
+
+    The devices and buildings stores hold a key to the data in the
+    server (see _get_devices). The recent measurements of each loaded
+    device are encoded with wire.encode_series and, unless drawn in the
+    browser, also kept in the server.
+    """
 
     dash_app = dash.Dash(
         __name__,
@@ -293,76 +410,257 @@ def build_app(**kwargs):
             Output("buildings", "data"),
             Output("filter-buildings", "options"),
         ],
-        [Input("interval-component-devices", "n_intervals")],
+        [
+            Input("interval-component-devices", "n_intervals"),
+            Input("live-devices", "n_clicks"),
+        ],
+        [
+            State("devices", "data"),
+            State("buildings", "data"),
+        ],
     )
-    def update_dbb(interval_value):
-        return models.load_devices()
+    def update_dbb(
+        interval_value, live_value, devices_key, buildings_key
+    ):
+        devices, buildings, building_options = models.load_devices()
+        new_devices_key = _server_store.put(devices)
+        new_buildings_key = _server_store.put(buildings)
+        if (new_devices_key, new_buildings_key) == (
+            devices_key,
+            buildings_key,
+        ):
+            # Nothing changed, avoid the chain of callbacks.
+            raise PreventUpdate
+        return new_devices_key, new_buildings_key, building_options
+
+    def _selected_serials(devices, selected, buildings):
+        return {
+            dev["serial_number"]
+            for dev in devices
+            if buildings.get(dev["building"]) in selected
+        }
 
     @dash_app.callback(
         [
             Output("recent-measurements", "data"),
             Output("last-update", "data"),
+            Output("data-version", "data"),
         ],
         [
             Input("devices", "data"),
             Input("interval-component-records", "n_intervals"),
+            Input("live-records", "n_clicks"),
+            Input("visible-devices", "data"),
+        ],
+        [
+            State("filter-buildings", "value"),
+            State("buildings", "data"),
+            State("data-version", "data"),
         ],
     )
-    def update_recent_measurements(devices, interval_value):
-        out = {}
-        for dev in devices:
-            serial_number = dev["serial_number"]
-            out[str(serial_number)] = models.get_values(
-                serial_number, -config.DISPLAY_LEN_SEC, 5000
-            )
-        return out, arrow.now(config.TIMEZONE).format(
-            "YYYY-MM-DD HH:mm:ss"
+    def update_recent_measurements(
+        devices_key,
+        interval_value,
+        live_value,
+        visible,
+        selected,
+        buildings_key,
+        previous_version,
+    ):
+        if devices_key is None:
+            raise PreventUpdate
+        devices, buildings = _get_devices(devices_key, buildings_key)
+        # Only the boxes of the selected buildings that are in the
+        # viewport (see assets/lazy.js) are loaded.
+        serial_numbers = _selected_serials(
+            devices, selected, buildings
+        ).intersection(visible)
+
+        # On a timer tick, nothing to do if no new data arrived.
+        # The time slot forces a refresh from time to time, as devices
+        # become offline without new data.
+        version = "%s-%d" % (
+            models.data_version(serial_numbers),
+            arrow.utcnow().timestamp
+            // (config.CONSIDER_OFFLINE_SEC // 2),
         )
+        triggered = {
+            t["prop_id"] for t in dash.callback_context.triggered
+        }
+        if (
+            triggered == {"interval-component-records.n_intervals"}
+            and version == previous_version
+        ):
+            raise PreventUpdate
+
+        out = _get_recent_measurements(serial_numbers)
+        if not config.CLIENTSIDE_SPARKLINES:
+            out = _server_store.put(out)
+        return (
+            out,
+            arrow.now(config.TIMEZONE).format("YYYY-MM-DD HH:mm:ss"),
+            version,
+        )
+
+    if not config.LIVE_UPDATES:
+
+        @dash_app.callback(
+            Output("interval-component-records", "interval"),
+            Input("devices", "data"),
+            Input("visible-devices", "data"),
+            State("buildings", "data"),
+        )
+        def update_refresh_interval(
+            devices_key, visible, buildings_key
+        ):
+            # Poll as fast as the fastest visible device reports.
+            devices, _ = _get_devices(devices_key, buildings_key)
+            visible = set(visible)
+            acq_periods = [
+                dev["acq_period"]
+                for dev in devices
+                if dev["serial_number"] in visible
+            ]
+            if not acq_periods:
+                return config.REFRESH_INTERVAL_SEC * 1000
+            return min(
+                max(
+                    min(acq_periods),
+                    config.REFRESH_MIN_INTERVAL_SEC * 1000,
+                ),
+                config.REFRESH_INTERVAL_SEC * 1000,
+            )
+
+    # Pause the timers while the page is hidden (see assets/visibility.js)
+    dash_app.clientside_callback(
+        """
+        function(n_clicks) {
+        return [document.hidden, document.hidden];
+        }
+        """,
+        Output("interval-component-records", "disabled"),
+        Output("interval-component-devices", "disabled"),
+        Input("page-visibility", "n_clicks"),
+    )
 
     @dash_app.callback(
         Output("summary-count", "data"),
-        Input("recent-measurements", "data"),
+        Input("last-update", "data"),
     )
-    def update_summary_count(recent_measurements):
-        cnt_ok = cnt_warning = cnt_danger = cnt_offline = 0
-        for k, (x, y) in recent_measurements.items():
-            if not x:
-                cnt_offline += 1
-                continue
-
-            col = color_from_value(y[-1], x[-1])
-            if col == COLORS.OK:
-                cnt_ok += 1
-            elif col == COLORS.WARNING:
-                cnt_warning += 1
-            elif col == COLORS.WARNING:
-                cnt_danger += 1
-            elif col == COLORS.OFFLINE:
-                cnt_offline += 1
-
-        return cnt_ok, cnt_warning, cnt_danger, cnt_offline
+    def update_summary_count(last_update):
+        # Not all boxes are loaded, count from the whole fleet.
+        by_status = models.get_devices_by_status()
+        return (
+            len(by_status[COLORS.OK]),
+            len(by_status[COLORS.WARNING]),
+            len(by_status[COLORS.DANGER]),
+            len(by_status[COLORS.OFFLINE]),
+        )
 
     @dash_app.callback(
         Output("grid-content", "children"),
         Input("devices", "data"),
-        Input("recent-measurements", "data"),
         Input("buildings", "data"),
         Input("view-options", "value"),
+        Input("filter-buildings", "value"),
     )
     def update_boxes(
-        devices, recent_measurements, buildings, view_options
+        devices_key, buildings_key, view_options, selected
     ):
-        out = []
-        for dev in devices:
-            out.append(
-                build_box(
-                    dev,
-                    recent_measurements[str(dev["serial_number"])],
-                    buildings,
-                    view_options,
+        if devices_key is None:
+            raise PreventUpdate
+        devices, buildings = _get_devices(devices_key, buildings_key)
+        # Boxes are created empty, and filled when their data is loaded.
+        return [
+            build_box(dev, ([], []), buildings, view_options)
+            for dev in devices
+            if buildings.get(dev["building"]) in selected
+        ]
+
+    dash_app.clientside_callback(
+        """
+        function(n_clicks, previous) {
+        var visible = window.co2Lazy.visible();
+        if (JSON.stringify(visible) === JSON.stringify(previous)) {
+            return window.dash_clientside.no_update;
+        }
+        return visible;
+        }
+        """,
+        Output("visible-devices", "data"),
+        Input("lazy-visible", "n_clicks"),
+        State("visible-devices", "data"),
+    )
+
+    if config.CLIENTSIDE_SPARKLINES:
+
+        dash_app.clientside_callback(
+            ClientsideFunction(
+                namespace="co2", function_name="renderSparklines"
+            ),
+            Output({"type": "sparkline", "serial": ALL}, "figure"),
+            Output({"type": "indicator", "serial": ALL}, "color"),
+            Output({"type": "bigvalue", "serial": ALL}, "children"),
+            Output({"type": "bigvalue", "serial": ALL}, "style"),
+            Input("recent-measurements", "data"),
+            Input({"type": "sparkline", "serial": ALL}, "id"),
+            Input("sparkline-config", "data"),
+        )
+
+    else:
+
+        @dash_app.callback(
+            Output({"type": "sparkline", "serial": ALL}, "figure"),
+            Output({"type": "indicator", "serial": ALL}, "color"),
+            Output({"type": "bigvalue", "serial": ALL}, "children"),
+            Output({"type": "bigvalue", "serial": ALL}, "style"),
+            Input("recent-measurements", "data"),
+            Input({"type": "sparkline", "serial": ALL}, "id"),
+            State("visible-devices", "data"),
+        )
+        def update_sparklines(recent_key, ids, visible):
+            recent_measurements = _server_store.get(recent_key)
+            if recent_measurements is None:
+                recent_measurements = _get_recent_measurements(
+                    {box_id["serial"] for box_id in ids}.intersection(
+                        visible
+                    )
                 )
+
+            series = {
+                sn: wire.decode_series(data)
+                for sn, data in recent_measurements.items()
+            }
+            # Status of all loaded devices at once.
+            codes = classify(
+                [y[-1] if y else nan for _, y in series.values()],
+                [x[-1] if x else nan for x, _ in series.values()],
             )
-        return out
+            status_colors = {
+                sn: STATUS_COLORS[code]
+                for sn, code in zip(series, codes)
+            }
+
+            figures, colors, values, styles = [], [], [], []
+            for box_id in ids:
+                serial_number = box_id["serial"]
+                if str(serial_number) not in series:
+                    # Not loaded (yet), keep it as it is.
+                    figures.append(dash.no_update)
+                    colors.append(dash.no_update)
+                    values.append(dash.no_update)
+                    styles.append(dash.no_update)
+                    continue
+                fig, color, current_value = box_content(
+                    serial_number,
+                    *series[str(serial_number)],
+                    status_colors[str(serial_number)],
+                )
+                figures.append(fig)
+                colors.append(color)
+                values.append(f"{current_value}")
+                styles.append({"color": color})
+            return figures, colors, values, styles
 
     @dash_app.callback(
         Output("grid-content", "className"),
@@ -454,13 +752,31 @@ def build_app(**kwargs):
         Input("grid-content", "children"),
     )
 
+    if config.LIVE_UPDATES:
+        # Subscribe to the events of the selected buildings,
+        # see assets/live.js
+        dash_app.clientside_callback(
+            """
+            function(selected, options) {
+            var names = options.filter(
+                o => selected.includes(o.value)
+            ).map(o => o.label);
+            window.co2Live.subscribe(names);
+            return names.length;
+            }
+            """,
+            Output("live-subscription", "data"),
+            Input("filter-buildings", "value"),
+            Input("filter-buildings", "options"),
+        )
+
     @dash_app.callback(
         Output("filter-buildings", "value"),
-        Input("buildings", "data"),
+        Input("filter-buildings", "options"),
         Input("app-container", "children"),
     )
-    def check_all_boxes(buildings, _aux):
-        return list(buildings.values())
+    def check_all_boxes(building_options, _aux):
+        return [option["value"] for option in building_options]
 
     dash_app.layout = html.Div(
         id="big-app-container",
@@ -505,15 +821,44 @@ def build_app(**kwargs):
                 ],
             ),
             dcc.Store(id="n-interval-stage", data=0),
-            dcc.Store(id="devices", data=[]),
-            dcc.Store(id="recent-measurements", data={}),
+            dcc.Store(id="devices", data=None),
+            dcc.Store(id="recent-measurements", data=None),
             dcc.Store(id="last-update", data="n/a"),
-            dcc.Store(id="buildings", data="{}"),
+            dcc.Store(id="buildings", data=None),
             dcc.Store(id="summary-count", data=(0, 0, 0, 0)),
             dcc.Store(id="trash", data=0),
+            dcc.Store(id="sparkline-config", data=sparkline_config()),
+            dcc.Store(id="live-subscription", data=0),
+            dcc.Store(id="visible-devices", data=[]),
+            dcc.Store(id="data-version", data=None),
+            # Clicked from assets/visibility.js when the page is
+            # hidden or shown.
+            html.Button(
+                id="page-visibility",
+                n_clicks=0,
+                style={"display": "none"},
+            ),
+            # Clicked from assets/lazy.js when boxes enter the viewport.
+            html.Button(
+                id="lazy-visible", n_clicks=0, style={"display": "none"}
+            ),
+            # Clicked from assets/live.js when events arrive.
+            html.Button(
+                id="live-records", n_clicks=0, style={"display": "none"}
+            ),
+            html.Button(
+                id="live-devices", n_clicks=0, style={"display": "none"}
+            ),
             dcc.Interval(
                 id="interval-component-records",
-                interval=3 * 60 * 1000,  # in milliseconds
+                # in milliseconds, only a fallback with live updates.
+                # Otherwise, adjusted by update_refresh_interval.
+                interval=(
+                    30 * 60
+                    if config.LIVE_UPDATES
+                    else config.REFRESH_INTERVAL_SEC
+                )
+                * 1000,
                 n_intervals=50,  # start at batch 50
                 # disabled=False,
             ),
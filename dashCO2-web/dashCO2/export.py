@@ -0,0 +1,218 @@
+"""
+    dashCO2.export
+    ~~~~~~~~~~~~~~
+
+    Exportación de registros sin cargarlos todos en memoria. Los
+    registros se leen en tandas de EXPORT_BATCH_SIZE (paginando por
+    timestamp e id) y se envían a medida que se leen.
+
+    Formatos: csv, csv.gz y, si está instalado pyarrow, parquet
+    y arrow (IPC stream).
+
+    Parámetros (ver parse_args):
+        serial_number   uno o más números de serie.
+        building        edificio.
+        start, end      rango de tiempo, como timestamp o fecha
+                        (ej. 2021-07-01 o 2021-07-01T12:00).
+"""
+
+import csv
+import io
+import zlib
+
+import arrow
+import flask
+from sqlalchemy import tuple_
+
+from . import config, models
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COLUMNS = (
+    "id",
+    "serial_number",
+    "timestamp",
+    "co2",
+    "temperature",
+    "uptime",
+    "ntp_epoch",
+    "boot_id",
+)
+
+MIMETYPES = {
+    "csv": "text/csv",
+    "csv.gz": "application/gzip",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def _timestamp(value: str) -> int:
+    if value.isdigit():
+        return int(value)
+    return arrow.get(value, tzinfo=config.TIMEZONE).timestamp
+
+
+def parse_args(args) -> dict:
+    """Filters from the request arguments (ValueError if invalid)."""
+    try:
+        return dict(
+            serial_numbers=[
+                int(v) for v in args.getlist("serial_number")
+            ]
+            or None,
+            building=args.get("building") or None,
+            start=_timestamp(args["start"])
+            if args.get("start")
+            else None,
+            end=_timestamp(args["end"]) if args.get("end") else None,
+        )
+    except arrow.parser.ParserError as ex:
+        raise ValueError(str(ex))
+
+
+def iter_batches(
+    serial_numbers=None,
+    building=None,
+    start=None,
+    end=None,
+    batch_size=None,
+    query=None,
+):
+    """Yield lists of records (as tuples of COLUMNS) sorted by
+    timestamp and id. Each batch is a new query that starts after
+    the last record of the previous one.
+
+    query is a Record query with more filters (for example the one
+    of an admin list view); its order is ignored."""
+    Record = models.Record
+    batch_size = batch_size or config.EXPORT_BATCH_SIZE
+
+    if query is None:
+        query = Record.query
+    query = query.order_by(None).with_entities(
+        *(getattr(Record, column) for column in COLUMNS)
+    )
+    if serial_numbers is not None:
+        query = query.filter(Record.serial_number.in_(serial_numbers))
+    if building is not None:
+        query = query.filter(
+            Record.serial_number.in_(
+                models.Device.query.with_entities(
+                    models.Device.serial_number
+                ).filter(models.Device.building == building)
+            )
+        )
+    if start is not None:
+        query = query.filter(Record.timestamp >= start)
+    if end is not None:
+        query = query.filter(Record.timestamp < end)
+    query = query.order_by(Record.timestamp, Record.id)
+
+    key = tuple_(Record.timestamp, Record.id)
+    last = None
+    while True:
+        page = query if last is None else query.filter(key > last)
+        rows = page.limit(batch_size).all()
+        if not rows:
+            return
+        yield rows
+        last = (rows[-1].timestamp, rows[-1].id)
+
+
+def _csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _Sink(io.RawIOBase):
+    """Writable file that keeps the data until drained."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def _arrow_chunks(batches, fmt):
+    schema = pyarrow.schema(
+        [(column, pyarrow.int64()) for column in COLUMNS]
+    )
+    sink = _Sink()
+    if fmt == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+
+    for rows in batches:
+        table = pyarrow.Table.from_pydict(
+            dict(zip(COLUMNS, zip(*rows))), schema=schema
+        )
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def available_formats() -> tuple[str]:
+    if pyarrow is None:
+        return ("csv", "csv.gz")
+    return tuple(MIMETYPES)
+
+
+def stream(fmt: str, filters: dict, query=None) -> flask.Response:
+    """Streaming response with the records matching the filters
+    (and query, see iter_batches)."""
+    if fmt not in available_formats():
+        flask.abort(404)
+
+    batches = iter_batches(query=query, **filters)
+    if fmt in ("parquet", "arrow"):
+        chunks = _arrow_chunks(batches, fmt)
+    else:
+        chunks = _csv_chunks(batches)
+        if fmt == "csv.gz":
+            chunks = _gzip_chunks(chunks)
+
+    filename = "registros-%s.%s" % (
+        arrow.now(config.TIMEZONE).format("YYYYMMDD-HHmmss"),
+        fmt,
+    )
+    return flask.Response(
+        flask.stream_with_context(chunks),
+        mimetype=MIMETYPES[fmt],
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+        },
+    )
@@ -0,0 +1,229 @@
+"""
+    dashCO2.firmware
+    ~~~~~~~~~~~~~~~~
+
+    Catálogo en memoria de los archivos de firmware en FIRMWARE_FOLDER
+    (<version>.ino.bin, y first.ino.bin para el registro) con su
+    tamaño, fecha de modificación, MD5 y SHA256.
+
+    Si FIRMWARE_GZIP es True (no lo es por defecto), junto a cada
+    archivo se guarda una versión comprimida (<version>.ino.bin.gz) que
+    el actualizador del ESP8266 puede grabar directamente, y el MD5 del
+    original a partir del cual se generó (<version>.ino.bin.gz.md5).
+    La versión comprimida se vuelve a generar si el original cambió,
+    sin importar las fechas. Si el directorio no tiene permisos de
+    escritura o el archivo no se achica, se usa sólo el original. Los
+    archivos se escriben con un nombre temporal único y se renombran,
+    así varios workers pueden generarlos a la vez. Ni estos archivos ni
+    los temporales terminan en .ino.bin, por lo que no aparecen en el
+    catálogo.
+
+    Sólo se envía a los dispositivos que la piden (/updates/<version>
+    ?gzip=1): el bootloader tiene que poder descomprimirla, lo que
+    requiere compilar el firmware con el core ESP8266 de Arduino 2.7.0
+    o posterior. El firmware de co2-sensino todavía no la pide.
+
+    El directorio se revisa a lo sumo una vez cada FIRMWARE_POLL_SEC,
+    y sólo se vuelven a calcular los hashes de los archivos que
+    cambiaron (según tamaño y fecha de modificación).
+"""
+
+from __future__ import annotations
+
+import dataclasses
+import gzip
+import hashlib
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from typing import Union
+
+from . import config
+
+SUFFIX = ".ino.bin"
+
+
+@dataclasses.dataclass(frozen=True)
+class FirmwareFile:
+    name: str
+    path: pathlib.Path
+    size: int
+    mtime: float
+    md5: str
+    sha256: str
+    # Versión comprimida, None si no hay.
+    gz_size: Union[int, None] = None
+    gz_md5: Union[str, None] = None
+
+    @property
+    def version(self) -> Union[int, None]:
+        """Version number, None for first.ino.bin."""
+        return int(self.name) if self.name.isdigit() else None
+
+    @property
+    def gz_path(self) -> pathlib.Path:
+        return _gz_path(self.path)
+
+    @property
+    def savings(self) -> Union[float, None]:
+        """Fraction of the size saved by the compressed version."""
+        if self.gz_size is None:
+            return None
+        return 1 - self.gz_size / self.size
+
+    @classmethod
+    def from_path(
+        cls,
+        path: pathlib.Path,
+        stat: os.stat_result,
+        gzip_variant=False,
+    ):
+        # Los binarios pesan a lo sumo unos pocos MB.
+        data = path.read_bytes()
+        md5 = hashlib.md5(data).hexdigest()
+        gz_data = (
+            _gzip_variant(path, data, md5) if gzip_variant else None
+        )
+        return cls(
+            name=path.name[: -len(SUFFIX)],
+            path=path,
+            size=stat.st_size,
+            mtime=stat.st_mtime,
+            md5=md5,
+            sha256=hashlib.sha256(data).hexdigest(),
+            gz_size=None if gz_data is None else len(gz_data),
+            gz_md5=None
+            if gz_data is None
+            else hashlib.md5(gz_data).hexdigest(),
+        )
+
+
+def _gz_path(path: pathlib.Path) -> pathlib.Path:
+    return path.with_name(path.name + ".gz")
+
+
+def _write(path: pathlib.Path, data: bytes):
+    """Write atomically, with a temporary file of its own (other
+    workers may be writing the same path)."""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=path.name + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _gzip_variant(path: pathlib.Path, data: bytes, md5: str):
+    """Content of the compressed version of a firmware file, creating it
+    if missing or made from other content (md5 is the one of data).
+    None if not available."""
+    gz_path = _gz_path(path)
+    source_path = gz_path.with_name(gz_path.name + ".md5")
+    try:
+        if source_path.read_text().strip() == md5:
+            return gz_path.read_bytes()
+    except FileNotFoundError:
+        pass
+
+    # mtime=0 para que el resultado (y su MD5) no dependa del momento.
+    gz_data = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz_data) >= len(data):
+        return None
+    try:
+        # Primero se borra el MD5, así un corte a la mitad no deja un
+        # .gz de otro original que parezca válido.
+        source_path.unlink(missing_ok=True)
+        _write(gz_path, gz_data)
+        _write(source_path, md5.encode("ascii"))
+    except OSError:
+        return None
+    return gz_data
+
+
+class Catalog:
+    """Firmware files of a folder, refreshed by polling."""
+
+    def __init__(self, folder, poll_sec: float, gzip_variants=False):
+        self.folder = pathlib.Path(folder)
+        self.poll_sec = poll_sec
+        self.gzip_variants = gzip_variants
+        self._lock = threading.Lock()
+        self._files = {}
+        self._next_poll = 0
+
+    def _scan(self):
+        files = {}
+        try:
+            entries = list(os.scandir(self.folder))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if not entry.name.endswith(SUFFIX) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            name = entry.name[: -len(SUFFIX)]
+            current = self._files.get(name)
+            if (
+                current is not None
+                and current.size == stat.st_size
+                and current.mtime == stat.st_mtime
+            ):
+                files[name] = current
+            else:
+                files[name] = FirmwareFile.from_path(
+                    pathlib.Path(entry.path), stat, self.gzip_variants
+                )
+        self._files = files
+
+    def refresh(self, force=False):
+        """Scan the folder if the poll interval has elapsed."""
+        with self._lock:
+            now = time.monotonic()
+            if force or now >= self._next_poll:
+                self._scan()
+                self._next_poll = now + self.poll_sec
+
+    def get(self, name) -> Union[FirmwareFile, None]:
+        """Firmware file by name ("first" or the version)."""
+        self.refresh()
+        return self._files.get(str(name))
+
+    def files(self) -> list[FirmwareFile]:
+        """All firmware files, sorted by name."""
+        self.refresh()
+        return sorted(self._files.values(), key=lambda f: f.name)
+
+    def latest_version(self) -> Union[int, None]:
+        versions = [
+            f.version
+            for f in self.files()
+            if f.version is not None and f.name.startswith("20")
+        ]
+        return max(versions, default=None)
+
+
+_catalog: Union[Catalog, None] = None
+
+
+def get_catalog() -> Catalog:
+    """The catalog of config.FIRMWARE_FOLDER."""
+    global _catalog
+    if _catalog is None or (
+        _catalog.folder,
+        _catalog.gzip_variants,
+    ) != (
+        pathlib.Path(config.FIRMWARE_FOLDER),
+        config.FIRMWARE_GZIP,
+    ):
+        _catalog = Catalog(
+            config.FIRMWARE_FOLDER,
+            config.FIRMWARE_POLL_SEC,
+            config.FIRMWARE_GZIP,
+        )
+    return _catalog
@@ -0,0 +1,426 @@
+"""
+    dashCO2.fleet
+    ~~~~~~~~~~~~~
+
+    Generador de una flota sintética, para reproducir localmente los
+    volúmenes de producción (ver el comando generate-fleet y los
+    benchmarks).
+
+    - Dispositivos repartidos en edificios, pisos y aulas.
+    - CO2 con la forma de la ocupación: las aulas se llenan en los
+      bloques de clase (lunes a viernes, y menos los sábados) y el CO2
+      se acerca exponencialmente al valor de equilibrio de cada aula.
+    - Reinicios (boot_id nuevo y uptime desde cero).
+    - Cortes sin datos y dispositivos que dejaron de enviar datos.
+    - Fecha de la última calibración (o sin calibrar).
+
+    Los registros se generan de a un día, ordenados por timestamp como
+    llegan en producción, y se insertan en tandas. Los agregados
+    (RecordAggregate) se calculan al mismo tiempo.
+"""
+
+import dataclasses
+import math
+import time
+from typing import Union
+
+import arrow
+import numpy as np
+import sqlalchemy
+
+from . import config
+from .models import (
+    AGGREGATE_RESOLUTIONS,
+    Device,
+    Record,
+    RecordAggregate,
+)
+from .shared import DAY
+
+OUTDOOR_CO2 = 420
+
+# Bloques de clase (hora local).
+BLOCKS = ((8, 10), (10.5, 12.5), (14, 16), (16.5, 18.5), (19, 22))
+
+# Probabilidad de uso de un bloque según el día (lunes = 0).
+WEEKDAY_USE = (1, 1, 1, 1, 1, 0.3, 0)
+
+FLOORS = ("PB", "1", "2", "3")
+
+ROOMS_PER_FLOOR = 10
+
+# Eventos por dispositivo y por día.
+REBOOTS_PER_DAY = 0.2
+GAPS_PER_DAY = 0.15
+
+# Fracción de dispositivos que dejan de enviar datos el último día.
+STOPPED_FRACTION = 0.03
+
+# Fracción de dispositivos nunca calibrados.
+NO_CAL_FRACTION = 0.1
+
+# Uptime máximo (se reinicia antes de pasar los 2**31 ms de una columna
+# INTEGER).
+MAX_UPTIME_SEC = 20 * DAY
+
+_BATCH = 50_000
+
+
+@dataclasses.dataclass
+class _Sensor:
+    serial_number: int
+    # CO2 sobre el exterior con el aula llena, y constante de tiempo
+    # del aula (en segundos).
+    peak: float
+    tau: float
+    # Probabilidad de que un bloque de clase se use.
+    use: float
+    # Desfasaje de las mediciones respecto de los otros dispositivos.
+    offset: int
+    co2: float
+    boot_times: list[int]
+    boot_ids: list[int]
+    stop: Union[int, None] = None
+    last: Union[tuple[int, int], None] = None
+
+
+def _new_boot_id(rng) -> int:
+    return int(rng.integers(1, 2**31))
+
+
+def _device_rows(rng, first_serial, devices, period_sec, end):
+    per_building = len(FLOORS) * ROOMS_PER_FLOOR
+    versions = _firmware_versions()
+    for ndx in range(devices):
+        floor_ndx = ndx // ROOMS_PER_FLOOR % len(FLOORS)
+        room = ndx % ROOMS_PER_FLOOR + 1
+        if rng.random() < NO_CAL_FRACTION:
+            last_calibration = config.NO_CAL
+        else:
+            age = min(rng.exponential(90 * DAY), 3 * 365 * DAY)
+            last_calibration = int(end - age)
+        yield dict(
+            serial_number=first_serial + ndx,
+            acq_period=period_sec * 1000,
+            screen_mode=int(rng.choice(3, p=(0.8, 0.15, 0.05))),
+            last_calibration=last_calibration,
+            firmware_version=int(
+                versions[-1]
+                if rng.random() < 0.8
+                else rng.choice(versions)
+            ),
+            hardware_info="{}",
+            # Un dispositivo de referencia por edificio.
+            reference_device=int(ndx % per_building == 0),
+            building=f"Pabellón {ndx // per_building + 1}",
+            floor=FLOORS[floor_ndx],
+            room=f"Aula {floor_ndx}{room:02d}",
+        )
+
+
+def _firmware_versions() -> list[int]:
+    """Versions in the firmware catalog (or a default one)."""
+    from .firmware import get_catalog
+
+    versions = sorted(
+        f.version
+        for f in get_catalog().files()
+        if f.version is not None and f.name.startswith("20")
+    )
+    return versions or [2021071801]
+
+
+def _target(rng, sensor, ts, utcoffset):
+    """Equilibrium CO2 of the room at each timestamp."""
+    local = ts + utcoffset
+    days = local // DAY
+    hours = (local % DAY) / 3600
+    unique_days, day_ndx = np.unique(days, return_inverse=True)
+    # 1970-01-01 fue jueves.
+    weekday = (unique_days + 3) % 7
+    use = np.asarray(WEEKDAY_USE)[weekday][:, None] * sensor.use
+    occupied = rng.random((len(unique_days), len(BLOCKS))) < use
+    attendance = rng.uniform(0.4, 1, (len(unique_days), len(BLOCKS)))
+
+    level = np.zeros(len(ts))
+    for block, (start, stop) in enumerate(BLOCKS):
+        in_block = (hours >= start) & (hours < stop)
+        level[in_block] = (occupied * attendance)[
+            day_ndx[in_block], block
+        ]
+    return OUTDOOR_CO2 + level * sensor.peak
+
+
+def _co2(sensor, ts, target):
+    """First order response of the room to the target, by segments of
+    constant target."""
+    out = np.empty(len(ts))
+    bounds = np.concatenate(
+        ([0], np.flatnonzero(np.diff(target)) + 1, [len(ts)])
+    )
+    co2 = sensor.co2
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        seg = ts[start:stop]
+        value = target[start]
+        out[start:stop] = value + (co2 - value) * np.exp(
+            -(seg - seg[0]) / sensor.tau
+        )
+        co2 = out[stop - 1]
+    sensor.co2 = co2
+    return out
+
+
+def _series(rng, sensor, chunk_start, chunk_end, period_sec, utcoffset):
+    """Records of a sensor in [chunk_start, chunk_end)."""
+    first = chunk_start + (sensor.offset - chunk_start) % period_sec
+    ts = np.arange(first, chunk_end, period_sec, dtype=np.int64)
+    if not len(ts):
+        return None
+
+    co2 = _co2(sensor, ts, _target(rng, sensor, ts, utcoffset))
+    co2 = np.clip(np.rint(co2 + rng.normal(0, 8, len(ts))), 380, 4990)
+    temperature = np.rint(21 + (co2 - OUTDOOR_CO2) / 400)
+
+    keep = np.ones(len(ts), dtype=bool)
+    span = chunk_end - chunk_start
+    for _ in range(rng.poisson(REBOOTS_PER_DAY * span / DAY)):
+        at = int(rng.integers(chunk_start, chunk_end))
+        # El dispositivo tarda un poco en volver a medir.
+        keep &= (ts < at) | (ts >= at + 90)
+        sensor.boot_times.append(at + 90)
+        sensor.boot_ids.append(_new_boot_id(rng))
+    if chunk_end - max(sensor.boot_times) > MAX_UPTIME_SEC:
+        sensor.boot_times.append(
+            max(sensor.boot_times) + MAX_UPTIME_SEC
+        )
+        sensor.boot_ids.append(_new_boot_id(rng))
+    for _ in range(rng.poisson(GAPS_PER_DAY * span / DAY)):
+        at = int(rng.integers(chunk_start, chunk_end))
+        length = np.clip(rng.lognormal(math.log(3600), 1), 600, DAY / 2)
+        keep &= (ts < at) | (ts >= at + length)
+    if sensor.stop is not None:
+        keep &= ts < sensor.stop
+    if not keep.any():
+        return None
+
+    order = np.argsort(sensor.boot_times)
+    boot_times = np.asarray(sensor.boot_times)[order]
+    boot_ids = np.asarray(sensor.boot_ids)[order]
+    ts, co2, temperature = ts[keep], co2[keep], temperature[keep]
+    boot = np.searchsorted(boot_times, ts, side="right") - 1
+    uptime = (ts - boot_times[boot]) * 1000
+
+    sensor.last = (int(ts[-1]), int(co2[-1]))
+    return (
+        ts,
+        co2.astype(np.int64),
+        temperature.astype(np.int64),
+        uptime,
+        boot_ids[boot],
+    )
+
+
+def _aggregate_rows(serial_number, ts, co2):
+    for resolution in AGGREGATE_RESOLUTIONS:
+        buckets = ts - ts % resolution
+        starts = np.flatnonzero(np.diff(buckets, prepend=-1))
+        rows = zip(
+            buckets[starts].tolist(),
+            np.diff(starts, append=len(ts)).tolist(),
+            np.add.reduceat(co2, starts).tolist(),
+            np.minimum.reduceat(co2, starts).tolist(),
+            np.maximum.reduceat(co2, starts).tolist(),
+        )
+        for row in rows:
+            yield (resolution, serial_number) + row
+
+
+_RECORD_COLUMNS = (
+    "serial_number",
+    "timestamp",
+    "co2",
+    "temperature",
+    "uptime",
+    "ntp_epoch",
+    "boot_id",
+)
+_AGGREGATE_COLUMNS = (
+    "resolution",
+    "serial_number",
+    "bucket",
+    "count",
+    "co2_sum",
+    "co2_min",
+    "co2_max",
+)
+
+
+def _insert(conn, table, columns, rows):
+    """Insert rows (tuples in the order of columns) with the DBAPI
+    cursor, compiling the statement once instead of processing the
+    parameters of each row."""
+    compiled = table.insert().compile(
+        dialect=conn.dialect, column_keys=columns
+    )
+    if not compiled.positional:
+        rows = [dict(zip(columns, row)) for row in rows]
+    elif compiled.positiontup != list(columns):
+        order = [columns.index(key) for key in compiled.positiontup]
+        rows = [tuple(row[i] for i in order) for row in rows]
+    cursor = conn.connection.cursor()
+    try:
+        for start in range(0, len(rows), _BATCH):
+            cursor.executemany(
+                str(compiled), rows[start : start + _BATCH]
+            )
+    finally:
+        cursor.close()
+
+
+def generate(
+    engine,
+    devices: int,
+    days: int,
+    period_sec: int = 60,
+    seed: int = 0,
+    end: Union[int, None] = None,
+    echo=None,
+) -> dict[str, int]:
+    """Add a synthetic fleet of devices with days of records until end
+    (now by default) to the database. Serial numbers start after the
+    largest one in the database (of devices, records or aggregates, a
+    deleted device may have left the others), so the records and
+    aggregate buckets added never overlap existing ones, whatever end
+    is. Returns the number of rows added."""
+    rng = np.random.default_rng(seed)
+    end = end or arrow.utcnow().timestamp
+    start = end - days * DAY
+    utcoffset = int(
+        arrow.get(end).to(config.TIMEZONE).utcoffset().total_seconds()
+    )
+    started = time.perf_counter()
+
+    with engine.connect() as conn:
+        first_serial = (
+            max(
+                conn.execute(
+                    sqlalchemy.select(
+                        [sqlalchemy.func.max(model.serial_number)]
+                    )
+                ).scalar()
+                or 0
+                for model in (Device, Record, RecordAggregate)
+            )
+            + 1
+        )
+
+    device_rows = list(
+        _device_rows(rng, first_serial, devices, period_sec, end)
+    )
+    sensors = [
+        _Sensor(
+            serial_number=row["serial_number"],
+            peak=rng.uniform(300, 1600),
+            tau=rng.uniform(15, 60) * 60,
+            use=rng.uniform(0.3, 0.95),
+            offset=int(rng.integers(period_sec)),
+            co2=OUTDOOR_CO2,
+            boot_times=[int(start - rng.integers(0, 3 * DAY))],
+            boot_ids=[_new_boot_id(rng)],
+            stop=(
+                int(rng.integers(end - DAY, end))
+                if rng.random() < STOPPED_FRACTION
+                else None
+            ),
+        )
+        for row in device_rows
+    ]
+
+    counts = dict(devices=len(device_rows), records=0, aggregates=0)
+    with engine.begin() as conn:
+        conn.execute(Device.__table__.insert(), device_rows)
+
+    # De a un día (UTC), así los agregados de cada tanda no se
+    # superponen con los de las otras.
+    bounds = list(range(start - start % DAY + DAY, end, DAY))
+    for chunk_start, chunk_end in zip([start] + bounds, bounds + [end]):
+        columns, aggregates = [], []
+        for sensor in sensors:
+            series = _series(
+                rng,
+                sensor,
+                chunk_start,
+                chunk_end,
+                period_sec,
+                utcoffset,
+            )
+            if series is None:
+                continue
+            ts, co2 = series[:2]
+            columns.append(
+                (np.full(len(ts), sensor.serial_number),) + series
+            )
+            aggregates.extend(
+                _aggregate_rows(sensor.serial_number, ts, co2)
+            )
+        if not columns:
+            continue
+
+        serial, ts, co2, temperature, uptime, boot_id = (
+            np.concatenate(column) for column in zip(*columns)
+        )
+        order = np.argsort(ts, kind="stable")
+        # ntp_epoch es el mismo timestamp.
+        records = list(
+            zip(
+                *(
+                    column[order].tolist()
+                    for column in (
+                        serial,
+                        ts,
+                        co2,
+                        temperature,
+                        uptime,
+                        ts,
+                    )
+                ),
+                boot_id[order].tolist(),
+            )
+        )
+        with engine.begin() as conn:
+            _insert(conn, Record.__table__, _RECORD_COLUMNS, records)
+            _insert(
+                conn,
+                RecordAggregate.__table__,
+                _AGGREGATE_COLUMNS,
+                aggregates,
+            )
+        counts["records"] += len(records)
+        counts["aggregates"] += len(aggregates)
+        if echo is not None:
+            echo(
+                "%s: %d records (%.1f s)"
+                % (
+                    arrow.get(chunk_start).format("YYYY-MM-DD"),
+                    len(records),
+                    time.perf_counter() - started,
+                )
+            )
+
+    device = Device.__table__
+    with engine.begin() as conn:
+        conn.execute(
+            device.update()
+            .where(device.c.serial_number == sqlalchemy.bindparam("sn"))
+            .values(
+                last_seen=sqlalchemy.bindparam("seen"),
+                last_co2=sqlalchemy.bindparam("co2"),
+            ),
+            [
+                dict(sn=sensor.serial_number, seen=seen, co2=co2)
+                for sensor in sensors
+                if sensor.last is not None
+                for seen, co2 in [sensor.last]
+            ],
+        )
+    return counts
@@ -0,0 +1,286 @@
+"""
+    dashCO2.history
+    ~~~~~~~~~~~~~~~
+
+    Applicación en dash para explorar la historia de un dispositivo
+    o un edificio. La resolución (datos crudos, minuto, hora o día)
+    se elige según el rango pedido y se vuelve a consultar al hacer
+    zoom o desplazar el gráfico (ver models.get_history).
+"""
+
+import arrow
+import dash
+import dash_core_components as dcc
+import dash_html_components as html
+import numpy as np
+from dash.dependencies import Input, Output
+
+from . import config, models
+from .shared import COLORS
+
+RANGES = {
+    "1 h": 60 * 60,
+    "24 h": 24 * 60 * 60,
+    "7 d": 7 * 24 * 60 * 60,
+    "30 d": 30 * 24 * 60 * 60,
+    "1 año": 365 * 24 * 60 * 60,
+}
+
+RESOLUTION_LABELS = {
+    0: "datos crudos",
+    60: "promedio por minuto",
+    60 * 60: "promedio por hora",
+    24 * 60 * 60: "promedio por día",
+}
+
+
+def _utcoffset():
+    return arrow.now(config.TIMEZONE).utcoffset().total_seconds()
+
+
+def _to_local(timestamps) -> list[str]:
+    """Timestamps as local date strings (understood by plotly)."""
+    local = np.asarray(timestamps, dtype=np.int64) + int(_utcoffset())
+    return local.astype("datetime64[s]").astype(str).tolist()
+
+
+def _from_local(value: str) -> int:
+    return arrow.get(value, tzinfo=config.TIMEZONE).timestamp
+
+
+def _zoom_range(relayout_data):
+    """Range selected in the graph or None if autorange."""
+    try:
+        return (
+            _from_local(relayout_data["xaxis.range[0]"]),
+            _from_local(relayout_data["xaxis.range[1]"]),
+        )
+    except (KeyError, TypeError, arrow.parser.ParserError):
+        return None
+
+
+def _building_serial_numbers(building) -> list[int]:
+    query = models.Device.query.with_entities(
+        models.Device.serial_number
+    ).filter(models.Device.building == building)
+    return [serial_number for (serial_number,) in query]
+
+
+def build_figure(resolution, data, start, end, uirevision):
+    layout = dict(
+        uirevision=uirevision,
+        paper_bgcolor="rgba(0,0,0,0)",
+        plot_bgcolor="rgba(0,0,0,0)",
+        font=dict(color="#f3f5f4"),
+        margin=dict(l=40, r=10, t=40, b=40),
+        title=RESOLUTION_LABELS[resolution],
+        showlegend=False,
+        xaxis=dict(
+            type="date",
+            range=_to_local([start, end]),
+            showgrid=False,
+        ),
+        yaxis=dict(title="CO2 [ppm]", gridcolor="#4B5460"),
+        shapes=[
+            dict(
+                type="line",
+                xref="paper",
+                x0=0,
+                x1=1,
+                y0=value,
+                y1=value,
+                line=dict(dash="dot", width=1, color=color),
+            )
+            for value, color in (
+                (config.RANGES.OK, COLORS.OK),
+                (config.RANGES.WARNING, COLORS.WARNING),
+                (config.RANGES.DANGER, COLORS.DANGER),
+            )
+        ],
+    )
+
+    if not data:
+        return dict(data=[], layout=layout)
+
+    timestamps, means, mins, maxs = zip(*data)
+    x = _to_local(timestamps)
+
+    traces = []
+    if resolution:
+        traces += [
+            dict(
+                type="scatter",
+                x=x,
+                y=maxs,
+                mode="lines",
+                line=dict(width=0),
+                hoverinfo="skip",
+            ),
+            dict(
+                type="scatter",
+                x=x,
+                y=mins,
+                mode="lines",
+                line=dict(width=0),
+                fill="tonexty",
+                fillcolor="rgba(136,136,136,0.3)",
+                hoverinfo="skip",
+            ),
+        ]
+    traces.append(
+        dict(
+            type="scatter",
+            x=x,
+            y=means,
+            mode="lines",
+            line=dict(color="#92e0d3", width=2),
+            name="CO2",
+        )
+    )
+    return dict(data=traces, layout=layout)
+
+
+def build_app(**kwargs):
+
+    dash_app = dash.Dash(
+        __name__,
+        meta_tags=[
+            {
+                "name": "viewport",
+                "content": "width=device-width, initial-scale=1",
+            }
+        ],
+        **kwargs,
+    )
+
+    @dash_app.callback(
+        [
+            Output("history-device", "options"),
+            Output("history-building", "options"),
+            Output("history-device", "value"),
+        ],
+        Input("history-url", "search"),
+    )
+    def update_options(search):
+        devices = models.Device.query.order_by(
+            models.Device.serial_number
+        ).all()
+        device_options = [
+            dict(
+                label=f"s/n {dev.serial_number} - {dev.building} "
+                f"- {dev.room}",
+                value=dev.serial_number,
+            )
+            for dev in devices
+        ]
+        building_options = [
+            dict(label=building, value=building)
+            for building in sorted({dev.building for dev in devices})
+        ]
+
+        selected = None
+        for item in (search or "").lstrip("?").split("&"):
+            key, _, value = item.partition("=")
+            if key == "serial_number" and value.isdigit():
+                selected = int(value)
+
+        return device_options, building_options, selected
+
+    @dash_app.callback(
+        Output("history-graph", "figure"),
+        Input("history-device", "value"),
+        Input("history-building", "value"),
+        Input("history-range", "value"),
+        Input("history-graph", "relayoutData"),
+    )
+    def update_graph(
+        serial_number, building, range_label, relayout_data
+    ):
+        if serial_number is not None:
+            serial_numbers = [serial_number]
+        elif building is not None:
+            serial_numbers = _building_serial_numbers(building)
+        else:
+            serial_numbers = []
+
+        uirevision = f"{serial_number}-{building}-{range_label}"
+        end = arrow.utcnow().timestamp
+        start = end - RANGES[range_label]
+
+        triggered = [
+            t["prop_id"] for t in dash.callback_context.triggered
+        ]
+        if "history-graph.relayoutData" in triggered:
+            start, end = _zoom_range(relayout_data) or (start, end)
+
+        if not serial_numbers:
+            return build_figure(0, [], start, end, uirevision)
+
+        resolution, data = models.get_history(
+            serial_numbers, start, end
+        )
+        return build_figure(resolution, data, start, end, uirevision)
+
+    dash_app.layout = html.Div(
+        id="big-app-container",
+        children=[
+            dcc.Location(id="history-url"),
+            html.Div(
+                id="banner",
+                className="banner",
+                children=[
+                    html.Div(
+                        id="banner-logo",
+                        children=[
+                            html.Img(
+                                id="logo",
+                                src=dash_app.get_asset_url(
+                                    "logo-exactas.png"
+                                ),
+                            ),
+                        ],
+                    ),
+                    html.Div(
+                        id="banner-text",
+                        className="row metric-row metric-row-up",
+                        children=[html.H5("Historia de CO2")],
+                    ),
+                ],
+            ),
+            html.Div(
+                className="section-banner",
+                style={"width": "100%", "display": "flex"},
+                children=[
+                    dcc.Dropdown(
+                        id="history-device",
+                        placeholder="Sensor",
+                        style={"width": "300px", "color": "#1e2130"},
+                    ),
+                    dcc.Dropdown(
+                        id="history-building",
+                        placeholder="Edificio",
+                        style={"width": "200px", "color": "#1e2130"},
+                    ),
+                    dcc.RadioItems(
+                        id="history-range",
+                        options=[
+                            dict(label=label, value=label)
+                            for label in RANGES
+                        ],
+                        value="24 h",
+                        labelStyle={"display": "inline-block"},
+                        labelClassName="mleft",
+                    ),
+                ],
+            ),
+            dcc.Graph(
+                id="history-graph",
+                style={"width": "100%", "height": "70vh"},
+                config={"displaylogo": False},
+            ),
+        ],
+    )
+
+    dash_app.title = "Historia de CO2 / Exactas / UBA"
+
+    return dash_app
@@ -0,0 +1,161 @@
+"""
+    dashCO2.kiosk
+    ~~~~~~~~~~~~~
+
+    Vista estática para pantallas de sólo lectura (kioscos).
+
+    /kiosk/ [GET]
+        Lista de edificios.
+    /kiosk/<building> [GET]
+        Estado de los sensores de un edificio, con gráficos en SVG
+        generados en el servidor.
+
+    Cada página se genera a lo sumo una vez cada KIOSK_REFRESH_SEC (por
+    proceso, ver ServerCache.get_or_set) y la comparten todas las
+    pantallas. Las respuestas llevan ETag para que
+    las pantallas que ya tienen la última versión reciban un 304. El
+    ETag se calcula con los datos de la página (últimos valores,
+    estados, umbrales), no con el HTML, que cambia en cada generación
+    (hora de actualización, posición de los gráficos).
+"""
+
+import hashlib
+
+import arrow
+import flask
+import numpy as np
+
+from . import cache, config, models
+from .shared import COLORS, STATUS_COLORS, classify
+
+# Tamaño del gráfico (unidades del viewBox del SVG).
+_WIDTH, _HEIGHT = 300, 100
+# Máximo valor de CO2 del eje vertical (igual que en el dashboard).
+_YMAX = 1200
+# Cantidad máxima de puntos por gráfico.
+_MAX_POINTS = 300
+
+_pages = cache.ServerCache(
+    config.KIOSK_REFRESH_SEC, maxsize=256, name="kiosk"
+)
+
+
+def _scale_y(value):
+    return _HEIGHT - np.clip(value, 0, _YMAX) * _HEIGHT / _YMAX
+
+
+def sparkline_points(timestamps, values, now) -> str:
+    """Points of the SVG polyline for the given values."""
+    if not timestamps:
+        return ""
+    timestamps = np.asarray(timestamps, dtype=float)
+    values = np.asarray(values, dtype=float)
+    step = -(-len(timestamps) // _MAX_POINTS)
+    timestamps, values = timestamps[::step], values[::step]
+
+    xmin = now - config.DISPLAY_LEN_SEC
+    x = (timestamps - xmin) * _WIDTH / config.DISPLAY_LEN_SEC
+    y = _scale_y(values)
+    return " ".join(f"{xi:.1f},{yi:.1f}" for xi, yi in zip(x, y))
+
+
+def _thresholds():
+    return [
+        (round(float(_scale_y(value)), 1), color)
+        for value, color in (
+            (config.RANGES.OK, COLORS.OK),
+            (config.RANGES.WARNING, COLORS.WARNING),
+            (config.RANGES.DANGER, COLORS.DANGER),
+        )
+    ]
+
+
+def render(building: str) -> tuple[str, str]:
+    """Render the page of a building, return the body and the etag."""
+    now = arrow.utcnow().timestamp
+    devices = (
+        models.Device.query.filter(models.Device.building == building)
+        .order_by(models.Device.floor, models.Device.room)
+        .all()
+    )
+    if not devices:
+        flask.abort(404)
+
+    series = [
+        models.get_recent_values(dev.serial_number) for dev in devices
+    ]
+    codes = classify(
+        [y[-1] if y else np.nan for _, y in series],
+        [x[-1] if x else np.nan for x, _ in series],
+        now,
+    )
+
+    boxes, inputs = [], [building, _thresholds()]
+    for dev, (x, y), code in zip(devices, series, codes):
+        value = y[-1] if x else "s/d"
+        color = STATUS_COLORS[code]
+        boxes.append(
+            dict(
+                title=(
+                    f"s/n {dev.serial_number}"
+                    if dev.room == "s/d"
+                    else dev.room
+                ),
+                floor=dev.floor,
+                value=value,
+                color=color,
+                points=sparkline_points(x, y, now),
+            )
+        )
+        inputs.append(
+            (
+                dev.serial_number,
+                dev.floor,
+                dev.room,
+                x[-1] if x else None,
+                value,
+                int(code),
+            )
+        )
+
+    body = flask.render_template(
+        "kiosk.html",
+        building=building,
+        boxes=boxes,
+        thresholds=_thresholds(),
+        width=_WIDTH,
+        height=_HEIGHT,
+        refresh_sec=config.KIOSK_REFRESH_SEC,
+        updated=arrow.now(config.TIMEZONE).format("YYYY-MM-DD HH:mm"),
+    )
+    etag = hashlib.blake2b(
+        repr(inputs).encode("utf-8"), digest_size=16
+    ).hexdigest()
+    return body, etag
+
+
+def init_app(app):
+    @app.route("/kiosk/")
+    def kiosk_index():
+        buildings = sorted(
+            building
+            for (building,) in models.Device.query.with_entities(
+                models.Device.building
+            ).distinct()
+        )
+        return flask.render_template(
+            "kiosk.html", buildings=buildings, boxes=None
+        )
+
+    # path: los edificios pueden tener "/" (p. ej. "s/d").
+    @app.route("/kiosk/<path:building>")
+    def kiosk(building):
+        body, etag = _pages.get_or_set(
+            building, lambda: render(building)
+        )
+
+        response = flask.Response(body, mimetype="text/html")
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = config.KIOSK_REFRESH_SEC
+        return response.make_conditional(flask.request)
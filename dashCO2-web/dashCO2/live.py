@@ -0,0 +1,182 @@
+"""
+    dashCO2.live
+    ~~~~~~~~~~~~
+
+    Envía a los dashboards conectados las mediciones nuevas y los cambios
+    de estado de los dispositivos usando Server-Sent Events.
+
+    /events [GET]
+        Stream de eventos. Acepta uno o más parámetros `building`
+        para recibir sólo los eventos de esos edificios.
+
+    Los eventos de un mismo dispositivo se agrupan (coalescing) durante
+    LIVE_COALESCE_SEC y se envía sólo el último.
+
+    El broker vive en el proceso: con varios workers de uwsgi cada uno
+    notifica sólo a los dashboards conectados a él.
+"""
+
+import json
+import threading
+import time
+
+import flask
+
+from . import config
+
+# Tiempo entre mensajes para mantener viva la conexión (en segundos).
+_KEEPALIVE_SEC = 15
+
+
+class Subscription:
+    """Pending events for a connected dashboard."""
+
+    def __init__(self, buildings=None):
+        self.buildings = frozenset(buildings or ())
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._ready = threading.Event()
+
+    def accepts(self, building) -> bool:
+        return not self.buildings or building in self.buildings
+
+    def put(self, key, event: str, data: dict):
+        with self._lock:
+            # A newer event with the same key replaces the older one.
+            self._pending.pop(key, None)
+            self._pending[key] = (event, data)
+        self._ready.set()
+
+    def wait(self, timeout: float, coalesce_sec: float):
+        """Wait for events and return them, after waiting coalesce_sec
+        for more events to arrive."""
+        if not self._ready.wait(timeout):
+            return []
+        time.sleep(coalesce_sec)
+        with self._lock:
+            self._ready.clear()
+            events, self._pending = list(self._pending.values()), {}
+        return events
+
+
+class Broker:
+    """Fan-out of events to the subscriptions of this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+
+    def subscribe(self, buildings=None) -> Subscription:
+        subscription = Subscription(buildings)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def pending(self) -> tuple[int, int]:
+        """Number of subscriptions and of events waiting to be sent."""
+        with self._lock:
+            subscriptions = tuple(self._subscriptions)
+        return (
+            len(subscriptions),
+            sum(len(s._pending) for s in subscriptions),
+        )
+
+    def publish(self, key, event: str, data: dict, building=None):
+        if not self._subscriptions:
+            return
+        with self._lock:
+            subscriptions = tuple(self._subscriptions)
+        for subscription in subscriptions:
+            if building is None or subscription.accepts(building):
+                subscription.put(key, event, data)
+
+
+broker = Broker()
+
+
+def publish_reading(dev, previous_co2, previous_seen):
+    """Publish the last reading of a device, and the status change
+    (compared to previous_co2 and previous_seen) if any."""
+    from .shared import COLORS, color_from_value
+
+    if not config.LIVE_UPDATES:
+        return
+
+    timestamp, co2 = dev.last_seen, dev.last_co2
+    color = color_from_value(co2, timestamp)
+    if previous_seen is None or previous_co2 is None:
+        previous_color = COLORS.OFFLINE
+    else:
+        previous_color = color_from_value(previous_co2, previous_seen)
+    data = dict(
+        serial_number=dev.serial_number,
+        building=dev.building,
+        timestamp=timestamp,
+        co2=co2,
+        color=color,
+    )
+    broker.publish(
+        ("reading", dev.serial_number), "reading", data, dev.building
+    )
+    if color != previous_color:
+        broker.publish(
+            ("status", dev.serial_number), "status", data, dev.building
+        )
+
+
+def publish_device(dev):
+    """Publish that a device was added or changed."""
+    if not config.LIVE_UPDATES:
+        return
+
+    broker.publish(
+        ("device", dev.serial_number),
+        "device",
+        dict(serial_number=dev.serial_number, building=dev.building),
+    )
+
+
+def _format(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def init_app(app):
+
+    if not config.LIVE_UPDATES:
+        return
+
+    @app.route("/events")
+    def events():
+        subscription = broker.subscribe(
+            flask.request.args.getlist("building")
+        )
+
+        def stream():
+            try:
+                yield "retry: 5000\n\n"
+                # The browser reconnects on its own, closing the stream
+                # from time to time frees the worker thread.
+                deadline = time.monotonic() + config.LIVE_MAX_STREAM_SEC
+                while time.monotonic() < deadline:
+                    events = subscription.wait(
+                        _KEEPALIVE_SEC, config.LIVE_COALESCE_SEC
+                    )
+                    if not events:
+                        yield ": keepalive\n\n"
+                    for event, data in events:
+                        yield _format(event, data)
+            finally:
+                broker.unsubscribe(subscription)
+
+        return flask.Response(
+            stream(),
+            mimetype="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+            },
+        )
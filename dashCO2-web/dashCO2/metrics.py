@@ -0,0 +1,329 @@
+"""
+    dashCO2.metrics
+    ~~~~~~~~~~~~~~~
+
+    Métricas en el formato de texto de Prometheus.
+
+    /metrics [GET]
+        Contadores e histogramas del proceso (ver abajo). Sólo si
+        METRICS es True; no pide autenticación.
+
+    Cada thread suma en su propio diccionario, así que registrar una
+    métrica no toma ningún lock. Los diccionarios se combinan al pedir
+    /metrics. Con varios workers de uwsgi cada uno tiene sus propias
+    métricas.
+"""
+
+import bisect
+import collections
+import threading
+import time
+
+import flask
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import config
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+
+def _snapshot(shard: dict) -> list:
+    # El thread dueño puede agregar claves mientras se copia.
+    while True:
+        try:
+            return list(shard.items())
+        except RuntimeError:
+            pass
+
+
+class Registry:
+    """Metrics of the process, with per thread storage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._metrics = []
+        # (thread, shard) of the threads that recorded something.
+        self._shards = []
+        # Values of the threads that already finished.
+        self._retired = collections.defaultdict(float)
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def shard(self) -> collections.defaultdict:
+        """Values of the current thread."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = collections.defaultdict(float)
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def totals(self) -> dict:
+        """Sum of the values of all threads."""
+        with self._lock:
+            totals = collections.defaultdict(float, self._retired)
+            alive = []
+            for thread, shard in self._shards:
+                items = _snapshot(shard)
+                for key, value in items:
+                    totals[key] += value
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    for key, value in items:
+                        self._retired[key] += value
+            self._shards = alive
+        return totals
+
+    def render(self) -> str:
+        totals = self.totals()
+        by_name = collections.defaultdict(list)
+        for (name, labels, suffix), value in totals.items():
+            by_name[name].append((labels, suffix, value))
+
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples(by_name[metric.name]))
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+
+
+def _format_value(value) -> str:
+    return (
+        repr(float(value)) if value != int(value) else str(int(value))
+    )
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.registry = registry or REGISTRY
+        self.registry.register(self)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self.registry.shard()[(self.name, labels, None)] += amount
+
+    def samples(self, values):
+        for labels, _, value in sorted(values):
+            yield "%s%s %s" % (
+                self.name,
+                _format_labels(self.labelnames, labels),
+                _format_value(value),
+            )
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        shard = self.registry.shard()
+        ndx = bisect.bisect_left(self.buckets, value)
+        shard[(self.name, labels, ndx)] += 1
+        shard[(self.name, labels, "sum")] += value
+
+    def samples(self, values):
+        series = collections.defaultdict(dict)
+        for labels, suffix, value in values:
+            series[labels][suffix] = value
+
+        for labels in sorted(series):
+            counts = series[labels]
+            cumulative = 0
+            for ndx, bound in enumerate(self.buckets + ("+Inf",)):
+                cumulative += counts.get(ndx, 0)
+                yield "%s_bucket%s %s" % (
+                    self.name,
+                    _format_labels(
+                        self.labelnames, labels, [("le", bound)]
+                    ),
+                    _format_value(cumulative),
+                )
+            formatted = _format_labels(self.labelnames, labels)
+            yield "%s_sum%s %s" % (
+                self.name,
+                formatted,
+                _format_value(counts.get("sum", 0)),
+            )
+            yield "%s_count%s %s" % (
+                self.name,
+                formatted,
+                _format_value(cumulative),
+            )
+
+
+class Gauge(_Metric):
+    """Value computed when the metrics are requested. func returns a
+    number or a dict mapping tuples of label values to numbers."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, func, labelnames=(), registry=None):
+        super().__init__(name, help, labelnames, registry)
+        self.func = func
+
+    def samples(self, values):
+        value = self.func()
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, v in sorted(value.items()):
+            yield "%s%s %s" % (
+                self.name,
+                _format_labels(self.labelnames, labels),
+                _format_value(v),
+            )
+
+
+REGISTRY = Registry()
+
+STORE_REQUESTS = Counter(
+    "dashco2_store_requests_total",
+    "Requests to /store by method and outcome.",
+    ("method", "outcome"),
+)
+STORE_DURATION = Histogram(
+    "dashco2_store_duration_seconds",
+    "Time to handle a request to /store.",
+    ("method",),
+)
+RECORDS = Counter(
+    "dashco2_records_total",
+    "Records stored in the database.",
+)
+AGGREGATE_FAILURES = Counter(
+    "dashco2_aggregate_failures_total",
+    "Records stored without updating the aggregates "
+    "(see flask rebuild-aggregates).",
+)
+DB_COMMIT_DURATION = Histogram(
+    "dashco2_db_commit_duration_seconds",
+    "Time to flush and commit a database session.",
+)
+DASH_CALLBACK_DURATION = Histogram(
+    "dashco2_dash_callback_duration_seconds",
+    "Time to run a Dash callback, by app and callback output.",
+    ("app", "callback"),
+)
+CACHE_REQUESTS = Counter(
+    "dashco2_cache_requests_total",
+    "Lookups in the server caches by result (hit or miss).",
+    ("cache", "result"),
+)
+FIRMWARE_BYTES = Counter(
+    "dashco2_firmware_bytes_total",
+    "Firmware bytes served by version and variant (bin or gz).",
+    ("version", "variant"),
+)
+
+
+def _live_queue():
+    from . import live
+
+    return live.broker.pending()
+
+
+LIVE_SUBSCRIPTIONS = Gauge(
+    "dashco2_live_subscriptions",
+    "Dashboards connected to /events.",
+    lambda: _live_queue()[0],
+)
+LIVE_PENDING_EVENTS = Gauge(
+    "dashco2_live_pending_events",
+    "Events waiting to be sent to the connected dashboards.",
+    lambda: _live_queue()[1],
+)
+
+
+def _before_commit(session):
+    session.info["commit_started"] = time.perf_counter()
+
+
+def _after_commit(session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        DB_COMMIT_DURATION.observe(time.perf_counter() - started)
+
+
+def init_app(app):
+
+    if not config.METRICS:
+        return
+
+    # Para todas las sesiones del proceso, una sola vez aunque se cree
+    # más de una app.
+    for name, listener in (
+        ("before_commit", _before_commit),
+        ("after_commit", _after_commit),
+    ):
+        if not event.contains(Session, name, listener):
+            event.listen(Session, name, listener)
+
+    @app.before_request
+    def _start_timer():
+        if flask.request.path.endswith("/_dash-update-component"):
+            flask.g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _observe_callback(response):
+        started = flask.g.pop("metrics_started", None)
+        if started is not None:
+            payload = flask.request.get_json(silent=True) or {}
+            DASH_CALLBACK_DURATION.observe(
+                time.perf_counter() - started,
+                flask.request.path[: -len("_dash-update-component")],
+                payload.get("output", ""),
+            )
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        return flask.Response(
+            REGISTRY.render(),
+            mimetype="text/plain; version=0.0.4",
+        )
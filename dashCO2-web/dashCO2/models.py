@@ -11,9 +11,11 @@ import collections
 from typing import Any, Union
 
 import arrow
-from sqlalchemy import and_, desc
+import numpy as np
+from sqlalchemy import and_, case, desc, func
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
-from . import db
+from . import cache, config, db, ringbuffer
 
 
 class Record(db.Model):
@@ -26,6 +28,43 @@ class Record(db.Model):
     ntp_epoch = db.Column(db.Integer, nullable=False)
     boot_id = db.Column(db.Integer, nullable=False)
 
+    __table_args__ = (
+        db.Index(
+            "ix_record_serial_number_timestamp",
+            "serial_number",
+            "timestamp",
+        ),
+        # Keyset pagination in the admin (see crud.RecordView).
+        db.Index("ix_record_timestamp_id", "timestamp", "id"),
+    )
+
+
+# Resúmenes para el índice del admin, por offline_secs (ver get_summary).
+_summaries = cache.ServerCache(
+    config.SUMMARY_TTL_SEC, maxsize=16, name="summary"
+)
+
+# Resoluciones de RecordAggregate (en segundos): minuto, hora y día.
+AGGREGATE_RESOLUTIONS = (60, 60 * 60, 24 * 60 * 60)
+
+
+class RecordAggregate(db.Model):
+    """CO2 values of a device aggregated in buckets of
+    `resolution` seconds starting at `bucket`."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.Integer, nullable=False)
+    serial_number = db.Column(db.Integer, nullable=False)
+    bucket = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    co2_sum = db.Column(db.Integer, nullable=False)
+    co2_min = db.Column(db.Integer, nullable=False)
+    co2_max = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint("resolution", "serial_number", "bucket"),
+    )
+
 
 class Device(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -46,6 +85,37 @@ class Device(db.Model):
     last_co2 = db.Column(db.Integer)
 
 
+class Rollout(db.Model):
+    """Staged firmware update (see rollout)."""
+
+    id = db.Column(db.Integer, primary_key=True)
+    firmware_version = db.Column(db.Integer, nullable=False)
+    created = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String, nullable=False, default="running")
+    max_in_flight = db.Column(db.Integer, nullable=False)
+
+    # Etapa actual y cuándo empezó.
+    wave = db.Column(db.Integer, nullable=False, default=0)
+    wave_started = db.Column(db.Integer, nullable=False)
+
+
+class RolloutDevice(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    rollout_id = db.Column(
+        db.Integer,
+        db.ForeignKey("rollout.id"),
+        nullable=False,
+        index=True,
+    )
+    serial_number = db.Column(db.Integer, nullable=False, index=True)
+    wave = db.Column(db.Integer, nullable=False)
+    state = db.Column(db.String, nullable=False, default="pending")
+    # Cuando se le envió la versión nueva al dispositivo.
+    offered_at = db.Column(db.Integer)
+
+    rollout = db.relationship(Rollout)
+
+
 def revgen(gen):
     """Reversed list from a generator."""
     return list(reversed(list(gen)))
@@ -81,6 +151,247 @@ def get_values(
     return revgen(timestamp), revgen(values)
 
 
+def add_record(dev: Device, values: dict) -> bool:
+    """Store a record (values are the Record columns), the last value
+    of the device and the aggregates in a single transaction (commits).
+
+    Returns False if the aggregates could not be updated. The record is
+    stored anyway, and flask rebuild-aggregates fixes the aggregates.
+    Other database errors are raised.
+    """
+    for _ in range(3):
+        rec = _add_record(dev, values)
+        try:
+            if rec.co2 < 5000:
+                for resolution in AGGREGATE_RESOLUTIONS:
+                    _add_to_aggregate(
+                        resolution,
+                        rec.serial_number,
+                        rec.timestamp,
+                        rec.co2,
+                    )
+            db.session.commit()
+            return True
+        except IntegrityError:
+            # A bucket was inserted by another worker in the meantime,
+            # start again (this time it will be updated).
+            db.session.rollback()
+        except SQLAlchemyError:
+            db.session.rollback()
+            break
+
+    _add_record(dev, values)
+    db.session.commit()
+    return False
+
+
+def _add_record(dev: Device, values: dict) -> Record:
+    rec = Record(**values)
+    db.session.add(rec)
+    dev.last_seen = rec.timestamp
+    dev.last_co2 = rec.co2
+    return rec
+
+
+def aggregates_missing() -> bool:
+    """True if there are records but no aggregates (e.g. a database
+    created before the aggregates, see flask rebuild-aggregates)."""
+    return (
+        db.session.query(Record.id).first() is not None
+        and db.session.query(RecordAggregate.id).first() is None
+    )
+
+
+def _add_to_aggregate(resolution, serialno, timestamp, co2):
+    bucket = timestamp - timestamp % resolution
+    updated = RecordAggregate.query.filter(
+        RecordAggregate.resolution == resolution,
+        RecordAggregate.serial_number == serialno,
+        RecordAggregate.bucket == bucket,
+    ).update(
+        {
+            "count": RecordAggregate.count + 1,
+            "co2_sum": RecordAggregate.co2_sum + co2,
+            "co2_min": case(
+                [(RecordAggregate.co2_min > co2, co2)],
+                else_=RecordAggregate.co2_min,
+            ),
+            "co2_max": case(
+                [(RecordAggregate.co2_max < co2, co2)],
+                else_=RecordAggregate.co2_max,
+            ),
+        },
+        synchronize_session=False,
+    )
+    if not updated:
+        db.session.add(
+            RecordAggregate(
+                resolution=resolution,
+                serial_number=serialno,
+                bucket=bucket,
+                count=1,
+                co2_sum=co2,
+                co2_min=co2,
+                co2_max=co2,
+            )
+        )
+        db.session.flush()
+
+
+def rebuild_aggregates():
+    """Rebuild RecordAggregate from all the records."""
+    RecordAggregate.query.delete()
+    for resolution in AGGREGATE_RESOLUTIONS:
+        bucket = Record.timestamp - Record.timestamp % resolution
+        query = (
+            db.session.query(
+                Record.serial_number,
+                bucket,
+                func.count(),
+                func.sum(Record.co2),
+                func.min(Record.co2),
+                func.max(Record.co2),
+            )
+            .filter(Record.co2 < 5000)
+            .group_by(Record.serial_number, bucket)
+        )
+        db.session.bulk_insert_mappings(
+            RecordAggregate,
+            (
+                dict(
+                    resolution=resolution,
+                    serial_number=serial_number,
+                    bucket=bucket_value,
+                    count=count,
+                    co2_sum=co2_sum,
+                    co2_min=co2_min,
+                    co2_max=co2_max,
+                )
+                for (
+                    serial_number,
+                    bucket_value,
+                    count,
+                    co2_sum,
+                    co2_min,
+                    co2_max,
+                ) in query
+            ),
+        )
+    db.session.commit()
+
+
+def pick_resolution(start: int, end: int, max_points: int) -> int:
+    """Coarsest resolution (in seconds, 0 is raw data) that still gives
+    at most max_points between start and end."""
+    span = end - start
+    # Raw data arrives at most every MIN_ACQ_PERIOD_SEC.
+    if span / ringbuffer.MIN_ACQ_PERIOD_SEC <= max_points:
+        return 0
+    for resolution in AGGREGATE_RESOLUTIONS:
+        if span / resolution <= max_points:
+            return resolution
+    return AGGREGATE_RESOLUTIONS[-1]
+
+
+def estimate_record_count(serial_numbers=None, min_ts=None) -> int:
+    """Estimate the number of records from the aggregates.
+
+    Invalid values are not included, and the count starts at the
+    beginning of the hour (or day if no min_ts) of min_ts.
+    """
+    resolution = (
+        AGGREGATE_RESOLUTIONS[1]
+        if min_ts is not None
+        else AGGREGATE_RESOLUTIONS[-1]
+    )
+    query = RecordAggregate.query.with_entities(
+        func.sum(RecordAggregate.count)
+    ).filter(RecordAggregate.resolution == resolution)
+    if serial_numbers is not None:
+        query = query.filter(
+            RecordAggregate.serial_number.in_(list(serial_numbers))
+        )
+    if min_ts is not None:
+        query = query.filter(
+            RecordAggregate.bucket >= min_ts - min_ts % resolution
+        )
+    return query.scalar() or 0
+
+
+def get_history(
+    serial_numbers: list[int], start: int, end: int, max_points=3000
+) -> tuple[int, list[tuple[int, float, int, int]]]:
+    """CO2 between start and end for one or more devices (combined).
+
+    Returns the resolution used (see pick_resolution) and a list of
+    (timestamp, mean, min, max) sorted by timestamp.
+    """
+    resolution = pick_resolution(start, end, max_points)
+    if resolution == 0 and len(serial_numbers) > 1:
+        # Raw values from several devices do not line up.
+        resolution = AGGREGATE_RESOLUTIONS[0]
+
+    if resolution == 0:
+        data = (
+            Record.query.with_entities(Record.timestamp, Record.co2)
+            .filter(
+                Record.serial_number == serial_numbers[0],
+                Record.timestamp.between(start, end),
+                Record.co2 < 5000,
+            )
+            .order_by(Record.timestamp)
+        )
+        return resolution, [(ts, co2, co2, co2) for ts, co2 in data]
+
+    data = (
+        db.session.query(
+            RecordAggregate.bucket,
+            func.sum(RecordAggregate.co2_sum),
+            func.sum(RecordAggregate.count),
+            func.min(RecordAggregate.co2_min),
+            func.max(RecordAggregate.co2_max),
+        )
+        .filter(
+            RecordAggregate.resolution == resolution,
+            RecordAggregate.serial_number.in_(serial_numbers),
+            RecordAggregate.bucket.between(start - resolution, end),
+        )
+        .group_by(RecordAggregate.bucket)
+        .order_by(RecordAggregate.bucket)
+    )
+    return resolution, [
+        (bucket, co2_sum / count, co2_min, co2_max)
+        for bucket, co2_sum, count, co2_min, co2_max in data
+    ]
+
+
+def get_recent_values(serialno: int) -> tuple[list[int], list[int]]:
+    """Get values from the last DISPLAY_LEN_SEC of a given device,
+    sorted by timestamp.
+
+    Values are taken from the ring buffer if enabled.
+    """
+    buffer = ringbuffer.get()
+    if buffer is None:
+        return get_values(serialno, -config.DISPLAY_LEN_SEC, 5000)
+    min_ts = arrow.utcnow().timestamp - config.DISPLAY_LEN_SEC
+    return buffer.get_values(serialno, min_ts)
+
+
+def data_version(serial_numbers) -> str:
+    """A value that changes when new data arrives for these devices."""
+    buffer = ringbuffer.get()
+    if buffer is not None:
+        return f"rb{buffer.version}"
+
+    total, count = (
+        db.session.query(func.sum(Device.last_seen), func.count())
+        .filter(Device.serial_number.in_(list(serial_numbers)))
+        .one()
+    )
+    return f"db{total}/{count}"
+
+
 def load_devices():
     """Load devices and buildings (used in dash)."""
     buildings = {"s/d": "building-filter-NO"}
@@ -102,83 +413,165 @@ def load_devices():
     return devices, buildings, building_options
 
 
+def _last_values_from_db():
+    """Serial numbers, last timestamps and values of every device
+    (NaN when unknown)."""
+    data = Device.query.with_entities(
+        Device.serial_number, Device.last_seen, Device.last_co2
+    ).all()
+    if not data:
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+    serial_numbers, timestamps, values = zip(*data)
+    return (
+        np.array(serial_numbers),
+        np.array(timestamps, dtype=float),
+        np.array(values, dtype=float),
+    )
+
+
+def _last_values_from_buffer(buffer):
+    """Like _last_values_from_db, but with the values of the ring
+    buffer. Devices are taken from the database: those not in the
+    buffer are unknown (offline) and those in the buffer but not in
+    the database are ignored."""
+    serial_numbers = np.array(
+        [
+            serial_number
+            for (serial_number,) in Device.query.with_entities(
+                Device.serial_number
+            )
+        ],
+        dtype=np.int64,
+    )
+    timestamps = np.full(len(serial_numbers), np.nan)
+    values = np.full(len(serial_numbers), np.nan)
+
+    known, known_timestamps, known_values = buffer.last_values()
+    order = np.argsort(known)
+    known = known[order]
+    pos = np.searchsorted(known, serial_numbers)
+    pos[pos == len(known)] = 0
+    found = (
+        known[pos] == serial_numbers
+        if len(known)
+        else np.zeros(len(serial_numbers), dtype=bool)
+    )
+    timestamps[found] = known_timestamps[order][pos[found]]
+    values[found] = known_values[order][pos[found]]
+    timestamps[timestamps == 0] = np.nan
+    return serial_numbers, timestamps, values
+
+
 def get_devices_by_status(
     consider_offline_sec=None,
 ) -> dict[Any, set[int]]:
-    """ """
-    from . import config
-    from .shared import COLORS, color_from_value
+    """Serial numbers of all devices grouped by status color."""
+    from .shared import classify, group_by_status
 
     consider_offline_sec = (
         consider_offline_sec or config.CONSIDER_OFFLINE_SEC
     )
-    out = {
-        COLORS.OK: set(),
-        COLORS.WARNING: set(),
-        COLORS.DANGER: set(),
-        COLORS.OFFLINE: set(),
-    }
-    for dev in Device.query.all():
-        color = color_from_value(
-            dev.last_co2, dev.last_seen, consider_offline_sec
-        )
-        out[color].add(dev.serial_number)
-
-    return out
 
+    # The ring buffer only knows about the last DISPLAY_LEN_SEC.
+    buffer = ringbuffer.get()
+    if (
+        buffer is not None
+        and consider_offline_sec <= config.DISPLAY_LEN_SEC
+    ):
+        serial_numbers, timestamps, values = _last_values_from_buffer(
+            buffer
+        )
+    else:
+        serial_numbers, timestamps, values = _last_values_from_db()
 
-def calibration_range_from_date(val, nocal):
-    DAY = 24 * 60 * 60
-    cal_ranges = {
-        "day": DAY,
-        "week": 7 * DAY,
-        "month": 30 * DAY,
-        "year": 365 * DAY,
-        "longer": None,
-    }
-    now = arrow.utcnow().timestamp
-    if val == nocal:
-        return "N/A"
-
-    for k, delta in cal_ranges.items():
-        if delta is None:
-            return k
-        if val > now - delta:
-            return k
-
-    raise ValueError("DELTAS for groupcal should end in None")
+    codes = classify(
+        values, timestamps, consider_offline_sec=consider_offline_sec
+    )
+    return group_by_status(serial_numbers, codes)
+
+
+# Rangos de antigüedad de la última calibración (en segundos), las
+# calibraciones más antiguas están en "longer" y las que no se hicieron
+# en "N/A".
+CALIBRATION_RANGES = (
+    ("day", 24 * 60 * 60),
+    ("week", 7 * 24 * 60 * 60),
+    ("month", 30 * 24 * 60 * 60),
+    ("year", 365 * 24 * 60 * 60),
+)
+
+
+def calibration_range(nocal, now=None):
+    """SQL expression with the calibration range of a device
+    (see CALIBRATION_RANGES)."""
+    if now is None:
+        now = arrow.utcnow().timestamp
+    return case(
+        [(Device.last_calibration == nocal, "N/A")]
+        + [
+            (Device.last_calibration > now - delta, name)
+            for name, delta in CALIBRATION_RANGES
+        ],
+        else_="longer",
+    )
 
 
 def summarize_devices(
     consider_offline_sec: int, nocal: int
 ) -> dict[str, Union[set[Any], int]]:
-    from .shared import COLORS, color_from_value
+    from .shared import classify, group_by_status
 
     status = collections.defaultdict(set)
     firmware_version = collections.defaultdict(set)
     building = collections.defaultdict(set)
     last_calibration = collections.defaultdict(set)
 
-    total = 0
-    for dev in Device.query.all():
-        if dev.last_seen is None:
-            color = COLORS.OFFLINE
-        else:
-            color = color_from_value(
-                dev.last_co2, dev.last_seen, consider_offline_sec
-            )
-        status[color].add(dev.serial_number)
-        building[dev.building].add(dev.serial_number)
-        firmware_version[dev.firmware_version].add(dev.serial_number)
-        last_calibration[
-            calibration_range_from_date(dev.last_calibration, nocal)
-        ].add(dev.serial_number)
-        total += 1
+    rows = db.session.query(
+        Device.serial_number,
+        Device.building,
+        Device.firmware_version,
+        calibration_range(nocal),
+        Device.last_co2,
+        Device.last_seen,
+    ).all()
+
+    codes = classify(
+        np.array([row[4] for row in rows], dtype=float),
+        np.array([row[5] for row in rows], dtype=float),
+        consider_offline_sec=consider_offline_sec,
+    )
+    status.update(group_by_status([row[0] for row in rows], codes))
+
+    for serial_number, bldg, version, cal_range, _, _ in rows:
+        building[bldg].add(serial_number)
+        firmware_version[version].add(serial_number)
+        last_calibration[cal_range].add(serial_number)
 
     return dict(
         by_status=status,
         by_firmware_version=firmware_version,
         by_building=building,
         by_last_calibration=last_calibration,
-        total=total,
+        total=len(rows),
     )
+
+
+def get_summary(
+    consider_offline_sec: int, nocal: int
+) -> dict[str, Union[set[Any], int]]:
+    """summarize_devices and the latest firmware version, cached for
+    SUMMARY_TTL_SEC or until invalidate_summary is called."""
+    from .shared import get_latest_firmware_version
+
+    def build():
+        summary = summarize_devices(consider_offline_sec, nocal)
+        summary["last_firmware_version"] = get_latest_firmware_version()
+        return summary
+
+    return _summaries.get_or_set((consider_offline_sec, nocal), build)
+
+
+def invalidate_summary():
+    """To be called when a device is added or changed (including a
+    change of status), so that the admin index is up to date."""
+    _summaries.clear()
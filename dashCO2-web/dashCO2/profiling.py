@@ -0,0 +1,168 @@
+"""
+    dashCO2.profiling
+    ~~~~~~~~~~~~~~~~~
+
+    Perfilado de las consultas SQL (sólo si SQL_PROFILING es True).
+
+    Para cada pedido (o callback de dash) se cuentan las consultas y el
+    tiempo total en la base de datos, que se envían en el encabezado
+    Server-Timing y se registran en el log (nivel DEBUG).
+
+    Las consultas que tardan más de SLOW_QUERY_MS se registran en el log
+    junto con su plan (EXPLAIN).
+
+    Las consultas más costosas por endpoint se muestran en el admin
+    (Perfil SQL). Los datos son del proceso y se pierden al reiniciar.
+"""
+
+import collections
+import re
+import threading
+import time
+
+import flask
+from sqlalchemy import event
+
+from . import config
+
+# Máximo de consultas distintas que se guardan.
+_MAX_STATEMENTS = 2000
+
+# (?, ?, ?) -> (?, ...), para agrupar las consultas con IN.
+_PARAM = r"\s*(?:\?|%\(\w+\)s|%s)\s*"
+_PARAM_LIST = re.compile(rf"\((?:{_PARAM},)+{_PARAM}\)")
+
+Stats = collections.namedtuple(
+    "Stats", "endpoint statement count total_ms max_ms"
+)
+
+
+class Profile:
+    """Query count and time by endpoint and statement."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def add(self, endpoint: str, statement: str, elapsed_ms: float):
+        key = (endpoint, _PARAM_LIST.sub("(?, ...)", statement))
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                if len(self._stats) >= _MAX_STATEMENTS:
+                    return
+                stats = self._stats[key] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += elapsed_ms
+            stats[2] = max(stats[2], elapsed_ms)
+
+    def top(self, n: int) -> list[Stats]:
+        """The n statements with more total time."""
+        with self._lock:
+            items = [
+                Stats(endpoint, statement, *stats)
+                for (endpoint, statement), stats in self._stats.items()
+            ]
+        items.sort(key=lambda s: s.total_ms, reverse=True)
+        return items[:n]
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+
+profile = Profile()
+
+
+def _endpoint() -> str:
+    request = flask.request
+    if request.path.endswith("/_dash-update-component"):
+        payload = request.get_json(silent=True) or {}
+        return f"{request.path} {payload.get('output', '')}"
+    return request.endpoint or request.path
+
+
+def explain(connection, statement, parameters) -> str:
+    """Query plan of a statement, using the DBAPI connection directly
+    so that it is not profiled again."""
+    if connection.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return "\n".join(
+            " ".join(str(col) for col in row)
+            for row in cursor.fetchall()
+        )
+    finally:
+        cursor.close()
+
+
+def init_app(app):
+
+    if not config.SQL_PROFILING:
+        return
+
+    from . import db
+
+    with app.app_context():
+        engine = db.engine
+
+    # En el contexto de la ejecución y no en conn.info: si la consulta
+    # falla after_cursor_execute no se llama y el contexto se descarta.
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, many):
+        context._profiling_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, many):
+        elapsed_ms = (
+            time.perf_counter() - context._profiling_started
+        ) * 1000
+
+        if flask.has_request_context():
+            queries = flask.g.setdefault("sql_queries", [])
+            queries.append((statement, elapsed_ms))
+        else:
+            profile.add("-", statement, elapsed_ms)
+
+        if elapsed_ms < config.SLOW_QUERY_MS:
+            return
+        plan = ""
+        if not many and statement.lstrip().upper().startswith("SELECT"):
+            try:
+                plan = explain(conn, statement, parameters)
+            except Exception as ex:
+                plan = f"(EXPLAIN failed: {ex})"
+        app.logger.warning(
+            f"Slow query ({elapsed_ms:.1f} ms): {statement}\n"
+            f"Parameters: {parameters!r}\nPlan:\n{plan}"
+        )
+
+    @app.after_request
+    def _server_timing(response):
+        queries = flask.g.get("sql_queries")
+        if queries:
+            total_ms = sum(elapsed_ms for _, elapsed_ms in queries)
+            response.headers.add(
+                "Server-Timing",
+                f'db;dur={total_ms:.1f};desc="{len(queries)} queries"',
+            )
+        return response
+
+    # Al final del pedido, para incluir las respuestas en streaming.
+    @app.teardown_request
+    def _summarize(exc):
+        queries = flask.g.pop("sql_queries", None)
+        if not queries:
+            return
+        endpoint = _endpoint()
+        total_ms = 0
+        for statement, elapsed_ms in queries:
+            profile.add(endpoint, statement, elapsed_ms)
+            total_ms += elapsed_ms
+        app.logger.debug(
+            f"{endpoint}: {len(queries)} queries in {total_ms:.1f} ms"
+        )
@@ -0,0 +1,328 @@
+"""
+    dashCO2.ringbuffer
+    ~~~~~~~~~~~~~~~~~~
+
+    Buffer circular con las mediciones recientes de cada dispositivo
+    (cubre DISPLAY_LEN_SEC). Vive en un archivo mapeado en memoria
+    (idealmente en /dev/shm) para que todos los workers de uwsgi lo
+    compartan. La ingesta agrega valores y el dashboard los lee sin
+    pasar por la base de datos.
+
+    El archivo sobrevive a los reinicios de uwsgi: al iniciar, sólo se
+    reconstruye desde la base de datos si nunca se llenó o si no se
+    escribió en DISPLAY_LEN_SEC (ver rebuild_from_db).
+"""
+
+from __future__ import annotations
+
+import contextlib
+import fcntl
+import os
+import threading
+import time
+from typing import Union
+
+import numpy as np
+
+from . import config
+
+# El período de adquisición mínimo permitido (en segundos),
+# define cuantos valores por dispositivo hay que guardar.
+MIN_ACQ_PERIOD_SEC = 5
+
+_MAGIC = 0xC02B0F
+_FREE = -1
+
+# Campos del encabezado (los tiempos son epoch en segundos).
+(
+    _H_MAGIC,
+    _H_DEVICES,
+    _H_CAPACITY,
+    _H_VERSION,
+    _H_BUILT,
+    _H_UPDATED,
+) = range(6)
+_HEADER_LEN = 8
+
+
+class RingBuffer:
+    """Fixed size ring buffer of (timestamp, co2) per device,
+    backed by a shared memory mapped file.
+
+    Writes are serialized across threads (threading.Lock) and
+    processes (fcntl.lockf on the file).
+    """
+
+    def __init__(self, path: str, max_devices: int, capacity: int):
+        self.path = path
+        self.max_devices = max_devices
+        self.capacity = capacity
+
+        itemsize = np.dtype(np.int64).itemsize
+        sizes = (
+            _HEADER_LEN * itemsize,
+            max_devices * itemsize,
+            max_devices * itemsize,
+            max_devices * itemsize,
+            max_devices * capacity * itemsize,
+            max_devices * capacity * np.dtype(np.int32).itemsize,
+        )
+        size = sum(sizes)
+
+        self._thread_lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        with self._lock():
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, size)
+
+            offsets = np.cumsum((0,) + sizes[:-1])
+            mm = np.memmap(
+                path, dtype=np.uint8, mode="r+", shape=(size,)
+            )
+            self._mm = mm
+
+            def view(n, dtype, shape):
+                start = offsets[n]
+                stop = start + sizes[n]
+                return mm[start:stop].view(dtype).reshape(shape)
+
+            self.header = view(0, np.int64, (_HEADER_LEN,))
+            self.serials = view(1, np.int64, (max_devices,))
+            self.heads = view(2, np.int64, (max_devices,))
+            self.counts = view(3, np.int64, (max_devices,))
+            self.timestamps = view(4, np.int64, (max_devices, capacity))
+            self.values = view(5, np.int32, (max_devices, capacity))
+
+            if not (
+                self.header[_H_MAGIC] == _MAGIC
+                and self.header[_H_DEVICES] == max_devices
+                and self.header[_H_CAPACITY] == capacity
+            ):
+                self._clear()
+
+    @contextlib.contextmanager
+    def _lock(self, shared=False):
+        with self._thread_lock:
+            fcntl.lockf(
+                self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            )
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _clear(self):
+        self.header[:] = 0
+        self.header[_H_MAGIC] = _MAGIC
+        self.header[_H_DEVICES] = self.max_devices
+        self.header[_H_CAPACITY] = self.capacity
+        self.serials[:] = _FREE
+        self.heads[:] = 0
+        self.counts[:] = 0
+
+    def _slot(self, serial_number: int, create: bool):
+        found = np.flatnonzero(self.serials == serial_number)
+        if found.size:
+            return int(found[0])
+        if not create:
+            return None
+        free = np.flatnonzero(self.serials == _FREE)
+        if not free.size:
+            raise MemoryError(
+                f"No room for {serial_number} in the ring buffer "
+                f"(RING_BUFFER_MAX_DEVICES = {self.max_devices})"
+            )
+        slot = int(free[0])
+        self.serials[slot] = serial_number
+        self.heads[slot] = 0
+        self.counts[slot] = 0
+        return slot
+
+    def _append(self, slot: int, timestamps, values):
+        n = len(timestamps)
+        if n > self.capacity:
+            timestamps = timestamps[-self.capacity :]
+            values = values[-self.capacity :]
+            n = self.capacity
+        idx = (self.heads[slot] + np.arange(n)) % self.capacity
+        self.timestamps[slot, idx] = timestamps
+        self.values[slot, idx] = values
+        self.heads[slot] = (self.heads[slot] + n) % self.capacity
+        self.counts[slot] = min(self.counts[slot] + n, self.capacity)
+
+    @property
+    def version(self) -> int:
+        """Incremented every time the content changes."""
+        return int(self.header[_H_VERSION])
+
+    def _changed(self):
+        self.header[_H_VERSION] += 1
+        self.header[_H_UPDATED] = int(time.time())
+
+    def register(self, serial_number: int):
+        with self._lock():
+            self._slot(serial_number, True)
+            self._changed()
+
+    def remove(self, serial_number: int):
+        """Free the slot of a device (e.g. deleted)."""
+        with self._lock():
+            slot = self._slot(serial_number, False)
+            if slot is not None:
+                self.serials[slot] = _FREE
+                self.counts[slot] = 0
+                self._changed()
+
+    def append(self, serial_number: int, timestamp: int, value: int):
+        with self._lock():
+            slot = self._slot(serial_number, True)
+            self._append(slot, (timestamp,), (value,))
+            self._changed()
+
+    def stale(self, max_age: float) -> bool:
+        """True if never rebuilt or not written in max_age seconds."""
+        return (
+            not self.header[_H_BUILT]
+            or time.time() - self.header[_H_UPDATED] > max_age
+        )
+
+    def rebuild(self, serial_numbers, records):
+        """Replace the content.
+
+        - serial_numbers: all devices to register.
+        - records: iterable of (serial_number, timestamp, co2)
+          sorted by serial_number and timestamp.
+        """
+        with self._lock():
+            self._rebuild(serial_numbers, records)
+
+    def rebuild_if_stale(self, load, max_age: float) -> bool:
+        """Rebuild with the serial numbers and records returned by
+        load() if stale (see stale). load is called while holding the
+        lock, so appends of other processes wait for the rebuild
+        instead of being lost. Returns True if rebuilt."""
+        with self._lock():
+            if not self.stale(max_age):
+                return False
+            self._rebuild(*load())
+            return True
+
+    def _rebuild(self, serial_numbers, records):
+        self._clear()
+        for serial_number in serial_numbers:
+            self._slot(serial_number, True)
+
+        data = np.array(list(records), dtype=np.int64).reshape(-1, 3)
+        if data.size:
+            serials, starts = np.unique(data[:, 0], return_index=True)
+            for serial_number, chunk in zip(
+                serials, np.split(data, starts[1:])
+            ):
+                slot = self._slot(int(serial_number), True)
+                self._append(slot, chunk[:, 1], chunk[:, 2])
+
+        self.header[_H_BUILT] = int(time.time())
+        self._changed()
+
+    def _read(self, slot):
+        count = int(self.counts[slot])
+        idx = (
+            self.heads[slot] - count + np.arange(count)
+        ) % self.capacity
+        timestamps = self.timestamps[slot, idx]
+        values = self.values[slot, idx]
+        order = np.argsort(timestamps, kind="stable")
+        return timestamps[order], values[order]
+
+    def get_values(
+        self, serial_number: int, min_ts: int
+    ) -> tuple[list[int], list[int]]:
+        """Values for a device since min_ts, sorted by timestamp.
+        (same filtering as models.get_values)"""
+        with self._lock(shared=True):
+            slot = self._slot(serial_number, False)
+            if slot is None:
+                return [], []
+            timestamps, values = self._read(slot)
+
+        keep = (timestamps >= min_ts) & (values < 5000)
+        return timestamps[keep].tolist(), values[keep].tolist()
+
+    def last_values(self):
+        """Last timestamp and value of every registered device.
+
+        Returns three arrays: serial numbers, timestamps and values
+        (NaN for devices without values).
+        """
+        with self._lock(shared=True):
+            used = np.flatnonzero(self.serials != _FREE)
+            last = (self.heads[used] - 1) % self.capacity
+            has_values = self.counts[used] > 0
+            timestamps = np.where(
+                has_values, self.timestamps[used, last], 0
+            ).astype(float)
+            values = np.where(
+                has_values, self.values[used, last], np.nan
+            ).astype(float)
+            return self.serials[used].copy(), timestamps, values
+
+
+_buffer: Union[RingBuffer, None] = None
+
+
+def get() -> Union[RingBuffer, None]:
+    """The ring buffer or None if not enabled."""
+    return _buffer
+
+
+def _load_from_db():
+    import arrow
+
+    from .models import Device, Record
+
+    min_ts = arrow.utcnow().timestamp - config.DISPLAY_LEN_SEC
+    serial_numbers = [
+        serial_number
+        for (serial_number,) in Device.query.with_entities(
+            Device.serial_number
+        )
+    ]
+    records = (
+        Record.query.with_entities(
+            Record.serial_number, Record.timestamp, Record.co2
+        )
+        .filter(Record.timestamp >= min_ts)
+        .order_by(Record.serial_number, Record.timestamp)
+    )
+    return serial_numbers, records
+
+
+def rebuild_from_db(force=True) -> bool:
+    """Fill the ring buffer with the last DISPLAY_LEN_SEC of records.
+    Unless force, only if stale (so that only the first worker to start
+    does it). Returns True if rebuilt."""
+    max_age = -1 if force else config.DISPLAY_LEN_SEC
+    return _buffer.rebuild_if_stale(_load_from_db, max_age)
+
+
+def init_app(app):
+    global _buffer
+
+    if not config.RING_BUFFER_PATH:
+        return
+
+    _buffer = RingBuffer(
+        config.RING_BUFFER_PATH,
+        config.RING_BUFFER_MAX_DEVICES,
+        config.DISPLAY_LEN_SEC // MIN_ACQ_PERIOD_SEC,
+    )
+
+    with app.app_context():
+        rebuilt = rebuild_from_db(force=False)
+
+    if rebuilt:
+        app.logger.info(
+            f"Ring buffer at {config.RING_BUFFER_PATH} rebuilt "
+            "from the database"
+        )
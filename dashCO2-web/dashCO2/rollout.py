@@ -0,0 +1,334 @@
+"""
+    dashCO2.rollout
+    ~~~~~~~~~~~~~~~
+
+    Actualización escalonada del firmware.
+
+    En lugar de cambiar la versión de todos los dispositivos a la vez
+    (y que todos descarguen el firmware en su próximo /store), cada
+    actualización se divide en etapas según ROLLOUT_WAVES (porcentaje
+    acumulado de los dispositivos). La versión nueva se envía en
+    userServerPayload.firmwareVersion sólo a los dispositivos de las
+    etapas ya iniciadas y mientras haya menos de max_in_flight
+    descargas en curso, contando las de todas las actualizaciones
+    abiertas (el límite es de la flota, no de cada actualización).
+
+    Estados de cada dispositivo:
+        pending     esperando su turno.
+        offered     se le envió la versión nueva.
+        done        volvió con la versión nueva.
+        failed      no volvió con la versión nueva en
+                    ROLLOUT_TIMEOUT_SEC.
+        cancelled   reemplazado por otra actualización.
+
+    Una etapa termina cuando no quedan dispositivos pendientes o
+    pasaron ROLLOUT_WAVE_SEC. La actualización se pausa sola si la
+    fracción de fallidos supera ROLLOUT_MAX_FAILED_FRACTION (una vez que
+    terminaron al menos ROLLOUT_MIN_RESOLVED dispositivos). Al
+    reanudarla se vuelve a intentar con los dispositivos fallidos.
+
+    Cuando todos sus dispositivos pasan a una actualización más nueva,
+    la anterior queda terminada (o cancelada si ninguno se actualizó).
+
+    El estado se guarda en la base de datos, por lo que es compartido
+    por todos los workers. Dos workers pueden entregar un lugar al mismo
+    tiempo, así que el límite de descargas puede excederse levemente.
+"""
+
+from __future__ import annotations
+
+import collections
+import math
+from typing import Union
+
+import arrow
+
+from . import cache, config
+from .models import (
+    Device,
+    Rollout,
+    RolloutDevice,
+    db,
+    invalidate_summary,
+)
+
+RUNNING, PAUSED, DONE, CANCELLED = (
+    "running",
+    "paused",
+    "done",
+    "cancelled",
+)
+PENDING, OFFERED, FAILED = "pending", "offered", "failed"
+
+# Estados de los dispositivos que aún no terminaron.
+_OPEN = (PENDING, OFFERED)
+
+# Números de serie con actualizaciones abiertas, para no consultar la
+# base en cada /store.
+_active = cache.ServerCache(5, maxsize=1, name="rollout")
+
+
+def _active_serials() -> frozenset[int]:
+    def build():
+        query = (
+            RolloutDevice.query.join(Rollout)
+            .with_entities(RolloutDevice.serial_number)
+            .filter(
+                RolloutDevice.state.in_(_OPEN),
+                Rollout.status.in_((RUNNING, PAUSED)),
+            )
+        )
+        return frozenset(serial_number for (serial_number,) in query)
+
+    return _active.get_or_set(None, build)
+
+
+def assign_waves(count: int, waves=None) -> list[int]:
+    """Wave of each of count devices given the cumulative
+    percentages."""
+    waves = waves or config.ROLLOUT_WAVES
+    bounds = [math.ceil(count * percent / 100) for percent in waves]
+    out = []
+    for ndx in range(count):
+        out.append(
+            next(w for w, bound in enumerate(bounds) if ndx < bound)
+        )
+    return out
+
+
+def create(device_ids, firmware_version: int) -> Union[Rollout, None]:
+    """Create a rollout of firmware_version for the given devices
+    (skipping those already in that version). Open (or failed) entries
+    of the same devices in other running or paused rollouts are
+    cancelled, and those rollouts updated, so that they finish if
+    nothing is left."""
+    now = arrow.utcnow().timestamp
+    serial_numbers = sorted(
+        serial_number
+        for (serial_number,) in Device.query.with_entities(
+            Device.serial_number
+        ).filter(
+            Device.id.in_(device_ids),
+            Device.firmware_version != firmware_version,
+        )
+    )
+    if not serial_numbers:
+        return None
+
+    # Los fallidos también, para no reintentarlos al reanudar.
+    superseded = RolloutDevice.query.filter(
+        RolloutDevice.serial_number.in_(serial_numbers),
+        RolloutDevice.state.in_(_OPEN + (FAILED,)),
+        RolloutDevice.rollout_id.in_(
+            db.session.query(Rollout.id).filter(
+                Rollout.status.in_((RUNNING, PAUSED))
+            )
+        ),
+    )
+    superseded_ids = [
+        rollout_id
+        for (rollout_id,) in superseded.with_entities(
+            RolloutDevice.rollout_id
+        ).distinct()
+    ]
+    superseded.update({"state": CANCELLED}, synchronize_session=False)
+    for old in Rollout.query.filter(Rollout.id.in_(superseded_ids)):
+        _update(old, now)
+
+    rollout = Rollout(
+        firmware_version=firmware_version,
+        created=now,
+        status=RUNNING,
+        max_in_flight=config.ROLLOUT_MAX_IN_FLIGHT,
+        wave=0,
+        wave_started=now,
+    )
+    db.session.add(rollout)
+    db.session.flush()
+    db.session.bulk_insert_mappings(
+        RolloutDevice,
+        [
+            dict(
+                rollout_id=rollout.id,
+                serial_number=serial_number,
+                wave=wave,
+                state=PENDING,
+            )
+            for serial_number, wave in zip(
+                serial_numbers, assign_waves(len(serial_numbers))
+            )
+        ],
+    )
+    db.session.commit()
+    _active.clear()
+    return rollout
+
+
+def set_status(rollout_ids, status: str):
+    """Pause, resume (RUNNING) or cancel rollouts."""
+    rollouts = Rollout.query.filter(
+        Rollout.id.in_(rollout_ids),
+        Rollout.status.in_((RUNNING, PAUSED)),
+    ).all()
+    for rollout in rollouts:
+        rollout.status = status
+        if status == RUNNING:
+            # Se vuelve a intentar con los que fallaron.
+            rollout.wave_started = arrow.utcnow().timestamp
+            RolloutDevice.query.filter(
+                RolloutDevice.rollout_id == rollout.id,
+                RolloutDevice.state == FAILED,
+            ).update({"state": PENDING}, synchronize_session=False)
+        elif status == CANCELLED:
+            RolloutDevice.query.filter(
+                RolloutDevice.rollout_id == rollout.id,
+                RolloutDevice.state.in_(_OPEN),
+            ).update({"state": CANCELLED}, synchronize_session=False)
+    db.session.commit()
+    _active.clear()
+    return len(rollouts)
+
+
+def progress(rollout_id: int) -> dict[str, int]:
+    """Number of devices in each state."""
+    query = (
+        RolloutDevice.query.with_entities(
+            RolloutDevice.state, db.func.count()
+        )
+        .filter(RolloutDevice.rollout_id == rollout_id)
+        .group_by(RolloutDevice.state)
+    )
+    return collections.Counter(dict(query.all()))
+
+
+def _update(rollout: Rollout, now: int):
+    """Pause the rollout if too many devices failed, and start the next
+    wave (or finish) when the current one is over."""
+    # Los dispositivos que no vuelven no deben ocupar un lugar.
+    RolloutDevice.query.filter(
+        RolloutDevice.rollout_id == rollout.id,
+        RolloutDevice.state == OFFERED,
+        RolloutDevice.offered_at < now - config.ROLLOUT_TIMEOUT_SEC,
+    ).update({"state": FAILED}, synchronize_session=False)
+
+    counts = progress(rollout.id)
+    resolved = counts[DONE] + counts[FAILED]
+    # Sin un mínimo, el primer fallido pausaría todo (1/1).
+    min_resolved = min(
+        config.ROLLOUT_MIN_RESOLVED,
+        resolved + counts[PENDING] + counts[OFFERED],
+    )
+    if (
+        counts[FAILED]
+        and resolved >= min_resolved
+        and counts[FAILED] / resolved
+        > config.ROLLOUT_MAX_FAILED_FRACTION
+    ):
+        rollout.status = PAUSED
+        _active.clear()
+        return
+
+    if not (counts[PENDING] or counts[OFFERED]):
+        # Sin ninguno actualizado: todos pasaron a otra actualización.
+        rollout.status = DONE if counts[DONE] else CANCELLED
+        _active.clear()
+        return
+
+    if rollout.status != RUNNING:
+        return
+
+    open_in_wave = RolloutDevice.query.filter(
+        RolloutDevice.rollout_id == rollout.id,
+        RolloutDevice.wave <= rollout.wave,
+        RolloutDevice.state.in_(_OPEN),
+    ).count()
+    last_wave = len(config.ROLLOUT_WAVES) - 1
+    if rollout.wave < last_wave and (
+        not open_in_wave
+        or now - rollout.wave_started > config.ROLLOUT_WAVE_SEC
+    ):
+        rollout.wave += 1
+        rollout.wave_started = now
+
+
+def firmware_for(dev: Device, reported_version: int) -> int:
+    """Firmware version to send to the device in /store.
+
+    dev.firmware_version unless the device is in an open rollout and it
+    is its turn.
+    """
+    if dev.serial_number not in _active_serials():
+        return dev.firmware_version
+
+    entry = (
+        RolloutDevice.query.join(Rollout)
+        .filter(
+            RolloutDevice.serial_number == dev.serial_number,
+            RolloutDevice.state.in_(_OPEN),
+            Rollout.status.in_((RUNNING, PAUSED)),
+        )
+        .order_by(RolloutDevice.id.desc())
+        .first()
+    )
+    if entry is None:
+        return dev.firmware_version
+
+    rollout = entry.rollout
+    now = arrow.utcnow().timestamp
+
+    if reported_version == rollout.firmware_version:
+        entry.state = DONE
+        dev.firmware_version = rollout.firmware_version
+        _update(rollout, now)
+        db.session.commit()
+        invalidate_summary()
+        return dev.firmware_version
+
+    if entry.state == OFFERED:
+        if now - entry.offered_at <= config.ROLLOUT_TIMEOUT_SEC:
+            return rollout.firmware_version
+        entry.state = FAILED
+        _update(rollout, now)
+        db.session.commit()
+        return dev.firmware_version
+
+    if rollout.status != RUNNING:
+        return dev.firmware_version
+
+    def in_flight():
+        # En todas las actualizaciones abiertas, sin las expiradas
+        # (que _update sólo marca en la propia).
+        return (
+            RolloutDevice.query.join(Rollout)
+            .filter(
+                RolloutDevice.state == OFFERED,
+                RolloutDevice.offered_at
+                >= now - config.ROLLOUT_TIMEOUT_SEC,
+                Rollout.status.in_((RUNNING, PAUSED)),
+            )
+            .count()
+        )
+
+    if (
+        entry.wave > rollout.wave
+        or in_flight() >= rollout.max_in_flight
+    ):
+        # Puede que haya expirado la etapa o alguna descarga.
+        _update(rollout, now)
+        db.session.commit()
+        if (
+            rollout.status != RUNNING
+            or entry.wave > rollout.wave
+            or in_flight() >= rollout.max_in_flight
+        ):
+            return dev.firmware_version
+
+    claimed = RolloutDevice.query.filter(
+        RolloutDevice.id == entry.id, RolloutDevice.state == PENDING
+    ).update(
+        {"state": OFFERED, "offered_at": now}, synchronize_session=False
+    )
+    db.session.commit()
+    if not claimed:
+        return dev.firmware_version
+    return rollout.firmware_version
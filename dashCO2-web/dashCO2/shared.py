@@ -4,14 +4,13 @@
 
 """
 
-import math
-import pathlib
 import secrets
 from typing import Union
 
 import arrow
+import numpy as np
 
-from . import config
+from . import config, firmware
 
 MAGIC_COOKIE_KEY = "CO2_TOKEN"
 MAGIC_COOKIE = secrets.token_urlsafe(16)
@@ -24,19 +23,11 @@ def check_cookie(value):
 
 
 def get_latest_firmware_version() -> Union[int, None]:
-    try:
-        stem, _ = sorted(
-            pathlib.Path(config.FIRMWARE_FOLDER).glob("20*.ino.bin")
-        )[-1].name.split(".", 1)
-        return int(stem)
-    except IndexError:
-        return None
+    return firmware.get_catalog().latest_version()
 
 
 def firmware_version_exists(version: int) -> bool:
-    return (
-        pathlib.Path(config.FIRMWARE_FOLDER) / f"{version}.ino.bin"
-    ).exists()
+    return firmware.get_catalog().get(version) is not None
 
 
 class COLORS:
@@ -46,36 +37,72 @@ class COLORS:
     DANGER = "#f45060"
 
 
+# Códigos de estado devueltos por classify, y su color.
+OFFLINE, OK, WARNING, DANGER = range(4)
+STATUS_COLORS = (
+    COLORS.OFFLINE,
+    COLORS.OK,
+    COLORS.WARNING,
+    COLORS.DANGER,
+)
+
+
+def classify(
+    values,
+    timestamps=None,
+    now: float = None,
+    consider_offline_sec=config.CONSIDER_OFFLINE_SEC,
+) -> np.ndarray:
+    """Status code (OFFLINE, OK, WARNING or DANGER) of many devices.
+
+    - values: last values (NaN when unknown).
+    - timestamps: time of the last values (NaN when unknown),
+      if None the devices are not checked for being offline.
+    - now: timestamp used to check for offline devices,
+      defaults to the current time.
+    """
+    values = np.asarray(values, dtype=float)
+    offline = np.isnan(values)
+    if timestamps is not None:
+        if now is None:
+            now = arrow.utcnow().float_timestamp
+        timestamps = np.asarray(timestamps, dtype=float)
+        offline |= np.isnan(timestamps)
+        offline |= now - timestamps > consider_offline_sec
+
+    return np.select(
+        [
+            offline,
+            values > config.RANGES.DANGER,
+            values > config.RANGES.WARNING,
+        ],
+        [OFFLINE, DANGER, WARNING],
+        OK,
+    )
+
+
+def group_by_status(serial_numbers, codes) -> dict[COLORS, set[int]]:
+    """Serial numbers grouped by the color of their status code."""
+    serial_numbers = np.asarray(serial_numbers)
+    return {
+        color: set(serial_numbers[codes == code].tolist())
+        for code, color in enumerate(STATUS_COLORS)
+    }
+
+
 def color_from_value(
     value,
     timestamp: float = None,
     consider_offline_sec=config.CONSIDER_OFFLINE_SEC,
 ) -> COLORS:
-    if timestamp:
-        try:
-            if not isinstance(timestamp, (int, float)):
-                timestamp = timestamp()
-            if (
-                arrow.utcnow().float_timestamp - timestamp
-                > consider_offline_sec
-            ):
-                return COLORS.OFFLINE
-        except Exception:
-            raise Exception(
-                (
-                    arrow.utcnow().float_timestamp,
-                    timestamp,
-                    config.CONSIDER_OFFLINE_SEC,
-                )
-            )
-
-    if math.isnan(value):
-        return COLORS.OFFLINE
-
-    elif value > config.RANGES.DANGER:
-        return COLORS.DANGER
-
-    elif value > config.RANGES.WARNING:
-        return COLORS.WARNING
-
-    return COLORS.OK
+    """Color of a single device (see classify)."""
+    if timestamp is not None and not isinstance(
+        timestamp, (int, float)
+    ):
+        timestamp = timestamp()
+    code = classify(
+        [value],
+        None if not timestamp else [timestamp],
+        consider_offline_sec=consider_offline_sec,
+    )
+    return STATUS_COLORS[int(code[0])]
@@ -0,0 +1,77 @@
+"""
+    dashCO2.wire
+    ~~~~~~~~~~~~
+
+    Formato compacto para enviar series de mediciones al navegador.
+
+    Cada serie (timestamps, valores) se codifica como:
+        t0: primer timestamp.
+        dt: diferencias entre timestamps consecutivos, uint16 en base64.
+        v: valores, int16 en base64.
+        big: (sólo si hace falta) las diferencias de 65535 s o más, en
+            orden. En dt se reemplazan por 65535.
+
+    Las series se ordenan por timestamp y los valores se limitan al rango
+    de int16, así que un reloj desfasado o un corte largo en un
+    dispositivo no impide codificar su serie.
+
+    Todos los números son little-endian
+    (ver decodeSeries en assets/sparklines.js).
+"""
+
+from __future__ import annotations
+
+import base64
+
+import numpy as np
+
+_DT = np.dtype("<u2")
+_V = np.dtype("<i2")
+
+# Diferencia que indica que el valor real está en big.
+_ESCAPE = 0xFFFF
+
+
+def _b64(arr: np.ndarray) -> str:
+    return base64.b64encode(arr.tobytes()).decode("ascii")
+
+
+def encode_series(timestamps, values) -> dict:
+    """Encode timestamps and values."""
+    if not len(timestamps):
+        return dict(t0=0, dt="", v="")
+
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    deltas = np.diff(timestamps)
+    if deltas.size and deltas.min() < 0:
+        order = np.argsort(timestamps, kind="stable")
+        timestamps, values = timestamps[order], values[order]
+        deltas = np.diff(timestamps)
+
+    data = dict(t0=int(timestamps[0]))
+    big = deltas >= _ESCAPE
+    if big.any():
+        data["big"] = deltas[big].tolist()
+        deltas[big] = _ESCAPE
+    iinfo = np.iinfo(_V)
+    data["dt"] = _b64(deltas.astype(_DT))
+    data["v"] = _b64(np.clip(values, iinfo.min, iinfo.max).astype(_V))
+    return data
+
+
+def decode_series(data: dict) -> tuple[list[int], list[int]]:
+    """Inverse of encode_series."""
+    values = np.frombuffer(base64.b64decode(data["v"]), dtype=_V)
+    if not values.size:
+        return [], []
+    deltas = np.frombuffer(
+        base64.b64decode(data["dt"]), dtype=_DT
+    ).astype(np.int64)
+    if "big" in data:
+        deltas[deltas == _ESCAPE] = data["big"]
+    timestamps = np.empty(values.size, dtype=np.int64)
+    timestamps[0] = data["t0"]
+    np.cumsum(deltas, out=timestamps[1:])
+    timestamps[1:] += data["t0"]
+    return timestamps.tolist(), values.tolist()
@@ -0,0 +1,64 @@
+import contextlib
+
+import pytest
+import sqlalchemy
+from sqlalchemy import event
+
+from dashCO2 import config, fleet, models
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """App on a sqlite database with a small synthetic fleet."""
+    path = tmp_path_factory.mktemp("db") / "fleet.db"
+    config.SQLALCHEMY_DATABASE_URI = f"sqlite:///{path}"
+    engine = sqlalchemy.create_engine(config.SQLALCHEMY_DATABASE_URI)
+    models.db.Model.metadata.create_all(engine)
+    fleet.generate(engine, 45, 2, period_sec=300)
+    engine.dispose()
+
+    from dashCO2 import create_app
+
+    return create_app(False)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def count_queries(app):
+    """Context manager returning the list of statements executed
+    inside it."""
+    with app.app_context():
+        engine = models.db.engine
+
+    @contextlib.contextmanager
+    def counter():
+        statements = []
+
+        def _count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", _count)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, "before_cursor_execute", _count)
+
+    return counter
+
+
+@pytest.fixture
+def queries_per_request(client, count_queries):
+    """Number of statements of a GET request, once the caches (record
+    counts, etc.) are filled by a first request."""
+
+    def queries(url):
+        assert client.get(url).status_code == 200
+        with count_queries() as statements:
+            assert client.get(url).status_code == 200
+        return len(statements)
+
+    return queries
@@ -0,0 +1,9 @@
+"""The Sensores list must run the same number of queries whatever the
+page (no query per row)."""
+
+
+def test_device_list(queries_per_request):
+    # 45 devices: a full first page and a partial last one.
+    first = queries_per_request("/admin/device/")
+    last = queries_per_request("/admin/device/?page=2")
+    assert first == last
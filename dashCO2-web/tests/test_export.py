@@ -0,0 +1,57 @@
+"""Export of the record views (see RecordView.stream_view)."""
+
+import csv
+import html
+import io
+import re
+from urllib.parse import parse_qs, urlparse
+
+import arrow
+
+
+def _rows(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    return list(csv.DictReader(io.StringIO(response.data.decode())))
+
+
+def test_filtered_export(client):
+    rows = _rows(
+        client, "/admin/record/stream/csv/?flt1_serial_number_equals=10"
+    )
+    assert rows
+    assert {row["serial_number"] for row in rows} == {"10"}
+
+
+def test_search_export(client):
+    rows = _rows(client, "/admin/record/stream/csv/?search=11")
+    assert rows
+    assert {row["serial_number"] for row in rows} == {"11"}
+
+
+def test_temporal_view_export(client):
+    start = arrow.utcnow().shift(days=-1).timestamp
+    rows = _rows(
+        client, "/admin/day/stream/csv/?flt1_serial_number_equals=12"
+    )
+    assert rows
+    assert {row["serial_number"] for row in rows} == {"12"}
+    # Allow for the time between the request and now.
+    assert min(int(row["timestamp"]) for row in rows) >= start - 60
+    unfiltered = _rows(client, "/admin/record/stream/csv/")
+    assert len(unfiltered) > len(rows)
+
+
+def test_list_links_keep_the_filters(client):
+    response = client.get(
+        "/admin/day/?flt1_serial_number_equals=12&search=1"
+    )
+    assert response.status_code == 200
+    (link,) = re.findall(
+        r'href="(/admin/day/stream/csv/[^"]*)"', response.data.decode()
+    )
+    query = parse_qs(urlparse(html.unescape(link)).query)
+    assert query == {
+        "flt1_serial_number_equals": ["12"],
+        "search": ["1"],
+    }
@@ -0,0 +1,30 @@
+"""Compressed firmware variants (see firmware.Catalog)."""
+
+import gzip
+import hashlib
+
+from dashCO2 import firmware
+
+
+def test_gzip_variants_stay_out_of_the_catalog(tmp_path):
+    data = b"\x00" * 4096 + b"firmware" * 100
+    (tmp_path / "2021070100.ino.bin").write_bytes(data)
+    # A leftover of an interrupted write.
+    (tmp_path / "2021070100.ino.bin.gz.abc.tmp").write_bytes(b"x")
+
+    for _ in range(2):
+        catalog = firmware.Catalog(tmp_path, 0, gzip_variants=True)
+        (entry,) = catalog.files()
+        assert entry.name == "2021070100"
+        assert gzip.decompress(entry.gz_path.read_bytes()) == data
+        assert (
+            entry.gz_md5
+            == hashlib.md5(entry.gz_path.read_bytes()).hexdigest()
+        )
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "2021070100.ino.bin",
+        "2021070100.ino.bin.gz",
+        "2021070100.ino.bin.gz.abc.tmp",
+        "2021070100.ino.bin.gz.md5",
+    ]
@@ -0,0 +1,31 @@
+"""Synthetic fleets (see fleet.generate)."""
+
+import sqlalchemy
+
+from dashCO2 import fleet, models
+
+
+def test_generate_after_deleted_devices(tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/fleet.db")
+    models.db.Model.metadata.create_all(engine)
+    end = 1_625_000_000
+    fleet.generate(engine, 2, 1, period_sec=600, end=end)
+
+    # The aggregates of a deleted device stay in the database.
+    with engine.begin() as conn:
+        conn.execute(
+            models.Device.__table__.delete().where(
+                models.Device.serial_number == 2
+            )
+        )
+
+    # Same range: new serial numbers, no duplicate buckets.
+    fleet.generate(engine, 2, 1, period_sec=600, end=end)
+    with engine.connect() as conn:
+        serial_numbers = sorted(
+            sn
+            for (sn,) in conn.execute(
+                sqlalchemy.select([models.Device.serial_number])
+            )
+        )
+    assert serial_numbers == [1, 3, 4]
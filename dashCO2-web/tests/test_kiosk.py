@@ -0,0 +1,35 @@
+"""ETag of the kiosk pages (see kiosk.render)."""
+
+import arrow
+
+from dashCO2 import kiosk
+
+_URL = "/kiosk/Pabellón 1"
+
+
+def _get(client, **headers):
+    kiosk._pages.clear()
+    return client.get(_URL, headers=headers)
+
+
+def test_etag_does_not_change_with_the_clock(client, monkeypatch):
+    first = _get(client)
+    assert first.status_code == 200
+
+    # A rebuild some minutes later (no new records) renders a
+    # different body with the same etag.
+    later = arrow.utcnow().shift(minutes=3)
+    monkeypatch.setattr(kiosk.arrow, "utcnow", lambda: later)
+    monkeypatch.setattr(
+        kiosk.arrow, "now", lambda tz=None: later.to(tz or "utc")
+    )
+    second = _get(client)
+    assert second.data != first.data
+    assert second.headers["ETag"] == first.headers["ETag"]
+
+    assert (
+        _get(
+            client, **{"If-None-Match": first.headers["ETag"]}
+        ).status_code
+        == 304
+    )
@@ -0,0 +1,25 @@
+"""Registration of the metrics (see metrics.init_app)."""
+
+import flask
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from dashCO2 import metrics
+
+
+def test_commit_metrics_only_when_enabled(app, monkeypatch):
+    # The test app is created with METRICS off.
+    assert not event.contains(
+        Session, "after_commit", metrics._after_commit
+    )
+
+    monkeypatch.setattr(metrics.config, "METRICS", True)
+    metrics.init_app(flask.Flask(__name__))
+    metrics.init_app(flask.Flask(__name__))
+    try:
+        assert event.contains(
+            Session, "after_commit", metrics._after_commit
+        )
+    finally:
+        event.remove(Session, "before_commit", metrics._before_commit)
+        event.remove(Session, "after_commit", metrics._after_commit)
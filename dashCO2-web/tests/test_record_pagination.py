@@ -0,0 +1,141 @@
+"""Keyset pagination of the record views (see RecordView.get_list)."""
+
+import flask
+import pytest
+
+from dashCO2 import models
+
+# Records of a device not in the fleet, 7 with each timestamp (so that
+# the pages of 20 records end in the middle of a tie).
+_SERIAL = 900
+_TIMESTAMPS = [2_000_000_000 - 60 * (i // 7) for i in range(95)]
+
+
+@pytest.fixture(scope="module")
+def tied(app):
+    """Ids of the records of _SERIAL, newest first."""
+    with app.app_context():
+        models.db.session.bulk_insert_mappings(
+            models.Record,
+            [
+                dict(
+                    serial_number=_SERIAL,
+                    timestamp=ts,
+                    co2=500,
+                    temperature=20,
+                    uptime=0,
+                    ntp_epoch=ts,
+                    boot_id=1,
+                )
+                for ts in _TIMESTAMPS
+            ],
+        )
+        models.db.session.commit()
+        yield [
+            id_
+            for (id_,) in models.Record.query.with_entities(
+                models.Record.id
+            )
+            .filter_by(serial_number=_SERIAL)
+            .order_by(
+                models.Record.timestamp.desc(), models.Record.id.desc()
+            )
+        ]
+        models.Record.query.filter_by(serial_number=_SERIAL).delete()
+        models.db.session.commit()
+
+
+def _view(app, endpoint):
+    admin = app.extensions["admin"][0]
+    return next(v for v in admin._views if v.endpoint == endpoint)
+
+
+def _page(app, url, endpoint="record"):
+    """Ids of the records in the page and its keyset links."""
+    view = _view(app, endpoint)
+    with app.test_request_context(url):
+        args = view._get_list_extra_args()
+        _, rows = view.get_list(
+            0, None, False, args.search, args.filters
+        )
+        return [row.id for row in rows], flask.g.keyset
+
+
+def _walk(app, url):
+    """Pages following the next links from url."""
+    pages = []
+    while url:
+        ids, keyset = _page(app, url)
+        pages.append((url, ids, keyset))
+        url = keyset["next_url"]
+    return pages
+
+
+def test_pages_follow_the_order(app, tied):
+    pages = _walk(
+        app, f"/admin/record/?flt1_serial_number_equals={_SERIAL}"
+    )
+    # Contiguous and without overlaps, across equal timestamps.
+    assert [i for _, ids, _ in pages for i in ids] == tied
+    assert len(pages) > 2
+    assert all(ids for _, ids, _ in pages)
+    assert pages[0][2]["prev_url"] is None
+
+
+def test_prev_links(app, tied):
+    pages = _walk(
+        app, f"/admin/record/?flt1_serial_number_equals={_SERIAL}"
+    )
+    for (_, ids, _), (_, _, keyset) in zip(pages, pages[1:]):
+        assert _page(app, keyset["prev_url"])[0] == ids
+
+
+def test_prev_next_round_trip(app, tied):
+    pages = _walk(
+        app, f"/admin/record/?flt1_serial_number_equals={_SERIAL}"
+    )
+    _, ids, keyset = pages[1]
+    prev_ids, prev_keyset = _page(app, keyset["prev_url"])
+    assert prev_ids == pages[0][1]
+    assert _page(app, prev_keyset["next_url"])[0] == ids
+
+
+def _cursor(app, position, serial_number=None):
+    """Cursor (timestamp_id) of the record at position, newest first."""
+    with app.app_context():
+        query = models.Record.query
+        if serial_number is not None:
+            query = query.filter_by(serial_number=serial_number)
+        record = (
+            query.order_by(
+                models.Record.timestamp.desc(),
+                models.Record.id.desc(),
+            )
+            .offset(position)
+            .first()
+        )
+    return f"{record.timestamp}_{record.id}"
+
+
+@pytest.mark.parametrize("endpoint", ["record", "day"])
+def test_deep_pages_same_queries(app, queries_per_request, endpoint):
+    url = f"/admin/{endpoint}/"
+    first = queries_per_request(url)
+    for args in (
+        f"?after={_cursor(app, 20)}",
+        f"?after={_cursor(app, 5000)}",
+        f"?before={_cursor(app, 5000)}",
+    ):
+        assert queries_per_request(url + args) == first
+
+
+def test_filtered_deep_pages_same_queries(app, queries_per_request):
+    url = "/admin/record/?flt1_serial_number_equals=10"
+    deep = url + f"&after={_cursor(app, 400, serial_number=10)}"
+    assert queries_per_request(url) == queries_per_request(deep)
+
+
+def test_sorted_by_column_says_offset(client):
+    response = client.get("/admin/record/?sort=2")
+    assert response.status_code == 200
+    assert "OFFSET" in response.get_data(as_text=True)
@@ -0,0 +1,56 @@
+import arrow
+import pytest
+
+from dashCO2 import models, ringbuffer
+from dashCO2.shared import COLORS
+
+
+@pytest.fixture
+def buffer(tmp_path, monkeypatch):
+    buffer = ringbuffer.RingBuffer(str(tmp_path / "ring.bin"), 64, 100)
+    monkeypatch.setattr(ringbuffer, "_buffer", buffer)
+    return buffer
+
+
+def test_rebuild_only_if_stale(buffer):
+    loads = []
+
+    def load():
+        loads.append(1)
+        return [1, 2], [(1, 100, 500), (1, 160, 510), (2, 100, 700)]
+
+    assert buffer.stale(3600)
+    assert buffer.rebuild_if_stale(load, 3600)
+    assert not buffer.stale(3600)
+    # Another worker starting later keeps the content.
+    assert not buffer.rebuild_if_stale(load, 3600)
+    assert len(loads) == 1
+    assert buffer.get_values(1, 0) == ([100, 160], [500, 510])
+
+
+def test_remove(buffer):
+    buffer.rebuild([1, 2], [(1, 100, 500), (2, 100, 700)])
+    buffer.remove(1)
+    assert buffer.get_values(1, 0) == ([], [])
+    assert buffer.last_values()[0].tolist() == [2]
+
+
+def test_status_uses_all_devices(app, buffer):
+    now = arrow.utcnow().timestamp
+    with app.app_context():
+        serial_numbers = [
+            sn
+            for (sn,) in models.Device.query.with_entities(
+                models.Device.serial_number
+            )
+        ]
+        # Only the first device reported since the rebuild, and 999
+        # is not in the database (e.g. deleted elsewhere).
+        buffer.rebuild([], [(serial_numbers[0], now, 450)])
+        buffer.append(999, now, 450)
+
+        by_status = models.get_devices_by_status()
+
+    assert set().union(*by_status.values()) == set(serial_numbers)
+    assert serial_numbers[0] in by_status[COLORS.OK]
+    assert set(serial_numbers[1:]) <= by_status[COLORS.OFFLINE]
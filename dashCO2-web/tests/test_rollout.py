@@ -0,0 +1,50 @@
+"""Limit of simultaneous downloads (see rollout.firmware_for)."""
+
+import pytest
+
+from dashCO2 import config, models, rollout
+
+
+@pytest.fixture
+def rollouts(app, monkeypatch):
+    """Two rollouts of one wave, for devices 20 and 21, with room for
+    a single download."""
+    monkeypatch.setattr(config, "ROLLOUT_WAVES", (100,))
+    monkeypatch.setattr(config, "ROLLOUT_MAX_IN_FLIGHT", 1)
+    with app.app_context():
+        devices = [
+            models.Device.query.filter_by(serial_number=sn).one()
+            for sn in (20, 21)
+        ]
+        created = [
+            rollout.create([dev.id], dev.firmware_version + 1)
+            for dev in devices
+        ]
+        yield devices, created
+        rollout.set_status([r.id for r in created], rollout.CANCELLED)
+        models.RolloutDevice.query.filter(
+            models.RolloutDevice.rollout_id.in_([r.id for r in created])
+        ).delete(synchronize_session=False)
+        models.Rollout.query.filter(
+            models.Rollout.id.in_([r.id for r in created])
+        ).delete(synchronize_session=False)
+        models.db.session.commit()
+
+
+def test_limit_across_rollouts(rollouts):
+    (first, second), (first_rollout, second_rollout) = rollouts
+    version = first.firmware_version
+    assert (
+        rollout.firmware_for(first, version)
+        == first_rollout.firmware_version
+    )
+    # The download of the other rollout takes the only place.
+    version = second.firmware_version
+    assert rollout.firmware_for(second, version) == version
+
+    # Once the first device is updated, the second one gets its turn.
+    rollout.firmware_for(first, first_rollout.firmware_version)
+    assert (
+        rollout.firmware_for(second, version)
+        == second_rollout.firmware_version
+    )
@@ -0,0 +1,78 @@
+import arrow
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from dashCO2 import metrics, models
+
+
+def _store(client, serial_number, timestamp, co2):
+    return client.post(
+        "/store",
+        json=dict(
+            timestamp=timestamp,
+            uptime=1,
+            ntpEpoch=timestamp,
+            bootID=1,
+            userRecord=dict(co2=co2, temperature=22),
+        ),
+        headers={
+            "SNO-SERIAL-NUMBER": str(serial_number),
+            "SNO-ACQ-PERIOD": "60000",
+            "SNO-METHOD": "0",
+            "SNO-USER-lastCalibration": "42",
+            "SNO-USER-firmwareVersion": "2021071801",
+        },
+    )
+
+
+def _minute(app, serial_number, timestamp):
+    with app.app_context():
+        return models.RecordAggregate.query.filter_by(
+            resolution=60,
+            serial_number=serial_number,
+            bucket=timestamp - timestamp % 60,
+        ).first()
+
+
+def _records(app, serial_number, timestamp):
+    with app.app_context():
+        return models.Record.query.filter_by(
+            serial_number=serial_number, timestamp=timestamp
+        ).count()
+
+
+def test_store_updates_aggregates(app, client):
+    # A minute without records of the fleet (two days ahead).
+    timestamp = arrow.utcnow().timestamp + 2 * 86400
+    timestamp -= timestamp % 60
+    assert _store(client, 3, timestamp, 700).status_code == 200
+    assert _store(client, 3, timestamp + 1, 900).status_code == 200
+
+    aggregate = _minute(app, 3, timestamp)
+    assert (aggregate.count, aggregate.co2_sum) == (2, 1600)
+    assert (aggregate.co2_min, aggregate.co2_max) == (700, 900)
+
+
+def test_store_without_aggregates(app, client, monkeypatch):
+    def fail(*args):
+        raise OperationalError("UPDATE", {}, Exception("locked"))
+
+    monkeypatch.setattr(models, "_add_to_aggregate", fail)
+    failures = metrics.REGISTRY.totals()[
+        (metrics.AGGREGATE_FAILURES.name, (), None)
+    ]
+    timestamp = arrow.utcnow().timestamp + 3 * 86400
+
+    assert _store(client, 4, timestamp, 650).status_code == 200
+    assert _records(app, 4, timestamp) == 1
+    assert _minute(app, 4, timestamp) is None
+    assert metrics.REGISTRY.totals()[
+        (metrics.AGGREGATE_FAILURES.name, (), None)
+    ] == pytest.approx(failures + 1)
+    with app.app_context():
+        assert (
+            models.Device.query.filter_by(serial_number=4)
+            .one()
+            .last_seen
+            == timestamp
+        )